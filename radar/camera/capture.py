@@ -0,0 +1,147 @@
+import time
+import logging
+import threading
+import traceback
+from collections import deque
+
+from metrics.prometheus import REGISTRY
+
+logger = logging.getLogger(__name__)
+
+CAPTURE_SECONDS = REGISTRY.histogram("camera_capture_seconds", "camera takeStill() until the image is on disk")
+CAPTURE_WAIT_SECONDS = REGISTRY.histogram("camera_capture_wait_seconds", "capture request waiting for the camera")
+
+class CaptureRequest:
+    __slots__ = ("key", "speed", "distance", "magnitude", "angle", "millis", "submitted")
+
+    def __init__(self, key, speed, distance, magnitude, angle, millis):
+        self.key = key
+        self.millis = millis # when the trigger happened, for cameras that can look back
+        self.speed = speed
+        self.distance = distance
+        self.magnitude = magnitude
+        self.angle = angle
+        self.submitted = time.monotonic()
+
+class CaptureWorker:
+    """
+    runs camera.takeStill() on its own thread so the radar loop only ever
+    appends to a bounded queue. what happens when the queue is full is
+    up to the policy
+        drop_newest - the new request is thrown away
+        drop_oldest - the oldest waiting request is thrown away
+        coalesce    - a waiting request with the same key (the track id) is
+                      replaced by the new one, otherwise drop_oldest
+    """
+    DROP_NEWEST = "drop_newest"
+    DROP_OLDEST = "drop_oldest"
+    COALESCE = "coalesce"
+    POLICIES = (DROP_NEWEST, DROP_OLDEST, COALESCE)
+
+    def __init__(self, camera, size=4, policy=COALESCE, onSaved=None):
+        if (policy not in self.POLICIES):
+            raise ValueError(f'''unknown capture policy [{policy}]''')
+
+        self.camera = camera
+        self.onSaved = onSaved # called with each file the camera wrote
+        self.size = size
+        self.policy = policy
+
+        self._queue = deque()
+        self._cond = threading.Condition()
+        self.isStopped = False
+
+        self.submitted = 0
+        self.captured = 0
+        self.dropped = 0
+        self.coalesced = 0
+        self.errors = 0
+        self._waitTotal = 0.0 # seconds from submit to capture start
+        self._waitMax = 0.0
+        self._captureTotal = 0.0 # seconds in takeStill
+        self._captureMax = 0.0
+
+        self._thread = threading.Thread(target=self.run, name="Camera", daemon=True)
+        self._thread.start()
+
+    def submit(self, key, speed, distance, magnitude, angle, millis=None):
+        """
+        never blocks. returns False if the request was dropped
+        """
+        request = CaptureRequest(key, speed, distance, magnitude, angle, millis)
+        with self._cond:
+            self.submitted += 1
+
+            if (self.policy == self.COALESCE and key != None):
+                for i, waiting in enumerate(self._queue):
+                    if (waiting.key == key):
+                        # keep the original times so latency stays honest and
+                        # the camera still looks back to the first trigger
+                        request.submitted = waiting.submitted
+                        request.millis = waiting.millis
+                        self._queue[i] = request
+                        self.coalesced += 1
+                        return True
+
+            if (len(self._queue) >= self.size):
+                self.dropped += 1
+                if (self.policy == self.DROP_NEWEST):
+                    return False
+                self._queue.popleft()
+
+            self._queue.append(request)
+            self._cond.notify()
+        return True
+
+    def stop(self):
+        with self._cond:
+            self.isStopped = True
+            self._cond.notify()
+
+    def run(self):
+        while True:
+            with self._cond:
+                while len(self._queue) == 0 and not self.isStopped:
+                    self._cond.wait()
+                if (self.isStopped):
+                    break
+                request = self._queue.popleft()
+
+            start = time.monotonic()
+            try:
+                filename = self.camera.takeStill(request.speed, request.distance, request.magnitude, request.angle, request.millis)
+                if (filename != None and self.onSaved != None):
+                    self.onSaved(filename)
+            except Exception as e:
+                self.errors += 1
+                traceback.print_exc()
+            end = time.monotonic()
+
+            wait = start - request.submitted
+            capture = end - start
+            CAPTURE_WAIT_SECONDS.observe(wait)
+            CAPTURE_SECONDS.observe(capture)
+            with self._cond:
+                self.captured += 1
+                self._waitTotal += wait
+                self._waitMax = max(self._waitMax, wait)
+                self._captureTotal += capture
+                self._captureMax = max(self._captureMax, capture)
+
+        logger.info(f'''camera worker was stopped''')
+
+    def getMetrics(self):
+        with self._cond:
+            n = max(self.captured, 1)
+            return {"policy": self.policy,
+                    "size": self.size,
+                    "queued": len(self._queue),
+                    "submitted": self.submitted,
+                    "captured": self.captured,
+                    "dropped": self.dropped,
+                    "coalesced": self.coalesced,
+                    "errors": self.errors,
+                    "wait_avg_ms": int(self._waitTotal / n * 1000),
+                    "wait_max_ms": int(self._waitMax * 1000),
+                    "capture_avg_ms": int(self._captureTotal / n * 1000),
+                    "capture_max_ms": int(self._captureMax * 1000)}
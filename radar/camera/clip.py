@@ -0,0 +1,133 @@
+import os
+import time
+import logging
+import threading
+import traceback
+from datetime import datetime
+from picamera2.encoders import H264Encoder
+from picamera2.outputs import CircularOutput
+
+logger = logging.getLogger(__name__)
+
+class ClipRecorder:
+    """
+    the hardware encoder runs all the time into a circular buffer holding
+    preRoll seconds of H.264. trigger() only moves a deadline, a thread of
+    our own opens the file, flushes the pre-roll and closes it postRoll
+    seconds after the last trigger. triggers while a clip is being written
+    make that clip longer instead of starting another one, up to maxLength
+    """
+    def __init__(self, camera, preRoll=3, postRoll=3, maxLength=30, fps=30, bitrate=4000000, folder="clips"):
+        self.camera = camera
+        self.preRoll = preRoll
+        self.postRoll = postRoll
+        self.maxLength = maxLength
+        self.folder = folder
+        os.makedirs(folder, exist_ok=True)
+
+        # sps/pps with every keyframe so a clip cut from the middle still plays
+        self.encoder = H264Encoder(bitrate=bitrate, repeat=True, iperiod=fps)
+        self.output = CircularOutput(buffersize=int(preRoll * fps))
+
+        self._cond = threading.Condition()
+        self.isStopped = False
+        self._deadline = None # monotonic time the current clip ends, None when idle
+        self._clipStart = 0
+        self._speed = 0
+        self._keys = set()
+
+        self.triggers = 0
+        self.merged = 0
+        self.clips = 0
+        self.errors = 0
+        self.lastClip = None
+
+        self.camera.start_encoder(self.encoder, self.output)
+
+        self._thread = threading.Thread(target=self.run, name="Clips", daemon=True)
+        self._thread.start()
+
+    def trigger(self, key=None, speed=0):
+        """
+        never blocks. returns False if this was merged into a clip already going
+        """
+        now = time.monotonic()
+        with self._cond:
+            self.triggers += 1
+            self._speed = max(self._speed, speed)
+
+            if (self._deadline != None):
+                self._keys.add(key)
+                self.merged += 1
+                self._deadline = min(max(self._deadline, now + self.postRoll), self._clipStart + self.maxLength)
+                return False
+
+            self._keys = {key}
+            self._clipStart = now
+            self._deadline = now + self.postRoll
+            self._cond.notify()
+        return True
+
+    def stop(self):
+        with self._cond:
+            self.isStopped = True
+            self._cond.notify()
+        self._thread.join()
+        self.camera.stop_encoder()
+
+    def run(self):
+        while True:
+            with self._cond:
+                while self._deadline == None and not self.isStopped:
+                    self._cond.wait()
+                if (self.isStopped):
+                    break
+                speed = self._speed
+
+            now = datetime.now()
+            filename = f'''{self.folder}/{now.year}{now.month:0>2}{now.day:0>2}{now.hour:0>2}{now.minute:0>2}{now.second:0>2}{now.microsecond:0>6}-{int(speed):0>2}.h264'''
+
+            try:
+                # writes the pre-roll out of the buffer, the encoder thread
+                # keeps appending live frames until stop()
+                self.output.fileoutput = filename
+                self.output.start()
+            except Exception as e:
+                self.errors += 1
+                traceback.print_exc()
+                with self._cond:
+                    self._deadline = None
+                    self._speed = 0
+                continue
+
+            with self._cond:
+                while not self.isStopped:
+                    remaining = self._deadline - time.monotonic()
+                    if (remaining <= 0):
+                        break
+                    self._cond.wait(remaining)
+                length = time.monotonic() - self._clipStart
+                vehicles = len(self._keys)
+                self._deadline = None
+                self._speed = 0
+
+            try:
+                self.output.stop()
+            except Exception as e:
+                self.errors += 1
+                traceback.print_exc()
+
+            self.clips += 1
+            self.lastClip = filename
+            logger.info(f'''clip [{filename}] [{self.preRoll + length:.1f}s] vehicles[{vehicles}]''')
+
+        logger.info(f'''clip recorder was stopped''')
+
+    def getMetrics(self):
+        with self._cond:
+            return {"triggers": self.triggers,
+                    "merged": self.merged,
+                    "clips": self.clips,
+                    "errors": self.errors,
+                    "recording": self._deadline != None,
+                    "last_clip": self.lastClip}
@@ -0,0 +1,135 @@
+import os
+import bisect
+import logging
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+def shardPath(folder, name):
+    """
+    folder/2026/10/18/20261018....jpg. names that don't start with a date stay flat
+    """
+    if (len(name) >= 8 and name[:8].isdigit()):
+        return os.path.join(folder, name[0:4], name[4:6], name[6:8], name)
+    return os.path.join(folder, name)
+
+class ImageIndex:
+    """
+    every image in folder kept sorted by name in memory. names start with
+    the capture time so name order is time order and a new capture almost
+    always lands at the end. files live in year/month/day directories
+    under folder, see shardPath(). the tree is only walked by rebuild(),
+    after that the camera side tells us about new files
+    """
+    def __init__(self, folder="images"):
+        self.folder = folder
+        self._names = [] # oldest first
+        self._info = {} # name -> (size, mtime millis)
+        self._lock = threading.Lock()
+        self.version = 0
+        self.totalBytes = 0
+
+    def rebuild(self):
+        start = time.monotonic()
+        self.migrate()
+
+        names = []
+        info = {}
+        for directory, dirs, files in os.walk(self.folder):
+            for name in files:
+                try:
+                    st = os.stat(os.path.join(directory, name))
+                except FileNotFoundError:
+                    continue
+                names.append(name)
+                info[name] = (st.st_size, int(st.st_mtime * 1000))
+        names.sort()
+
+        with self._lock:
+            self._names = names
+            self._info = info
+            self.totalBytes = sum([size for size, mtime in info.values()])
+            self.version += 1
+        logger.info(f'''indexed [{len(names)}] images [{self.totalBytes // 1048576}M] in [{self.folder}] in [{int((time.monotonic() - start) * 1000)}ms]''')
+
+    def migrate(self):
+        """
+        move images saved before sharding from folder into their day directory
+        """
+        moved = 0
+        try:
+            with os.scandir(self.folder) as d:
+                for f in d:
+                    path = shardPath(self.folder, f.name)
+                    if (f.is_file() and path != f.path):
+                        os.makedirs(os.path.dirname(path), exist_ok=True)
+                        os.replace(f.path, path)
+                        moved += 1
+        except FileNotFoundError:
+            return
+        if (moved > 0):
+            logger.info(f'''moved [{moved}] images into day directories''')
+
+    def getPath(self, name):
+        return shardPath(self.folder, name)
+
+    def add(self, path):
+        """
+        path is what the camera saved, see shardPath()
+        """
+        name = os.path.basename(path)
+        try:
+            st = os.stat(path)
+        except FileNotFoundError:
+            return
+
+        with self._lock:
+            old = self._info.get(name)
+            if (old == None):
+                if (len(self._names) == 0 or name > self._names[-1]):
+                    self._names.append(name)
+                else:
+                    bisect.insort(self._names, name)
+            else:
+                self.totalBytes -= old[0]
+            self._info[name] = (st.st_size, int(st.st_mtime * 1000))
+            self.totalBytes += st.st_size
+            self.version += 1
+
+    def remove(self, name):
+        with self._lock:
+            old = self._info.pop(name, None)
+            if (old == None):
+                return
+            i = bisect.bisect_left(self._names, name)
+            del self._names[i]
+            self.totalBytes -= old[0]
+            self.version += 1
+
+    def items(self):
+        """
+        snapshot of (name, size, mtime millis) oldest first
+        """
+        with self._lock:
+            return [(n, self._info[n][0], self._info[n][1]) for n in self._names]
+
+    def __len__(self):
+        return len(self._names)
+
+    def page(self, cursor=None, limit=50):
+        """
+        up to limit images newest first that are older than cursor (a name
+        from a previous page). returns (images, next cursor or None)
+        """
+        if (limit <= 0):
+            return [], None
+
+        with self._lock:
+            end = len(self._names) if cursor == None else bisect.bisect_left(self._names, cursor)
+            start = max(0, end - limit)
+            names = self._names[start:end][::-1]
+            images = [{"name": n, "path": shardPath(self.folder, n), "size": self._info[n][0], "mtime": self._info[n][1]} for n in names]
+
+        next = names[-1] if start > 0 else None
+        return images, next
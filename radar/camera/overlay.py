@@ -0,0 +1,90 @@
+import numpy as np
+import cv2
+
+class Overlay:
+    """
+    each character is rendered once into a small glyph mask and kept, a
+    line of text is those glyphs laid side by side. the timestamp and speed
+    change every shot but they're made of the same few dozen characters so
+    putText only runs the first time a character is seen. drawing only
+    touches the rectangle the mask covers so the cost doesn't grow with the
+    frame size. the same mask is scaled down for the preview instead of
+    being built again
+    """
+    def __init__(self, font=cv2.FONT_HERSHEY_COMPLEX, scale=1, thickness=2, color=(255, 255, 255)):
+        self.font = font
+        self.scale = scale
+        self.thickness = thickness
+        self.color = color
+        self._glyphs = {} # character -> (mask, advance)
+        self._last = (None, None) # (text, mask) so the preview of the same shot doesn't lay it out again
+
+        # one line height for every glyph so they line up on the baseline
+        (w, h), baseline = cv2.getTextSize("Ag|[]", font, scale, thickness)
+        self._ascent = h
+        self._height = h + baseline + thickness
+
+        self.hits = 0
+        self.misses = 0
+
+    def _glyph(self, c):
+        glyph = self._glyphs.get(c)
+        if (glyph != None):
+            self.hits += 1
+            return glyph
+
+        self.misses += 1
+        (w, h), baseline = cv2.getTextSize(c, self.font, self.scale, self.thickness)
+        # getTextSize adds half the thickness once per string, not per character
+        advance = w - (self.thickness + 1) // 2
+        # thickness spills past the advance, that part overlaps the next glyph
+        mask = np.zeros((self._height, advance + self.thickness), dtype=np.uint8)
+        cv2.putText(mask, c, (0, self._ascent), self.font, self.scale, 255, self.thickness)
+        glyph = self._glyphs[c] = (mask, advance)
+        return glyph
+
+    def _layout(self, text):
+        glyphs = [self._glyph(c) for c in text]
+        width = sum([advance for mask, advance in glyphs]) + self.thickness
+        line = np.zeros((self._height, width), dtype=np.uint8)
+        x = 0
+        for mask, advance in glyphs:
+            region = line[:, x:x + mask.shape[1]]
+            np.maximum(region, mask, out=region)
+            x += advance
+        return line
+
+    def getMask(self, text, width=None):
+        """
+        the rendered text, scaled to width pixels wide if given
+        """
+        last, mask = self._last
+        if (last != text):
+            mask = self._layout(text)
+            self._last = (text, mask)
+
+        if (width != None and width != mask.shape[1]):
+            height = max(1, int(mask.shape[0] * width / mask.shape[1]))
+            mask = cv2.resize(mask, (width, height), interpolation=cv2.INTER_AREA)
+        return mask
+
+    def draw(self, image, text, position, width=None):
+        """
+        position is the bottom left corner of the text like cv2.putText
+        """
+        mask = self.getMask(text, width)
+        x, y = position
+        top = max(0, y - mask.shape[0])
+        h = min(mask.shape[0], image.shape[0] - top)
+        w = min(mask.shape[1], image.shape[1] - x)
+        if (h <= 0 or w <= 0):
+            return
+
+        region = image[top:top + h, x:x + w]
+        where = mask[:h, :w] > 127
+        if (region.ndim == 3):
+            channels = region.shape[2]
+            color = np.array((tuple(self.color) + (255,) * channels)[:channels], dtype=region.dtype)
+            region[where] = color
+        else:
+            region[where] = max(self.color)
@@ -1,16 +1,31 @@
 from pprint import *
+import os
 import logging
 import time
 from datetime import datetime
 from picamera2 import Picamera2, MappedArray
 import cv2
 
+from camera.ring import ImageRing
+from camera.clip import ClipRecorder
+from camera.overlay import Overlay
+from camera.index import shardPath
+
 logger = logging.getLogger(__name__)
 
 class Picam:
-    def __init__ (self):
+    def __init__ (self, preTrigger=0, preTriggerSize=(1640, 1232), clipPreRoll=0, clipPostRoll=3, previewSize=(640, 480)):
 
         self.camera = Picamera2()
+        self.ring:ImageRing = None
+        self.clips:ClipRecorder = None
+        self.overlay = Overlay()
+        # the isp scales the lores stream for free, previews come from it
+        self.previewSize = previewSize
+        os.makedirs("previews", exist_ok=True)
+
+        # stage -> [count, total seconds, max seconds]
+        self.latency = {}
 
         #pprint(self.camera.sensor_modes)
         '''
@@ -25,41 +40,171 @@ class Picam:
         modes[7]:'size': (3280, 2464),
         '''
 
-        # grab values from sensor values so there will be no guessing
-        mode = self.camera.sensor_modes[3]
-        config = self.camera.create_still_configuration(main={'size': mode['size']})
-
-        self.camera.configure(config)
+        if (preTrigger > 0 or clipPreRoll > 0):
+            # keep the sensor streaming and the last few frames around so a
+            # trigger can reach back to when the car was actually in view.
+            # RGB888 is BGR in memory which is what cv2 wants
+            config = self.camera.create_video_configuration(main={'size': preTriggerSize, 'format': 'RGB888'},
+                                                            lores={'size': previewSize})
+            self.camera.configure(config)
+            self.mode = "ring" if preTrigger > 0 else "video"
+
+            if (preTrigger > 0):
+                size = self.camera.camera_configuration()["main"]["size"]
+                self.ring = ImageRing(preTrigger, (size[1], size[0], 3))
+                self.camera.post_callback = self._onFrame
+        else:
+            # grab values from sensor values so there will be no guessing
+            mode = self.camera.sensor_modes[3]
+            config = self.camera.create_still_configuration(main={'size': mode['size']}, lores={'size': previewSize})
+
+            self.camera.configure(config)
+            self.mode = "still"
+
+        # it doesn't change once configured so don't ask the camera every shot
+        self.size = tuple(self.camera.camera_configuration()["main"]["size"])
+        self.previewSize = tuple(self.camera.camera_configuration()["lores"]["size"])
 
         self.camera.start()
 
+        if (clipPreRoll > 0):
+            self.clips = ClipRecorder(self.camera, clipPreRoll, clipPostRoll)
+
+    def _onFrame(self, request):
+        # camera thread. one copy into the ring and out
+        with MappedArray(request, 'main') as m:
+            self.ring.put(m.array)
+
     def __del__(self):
+        if (self.clips != None):
+            self.clips.stop()
         self.camera.stop()
         self.camera.close()
 
-    def takeStill(self, speed, distance, magnitude, angle):
-
-        while True:
-            now = datetime.now()
-            filename = f'''images/{now.year}{now.month:0>2}{now.day:0>2}{now.hour:0>2}{now.minute:0>2}{now.second:0>2}{now.microsecond:0>6}-{speed:0>2}.jpg'''
-
-            text = now.isoformat(timespec='seconds')
-            image_size = self.camera.camera_configuration()["main"]["size"]
-            # left bottom corner
-            position = (0, image_size[1] - 20)
-            font_scale = 1
-            font = cv2.FONT_HERSHEY_COMPLEX
-            color = (255, 255, 255)
-            thickness = 2
-            status = f'''{text} [{speed} mph] [{distance} cm] [{magnitude} dB] [{angle:0>2.2f} rad] [{self.camera.camera_configuration()["main"]["size"]}]'''
-
-            with self.camera.captured_request() as request:
-                with MappedArray(request, 'main') as m:
-                    cv2.putText(m.array, status, position, font, font_scale, color, thickness)
-                    request.save("main", filename)
-            break
-
-        logger.info(f'''Click! [{filename}]''')
+    def triggerClip(self, key, speed):
+        """
+        never blocks. no-op unless clips are on
+        """
+        if (self.clips != None):
+            self.clips.trigger(key, speed)
+
+    def getClipMetrics(self):
+        if (self.clips == None):
+            return None
+        return self.clips.getMetrics()
+
+    def _measure(self, stage, seconds):
+        entry = self.latency.get(stage)
+        if (entry == None):
+            entry = self.latency[stage] = [0, 0.0, 0.0]
+        entry[0] += 1
+        entry[1] += seconds
+        entry[2] = max(entry[2], seconds)
+
+    def getMetrics(self):
+        """
+        capture to disk latency per stage so the modes can be compared
+        """
+        metrics = {"mode": self.mode,
+                   "size": f'''{self.size[0]}x{self.size[1]}''',
+                   "preview_size": f'''{self.previewSize[0]}x{self.previewSize[1]}''',
+                   "overlay_cache_hits": self.overlay.hits,
+                   "overlay_cache_misses": self.overlay.misses}
+        for stage, (count, total, peak) in list(self.latency.items()):
+            metrics[f'''{stage}_avg_ms'''] = int(total / max(count, 1) * 1000)
+            metrics[f'''{stage}_max_ms'''] = int(peak * 1000)
+        return metrics
+
+    def _filename(self, now, speed):
+        return f'''{now.year}{now.month:0>2}{now.day:0>2}{now.hour:0>2}{now.minute:0>2}{now.second:0>2}{now.microsecond:0>6}-{speed:0>2}.jpg'''
+
+    def _status(self, now, speed, distance, magnitude, angle, extra=""):
+        text = now.isoformat(timespec='seconds')
+        return f'''{text} [{speed} mph] [{distance} cm] [{magnitude} dB] [{angle:0>2.2f} rad] [{self.size[0]}x{self.size[1]}]{extra}'''
+
+    def _savePreview(self, preview, status, name):
+        # same text scaled to the preview, not rendered again
+        width = min(preview.shape[1], self.overlay.getMask(status).shape[1] * preview.shape[1] // self.size[0])
+        self.overlay.draw(preview, status, (0, preview.shape[0] - 4), width)
+        cv2.imwrite(f'''previews/{name}''', preview)
+
+    def takeStill(self, speed, distance, magnitude, angle, millis=None):
+        """
+        millis is when the trigger happened. with the pre-trigger ring the
+        sharpest frame since then is saved instead of a new capture
+        """
+        if (self.ring != None):
+            return self._saveFromRing(speed, distance, magnitude, angle, millis)
+
+        start = time.monotonic()
+        now = datetime.now()
+        name = self._filename(now, speed)
+        filename = shardPath("images", name)
+        os.makedirs(os.path.dirname(filename), exist_ok=True)
+        status = self._status(now, speed, distance, magnitude, angle)
+        # left bottom corner
+        position = (0, self.size[1] - 20)
+
+        with self.camera.captured_request() as request:
+            captured = time.monotonic()
+            with MappedArray(request, 'main') as m:
+                self.overlay.draw(m.array, status, position)
+            drawn = time.monotonic()
+            request.save("main", filename)
+            saved = time.monotonic()
+            with MappedArray(request, 'lores') as m:
+                # lores is yuv420, converting it copies it out of the request
+                preview = cv2.cvtColor(m.array, cv2.COLOR_YUV420p2BGR)
+
+        # the request is back with the camera before the preview is written
+        self._savePreview(preview, status, name)
+        done = time.monotonic()
+
+        self._measure("capture", captured - start)
+        self._measure("overlay", drawn - captured)
+        self._measure("save", saved - drawn)
+        self._measure("preview", done - saved)
+        self._measure("total", done - start)
+
+        logger.info(f'''Click! [{filename}] [{int((saved - start) * 1000)}ms]''')
+        return filename
+
+    def _saveFromRing(self, speed, distance, magnitude, angle, millis):
+        if (millis == None):
+            # manual still. newest frame
+            millis = time.time() * 1000
+
+        start = time.monotonic()
+        image, frameMillis, focus = self.ring.pickSharpest(millis)
+        if (image is None):
+            logger.info(f'''pre-trigger ring is empty''')
+            return None
+        captured = time.monotonic()
+
+        now = datetime.fromtimestamp(frameMillis / 1000)
+        name = self._filename(now, speed)
+        filename = shardPath("images", name)
+        os.makedirs(os.path.dirname(filename), exist_ok=True)
+
+        status = self._status(now, speed, distance, magnitude, angle, f''' [focus {int(focus)}]''')
+        self.overlay.draw(image, status, (0, image.shape[0] - 20))
+        drawn = time.monotonic()
+        cv2.imwrite(filename, image)
+        saved = time.monotonic()
+
+        # the ring frame isn't on the lores stream so this one is scaled in software
+        preview = cv2.resize(image, self.previewSize, interpolation=cv2.INTER_AREA)
+        cv2.imwrite(f'''previews/{name}''', preview)
+        done = time.monotonic()
+
+        self._measure("capture", captured - start)
+        self._measure("overlay", drawn - captured)
+        self._measure("save", saved - drawn)
+        self._measure("preview", done - saved)
+        self._measure("total", done - start)
+
+        logger.info(f'''Click! [{filename}] from ring [{int(time.time() * 1000 - frameMillis)}ms] ago''')
+        return filename
 
 
 def go():
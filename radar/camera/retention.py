@@ -0,0 +1,174 @@
+import os
+import heapq
+import shutil
+import logging
+import threading
+import traceback
+
+logger = logging.getLogger(__name__)
+
+DAY_MILLIS = 86400000
+
+def imageSpeed(name):
+    """
+    speed in the name the camera gave it, ...-<mph>.jpg. 0 is a manual still
+    """
+    try:
+        return float(os.path.splitext(name)[0].rsplit('-', 1)[1])
+    except (IndexError, ValueError):
+        return 0
+
+class RetentionManager:
+    """
+    keeps images/ under budgetBytes and the disk above minFreeBytes. every
+    interval seconds it checks and, if either is crossed, deletes at most
+    batch of the least valuable images and comes back soon after for the
+    next batch so a big cleanup never hogs the sd card. value is age with a
+    head start for vehicle captures, a manual still goes first and a
+    vehicle capture lives vehicleBonusDays longer plus speedBonusHours for
+    every mph. images only give up disk for minFreeBytes when deleting
+    them can actually get there, clips, recordings and the database share
+    the disk and aren't ours to delete. getMetrics() takes free space
+    from host's latest sample so page loads don't stat the disk
+    """
+    def __init__(self, index, thumbnails=None, previews="previews", budgetBytes=4 << 30, minFreeBytes=1 << 30,
+                 interval=60, batch=50, vehicleBonusDays=7, speedBonusHours=1, host=None):
+        self.index = index
+        self.host = host
+        self.thumbnails = thumbnails
+        self.previews = previews
+        self.budgetBytes = budgetBytes
+        self.minFreeBytes = minFreeBytes
+        self.interval = interval
+        self.batch = batch
+        self.vehicleBonusDays = vehicleBonusDays
+        self.speedBonusHours = speedBonusHours
+        # disk_usage() needs it to exist before the first capture makes it
+        os.makedirs(index.folder, exist_ok=True)
+
+        self.isStopped = False
+        self._cond = threading.Condition()
+
+        self.freeReachable = True
+        self.free = None # as of the last check
+        self.evicted = 0
+        self.evictedBytes = 0
+        self.passes = 0
+        self.errors = 0
+
+        self._thread = threading.Thread(target=self.run, name="Retention", daemon=True)
+        self._thread.start()
+
+    def value(self, name, mtime):
+        """
+        bigger is kept longer. in millis so it reads like a timestamp
+        """
+        speed = imageSpeed(name)
+        if (speed <= 0):
+            return mtime
+        return mtime + self.vehicleBonusDays * DAY_MILLIS + speed * self.speedBonusHours * 3600000
+
+    def getExcess(self):
+        """
+        bytes that have to go, 0 if we're fine
+        """
+        excess = self.index.totalBytes - self.budgetBytes
+        (total, used, free) = shutil.disk_usage(self.index.folder)
+        self.free = free
+        shortfall = self.minFreeBytes - free
+
+        # something else filled the disk. wiping the archive wouldn't fix it
+        reachable = shortfall <= self.index.totalBytes
+        if (reachable != self.freeReachable):
+            self.freeReachable = reachable
+            if (reachable):
+                logger.info(f'''free space [{free // 1048576}M] can be recovered from images again''')
+            else:
+                logger.warning(f'''free space [{free // 1048576}M] is below [{self.minFreeBytes // 1048576}M] and deleting every image [{self.index.totalBytes // 1048576}M] wouldn't fix it. only the image budget is enforced until it can''')
+        if (not reachable):
+            shortfall = 0
+
+        return max(excess, shortfall, 0)
+
+    def evictOnce(self):
+        """
+        one batch. returns True if there's still more to do
+        """
+        excess = self.getExcess()
+        if (excess <= 0):
+            return False
+
+        self.passes += 1
+        victims = heapq.nsmallest(self.batch, self.index.items(), key=lambda item: self.value(item[0], item[2]))
+        if (len(victims) == 0):
+            return False
+
+        for name, size, mtime in victims:
+            if (excess <= 0):
+                break
+            path = self.index.getPath(name)
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            self.index.remove(name)
+            if (self.thumbnails != None):
+                self.thumbnails.remove(name)
+            try:
+                os.remove(os.path.join(self.previews, name))
+            except FileNotFoundError:
+                pass
+            self._removeEmpty(os.path.dirname(path))
+
+            excess -= size
+            self.evicted += 1
+            self.evictedBytes += size
+
+        logger.info(f'''retention evicted [{self.evicted}] images so far [{self.evictedBytes // 1048576}M]''')
+        return excess > 0
+
+    def _removeEmpty(self, directory):
+        # day, month and year directories go once they're empty
+        while os.path.abspath(directory) != os.path.abspath(self.index.folder):
+            try:
+                os.rmdir(directory)
+            except OSError:
+                return
+            directory = os.path.dirname(directory)
+
+    def stop(self):
+        with self._cond:
+            self.isStopped = True
+            self._cond.notify()
+
+    def run(self):
+        while True:
+            more = False
+            try:
+                more = self.evictOnce()
+            except Exception as e:
+                self.errors += 1
+                traceback.print_exc()
+
+            with self._cond:
+                # a short breather between batches, the full interval when there's nothing to do
+                self._cond.wait(1 if more else self.interval)
+                if (self.isStopped):
+                    break
+
+        logger.info(f'''retention manager was stopped''')
+
+    def getMetrics(self):
+        free = self.free
+        snapshot = None if self.host == None else self.host.getSnapshot()
+        if (snapshot != None):
+            free = snapshot["disk"]["free"]
+        return {"budget_bytes": self.budgetBytes,
+                "used_bytes": self.index.totalBytes,
+                "free_bytes": free,
+                "min_free_bytes": self.minFreeBytes,
+                "min_free_reachable": self.freeReachable,
+                "evicted": self.evicted,
+                "evicted_bytes": self.evictedBytes,
+                "passes": self.passes,
+                "errors": self.errors}
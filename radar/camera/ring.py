@@ -0,0 +1,87 @@
+import time
+import threading
+import numpy as np
+import cv2
+
+class ImageRing:
+    """
+    the last `size` camera frames in one preallocated block. new frames are
+    copied into the oldest slot so memory never moves once it's allocated
+    """
+    def __init__(self, size, shape, dtype=np.uint8):
+        self.size = size
+        self.frames = np.zeros((size,) + tuple(shape), dtype=dtype)
+        self.millis = np.zeros(size, dtype=np.float64)
+        self._head = 0 # next slot to write
+        self._count = 0
+        self.lock = threading.Lock()
+
+        self.written = 0
+        self.skipped = 0 # frames we didn't copy because a save held the ring
+
+        # where a chosen frame is copied to so the ring can keep going while it's saved
+        self._out = np.zeros(tuple(shape), dtype=dtype)
+
+    def put(self, image, millis=None):
+        """
+        called from the camera callback. never waits on a save
+        """
+        if (not self.lock.acquire(blocking=False)):
+            self.skipped += 1
+            return
+
+        try:
+            h, w = self.frames.shape[1:3]
+            np.copyto(self.frames[self._head], image[:h, :w])
+            self.millis[self._head] = time.time() * 1000 if millis == None else millis
+            self._head = (self._head + 1) % self.size
+            self._count = min(self._count + 1, self.size)
+            self.written += 1
+        finally:
+            self.lock.release()
+
+    def _slots(self, sinceMillis):
+        # oldest to newest
+        slots = [(self._head - self._count + i) % self.size for i in range(self._count)]
+        chosen = [i for i in slots if self.millis[i] >= sinceMillis]
+        if (len(chosen) == 0 and len(slots) > 0):
+            # trigger came in before anything newer showed up. best we have
+            chosen = [slots[-1]]
+        return chosen
+
+    def pickSharpest(self, sinceMillis):
+        """
+        copy the sharpest frame since sinceMillis out of the ring.
+        returns (image, millis, focus) or (None, None, None) if empty
+        """
+        with self.lock:
+            best = None
+            bestFocus = -1.0
+            for i in self._slots(sinceMillis):
+                f = focusMeasure(self.frames[i])
+                if (f > bestFocus):
+                    best = i
+                    bestFocus = f
+
+            if (best == None):
+                return None, None, None
+
+            np.copyto(self._out, self.frames[best])
+            return self._out, float(self.millis[best]), bestFocus
+
+    def getFrames(self, sinceMillis):
+        """
+        copies of every frame since sinceMillis oldest first as (image, millis)
+        """
+        with self.lock:
+            return [(self.frames[i].copy(), float(self.millis[i])) for i in self._slots(sinceMillis)]
+
+def focusMeasure(image):
+    """
+    variance of the laplacian over a quarter resolution grey image. blur
+    from a moving car kills the high frequencies so bigger is sharper
+    """
+    small = image[::4, ::4]
+    if (small.ndim == 3):
+        small = cv2.cvtColor(small, cv2.COLOR_BGR2GRAY)
+    return float(cv2.Laplacian(small, cv2.CV_32F).var())
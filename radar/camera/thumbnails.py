@@ -0,0 +1,154 @@
+import os
+import logging
+import threading
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+from camera.index import shardPath
+
+logger = logging.getLogger(__name__)
+
+def buildThumbnails(source, outputs):
+    """
+    runs in a pool process. outputs is [(path, width)], largest first.
+    jpeg can decode at 1/2 scale almost for free so that's tried first
+    """
+    import cv2
+
+    widest = outputs[0][1]
+    image = cv2.imread(source, cv2.IMREAD_REDUCED_COLOR_2)
+    if (image is None or image.shape[1] < widest):
+        image = cv2.imread(source)
+    if (image is None):
+        raise ValueError(f'''can't read [{source}]''')
+
+    for path, width in outputs:
+        if (image.shape[1] > width):
+            height = int(image.shape[0] * width / image.shape[1])
+            image = cv2.resize(image, (width, height), interpolation=cv2.INTER_AREA)
+        # written next to the final name and renamed so a reader never sees half a file
+        temp = f'''{path}.tmp.jpg'''
+        cv2.imwrite(temp, image, [cv2.IMWRITE_JPEG_QUALITY, 80])
+        os.replace(temp, path)
+    return len(outputs)
+
+class ThumbnailCache:
+    """
+    smaller copies of images/ in cache/<size>/<same name>. they are built
+    in a process pool so decoding 8 megapixel jpegs never competes with
+    the radar thread for the gil. new captures are queued as they're
+    saved, anything older is queued the first time someone asks for it.
+    at most queueSize builds wait, past that requests are dropped and
+    asked for again next time. when the camera already wrote a lores copy
+    to previews/ that is the medium size and the thumb is made from it,
+    the full jpeg is only decoded for images without one
+    """
+    SIZES = {"medium": 1280, "thumb": 320}
+
+    def __init__(self, source="images", cache="cache", previews="previews", processes=1, queueSize=32):
+        self.source = source
+        self.cache = cache
+        self.previews = previews
+        self.queueSize = queueSize
+        for size in self.SIZES:
+            os.makedirs(os.path.join(cache, size), exist_ok=True)
+
+        self.processes = processes
+        self._pool = self._newPool()
+        self._pending = set()
+        self._failed = set() # not asked for again until restart
+        self._lock = threading.Lock()
+
+        self.built = 0
+        self.dropped = 0
+        self.errors = 0
+
+    def _newPool(self):
+        # spawn, the parent has threads and a camera open
+        return ProcessPoolExecutor(max_workers=self.processes, mp_context=multiprocessing.get_context("spawn"))
+
+    def getPath(self, size, name):
+        return os.path.join(self.cache, size, name)
+
+    def getUrl(self, size, name):
+        """
+        url of the cached copy, None if it isn't built yet (and now it's queued)
+        """
+        if (size == "medium" and os.path.isfile(os.path.join(self.previews, name))):
+            return f'''/{self.previews}/{name}'''
+        if (os.path.isfile(self.getPath(size, name))):
+            return f'''/{self.cache}/{size}/{name}'''
+        self.request(name)
+        return None
+
+    def request(self, name):
+        """
+        never blocks. False if the queue was full
+        """
+        with self._lock:
+            if (name in self._pending or name in self._failed):
+                return True
+            if (len(self._pending) >= self.queueSize):
+                self.dropped += 1
+                return False
+            self._pending.add(name)
+
+        source = os.path.join(self.previews, name)
+        if (os.path.isfile(source)):
+            outputs = [(self.getPath("thumb", name), self.SIZES["thumb"])]
+        else:
+            source = shardPath(self.source, name)
+            outputs = [(self.getPath(size, name), width) for size, width in sorted(self.SIZES.items(), key=lambda s: -s[1])]
+        try:
+            try:
+                future = self._pool.submit(buildThumbnails, source, outputs)
+            except BrokenProcessPool:
+                # a worker died. that's the pool's problem, not this image's
+                logger.info(f'''thumbnail pool broke, starting a new one''')
+                self._pool = self._newPool()
+                future = self._pool.submit(buildThumbnails, source, outputs)
+        except RuntimeError:
+            # pool is shut down
+            with self._lock:
+                self._pending.discard(name)
+            return False
+        future.add_done_callback(lambda f: self._done(name, f))
+        return True
+
+    def _done(self, name, future):
+        if (future.cancelled()):
+            with self._lock:
+                self._pending.discard(name)
+            return
+
+        e = future.exception()
+        with self._lock:
+            self._pending.discard(name)
+            if (isinstance(e, BrokenProcessPool)):
+                self.errors += 1
+            elif (e != None):
+                self.errors += 1
+                self._failed.add(name)
+            else:
+                self.built += 1
+        if (e != None):
+            logger.info(f'''thumbnail for [{name}] failed [{e}]''')
+
+    def remove(self, name):
+        for size in self.SIZES:
+            try:
+                os.remove(self.getPath(size, name))
+            except FileNotFoundError:
+                pass
+
+    def stop(self):
+        self._pool.shutdown(wait=False, cancel_futures=True)
+
+    def getMetrics(self):
+        with self._lock:
+            return {"pending": len(self._pending),
+                    "queue_size": self.queueSize,
+                    "built": self.built,
+                    "dropped": self.dropped,
+                    "errors": self.errors}
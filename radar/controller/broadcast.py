@@ -0,0 +1,94 @@
+import threading
+import logging
+from collections import deque
+
+logger = logging.getLogger(__name__)
+
+class Subscription:
+    """
+    one listener's bounded queue of (name, data) events
+    """
+    def __init__(self, size):
+        self.size = size
+        self._queue = deque()
+        self._cond = threading.Condition()
+        self.evicted = False
+
+    def offer(self, item):
+        """
+        never blocks. False if the queue was already full
+        """
+        with self._cond:
+            if (len(self._queue) >= self.size):
+                return False
+            self._queue.append(item)
+            self._cond.notify()
+        return True
+
+    def evict(self):
+        with self._cond:
+            self.evicted = True
+            self._queue.clear()
+            self._cond.notify()
+
+    def get(self, timeout):
+        """
+        everything queued, [] if nothing showed up in timeout seconds
+        """
+        with self._cond:
+            if (len(self._queue) == 0 and not self.evicted):
+                self._cond.wait(timeout)
+            items = list(self._queue)
+            self._queue.clear()
+            return items
+
+class Broadcaster:
+    """
+    fans events out to subscribers without ever waiting on one. a
+    subscriber whose queue is full is too slow to keep up and gets evicted
+    rather than holding the publisher back or silently missing events
+    """
+    def __init__(self, queueSize=64, maxSubscribers=4):
+        self.queueSize = queueSize
+        self.maxSubscribers = maxSubscribers
+        self._subscribers = []
+        self._lock = threading.Lock()
+
+        self.published = 0
+        self.evicted = 0
+
+    def subscribe(self):
+        """
+        a new Subscription or None if there are too many already
+        """
+        with self._lock:
+            if (len(self._subscribers) >= self.maxSubscribers):
+                return None
+            subscription = Subscription(self.queueSize)
+            self._subscribers.append(subscription)
+            return subscription
+
+    def unsubscribe(self, subscription):
+        with self._lock:
+            if (subscription in self._subscribers):
+                self._subscribers.remove(subscription)
+
+    def publish(self, name, data):
+        with self._lock:
+            if (len(self._subscribers) == 0):
+                return
+            self.published += 1
+            slow = [s for s in self._subscribers if not s.offer((name, data))]
+            for s in slow:
+                self._subscribers.remove(s)
+                self.evicted += 1
+        for s in slow:
+            s.evict()
+            logger.info(f'''evicted a slow event subscriber''')
+
+    def getMetrics(self):
+        with self._lock:
+            return {"subscribers": len(self._subscribers),
+                    "max_subscribers": self.maxSubscribers,
+                    "published": self.published,
+                    "evicted": self.evicted}
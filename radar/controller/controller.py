@@ -1,12 +1,23 @@
-import sys
-import math
 import os
 import time
 from datetime import datetime
 import threading
 import traceback
 import logging
+from collections import deque
 from kld7.radar import KLD7
+from kld7.protocol import RPST_PARAMETERS
+from controller.tracker import Tracker
+from camera.capture import CaptureWorker
+from camera.index import ImageIndex
+from camera.thumbnails import ThumbnailCache
+from camera.retention import RetentionManager
+from host.sampler import HostSampler
+from controller.store import ReadingStore
+from controller.quantiles import RollingQuantiles
+from controller.broadcast import Broadcaster
+from controller.profiles import ProfileStore
+from metrics.prometheus import REGISTRY
 
 isRaspberryPi = False
 if (os.path.isfile("/boot/firmware/config.txt")):
@@ -16,6 +27,10 @@ if (os.path.isfile("/boot/firmware/config.txt")):
 
 logger = logging.getLogger(__name__)
 
+LOOP_PERIOD = REGISTRY.histogram("radar_loop_period_seconds", "time between frames reaching the controller loop")
+LOOP_BUSY = REGISTRY.histogram("radar_loop_busy_seconds", "controller loop time spent on one frame, locks included")
+FRAME_AGE = REGISTRY.histogram("radar_frame_age_seconds", "frame completed on the wire to picked up by the controller loop")
+
 class Controller:
     def __init__ (self):
         self.isStopped = False
@@ -23,12 +38,34 @@ class Controller:
         self.speed_threshold = 15.0
 
         self.camera = None
+        self.capture:CaptureWorker = None # camera work happens on this, never on the radar loop
+        self.store:ReadingStore = None # readings and vehicles on disk, written from its own thread
+        self.images = ImageIndex("images") # what's in images/ without listing it every time
+        self.thumbnails:ThumbnailCache = None
+        self.retention:RetentionManager = None # keeps images/ inside its disk budget
+        self.host:HostSampler = None # memory, disk, load, wifi read in the background for the pages
+        self.profiles:ProfileStore = None # named radar configurations
+        self.activeProfile = None # what was last applied, None once a parameter is changed by hand
 
         self._TDATReadings = []
         self._maxTDATReadings = 10
         self._lastTDATReadingIndex = -1
         
         self._lastTrackedReadingTime = time.time() * 1000
+        self._lastFrame = None # most recent Frame from the radar, target or not
+
+        self.tracker = Tracker()
+        self._vehicleEvents = deque(maxlen=10) # newest last
+
+        # live readings/vehicles for whoever is listening, see /api/events
+        self.broadcaster = Broadcaster()
+
+        # streaming p50/p85/p95 over minute/hour/day windows. vehicle_speed
+        # is one peak speed per vehicle, the rest are per reading
+        self.percentiles = {"vehicle_speed": RollingQuantiles(255),
+                            "speed": RollingQuantiles(255),
+                            "distance": RollingQuantiles(16383),
+                            "magnitude": RollingQuantiles(255)}
 
         self.stats = {}
         self.read_count = "read_count"
@@ -74,13 +111,35 @@ class Controller:
 
         self.threadLock = threading.RLock()
 
+        # bumped whenever what they name changes so the web side can tell
+        # a poller nothing happened without building anything.
+        # startMillis keeps versions from one run apart from the next
+        self.startMillis = int(time.time() * 1000)
+        self.versions = {"readings": 0, "stats": 0, "params": 0}
+
         return
 
-    def dropInBucket(self, buckets, counts, v):
+    def bumpVersion(self, *names):
+        with self.threadLock:
+            for name in names:
+                self.versions[name] += 1
+
+    def getVersion(self, name):
+        return f'''{self.startMillis:x}-{self.versions[name]}'''
+
+    def getStatsVersion(self):
+        """
+        the stats version and the current minute. the rolling percentile
+        windows move on with time even when nothing is read, the minute is
+        their smallest slot
+        """
+        return f'''{self.getVersion("stats")}-{int(time.time() // 60):x}'''
+
+    def dropInBucket(self, buckets, counts, v, n=1):
         # going backwards through bucket list
         for b in buckets[::-1]:
             if v >= b:
-                counts[str(b)] += 1
+                counts[str(b)] += n
                 break
     
     def __del__ (self):
@@ -91,10 +150,165 @@ class Controller:
 
     def stop(self):
         self.isStopped = True
+        if (self.capture != None):
+            self.capture.stop()
+        if (self.thumbnails != None):
+            self.thumbnails.stop()
+        if (self.retention != None):
+            self.retention.stop()
+        if (self.host != None):
+            self.host.stop()
+
+    def getFrameCounters(self):
+        counters = self.radar.frames.getCounters()
+        counters["errors"] = self.radar.streamErrors
+        if (self.radar.protocol != None):
+            counters.update(self.radar.protocol.getCounters())
+        return counters
     
-    def init(self, radar:KLD7, camera = None):
+    def init(self, radar:KLD7, camera = None, capturePolicy=CaptureWorker.COALESCE, captureQueueSize=4, store:ReadingStore = None,
+             imageBudgetBytes=4 << 30, minFreeBytes=1 << 30, profiles:ProfileStore = None):
         self.radar = radar
         self.camera = camera
+        self.images.rebuild()
+        self.thumbnails = ThumbnailCache("images", "cache", "previews")
+        self.host = HostSampler()
+        self.retention = RetentionManager(self.images, self.thumbnails, "previews", imageBudgetBytes, minFreeBytes, host=self.host)
+        self.profiles = profiles
+        REGISTRY.addCollector(self.collectMetrics)
+        if (camera != None):
+            self.capture = CaptureWorker(camera, captureQueueSize, capturePolicy, self.onImageSaved)
+        self.store = store
+        if (store != None):
+            self.restore()
+
+    def onImageSaved(self, filename):
+        """
+        camera thread, right after a still is written
+        """
+        self.images.add(filename)
+        self.thumbnails.request(os.path.basename(filename))
+
+    def restore(self):
+        """
+        rebuild stats and the recent readings/vehicles from the store
+        """
+        start = time.monotonic()
+        saved = self.store.load(self._maxTDATReadings, self._vehicleEvents.maxlen)
+
+        with self.threadLock:
+            for reading in saved["readings"]:
+                self.addTDATReading(reading)
+            for event in saved["vehicles"]:
+                self._vehicleEvents.append(event)
+
+            totals = saved["totals"]
+            if (totals["count"] > 0):
+                self.stats[self.read_count] = totals["count"]
+                for key in (self.min_speed, self.max_speed, self.min_angle, self.max_angle,
+                            self.min_distance, self.max_distance, self.min_magnitude, self.max_magnitude):
+                    self.stats[key] = totals[key]
+
+            for hour, (count, fast) in saved["hours"].items():
+                self.stats[self.hourly_counts][hour] = count
+                self.stats[self.hourly_count_gt_30][hour] = fast
+
+            for speed, count in saved["speeds"].items():
+                self.dropInBucket(self.speed_buckets, self.stats[self.speed_counts], speed, count)
+
+        # the windows only need the last day of readings, vehicles go back as far as the day tier does
+        now = time.time() * 1000
+        for millis, speed, distance, magnitude in self.store.loadSince("readings", ("millis", "speed", "distance", "magnitude"), now - RollingQuantiles.DAY):
+            self.addPercentiles(millis, speed, distance, magnitude)
+        for millis, speed in self.store.loadSince("vehicles", ("millis", "peak_speed_mph"), now - 31 * RollingQuantiles.DAY):
+            self.percentiles["vehicle_speed"].add(speed, millis)
+
+        logger.info(f'''restored readings[{totals['count']}] vehicles[{sum(saved['speeds'].values())}] from [{self.store.path}] in [{int((time.monotonic() - start) * 1000)}ms]''')
+
+    def addPercentiles(self, millis, speed, distance, magnitude):
+        self.percentiles["speed"].add(speed, millis)
+        self.percentiles["distance"].add(distance, millis)
+        self.percentiles["magnitude"].add(magnitude, millis)
+
+    def getPercentiles(self):
+        """
+        name -> window -> {count, p50, p85, p95}
+        """
+        now = time.time() * 1000
+        return {name: q.getWindows(now) for name, q in self.percentiles.items()}
+
+    def getPercentileSlots(self, name, tier):
+        """
+        per hour or per day summaries oldest first as (start millis, summary)
+        """
+        return self.percentiles[name].getSlots(tier, time.time() * 1000)
+
+    def getStoreMetrics(self):
+        if (self.store == None):
+            return None
+        return self.store.getMetrics()
+
+    def collectMetrics(self):
+        """
+        counters for /metrics, read when it's scraped
+        """
+        samples = []
+        def counter(name, help, value, labels=None):
+            samples.append((name, "counter", help, labels, value))
+        def gauge(name, help, value, labels=None):
+            samples.append((name, "gauge", help, labels, value))
+
+        if (self.radar != None and self.radar.frames != None):
+            frames = self.radar.frames.getCounters()
+            counter("radar_frames_total", "frames streamed from the sensor", frames['pushed'])
+            counter("radar_frame_overruns_total", "frames dropped because the controller loop fell behind", frames['overruns'])
+            gauge("radar_frames_queued", "frames waiting for the controller loop", frames['queued'])
+            counter("radar_stream_errors_total", "failed frame requests while streaming", self.radar.streamErrors)
+            if (self.radar.protocol != None):
+                for name, value in self.radar.protocol.getCounters().items():
+                    counter(f'''kld7_{name}_total''', f'''serial decoder {name.replace('_', ' ')}''', value)
+
+        counter("radar_readings_total", "tracked readings", self.stats[self.read_count])
+        counter("radar_vehicles_total", "vehicles counted", sum(self.stats[self.hourly_counts]))
+
+        for prefix, metrics, names in (("camera_capture", self.getCaptureMetrics(), ("submitted", "captured", "dropped", "coalesced", "errors")),
+                                       ("store", self.getStoreMetrics(), ("written", "dropped", "commits")),
+                                       ("thumbnails", None if self.thumbnails == None else self.thumbnails.getMetrics(), ("built", "dropped", "errors")),
+                                       ("retention", self.getRetentionMetrics(), ("evicted", "evicted_bytes")),
+                                       ("events", self.broadcaster.getMetrics(), ("published", "evicted"))):
+            if (metrics == None):
+                continue
+            for name in names:
+                counter(f'''{prefix}_{name}_total''', f'''{prefix.replace('_', ' ')} {name.replace('_', ' ')}''', metrics.get(name))
+        return samples
+
+    def getHostSnapshot(self):
+        """
+        latest host sample, None until the sampler has one
+        """
+        if (self.host == None):
+            return None
+        return self.host.getSnapshot()
+
+    def getRetentionMetrics(self):
+        if (self.retention == None):
+            return None
+        return self.retention.getMetrics()
+
+    def getCaptureMetrics(self):
+        if (self.capture == None):
+            return None
+        return self.capture.getMetrics()
+
+    def getCameraMetrics(self):
+        if (self.camera == None):
+            return None
+        return self.camera.getMetrics()
+
+    def getClipMetrics(self):
+        if (self.camera == None):
+            return None
+        return self.camera.getClipMetrics()
     
     def getInitTime(self):
         return self.radar._init_time
@@ -116,6 +330,8 @@ class Controller:
         return readings
 
     def addTDATReading(self, reading):
+        self.broadcaster.publish("reading", reading)
+
         with self.threadLock:
             # need to fill it first because python is stupid
             if (len(self._TDATReadings) < self._maxTDATReadings):
@@ -132,14 +348,112 @@ class Controller:
 
         return
 
+    def startRawCapture(self):
+        os.makedirs("recordings", exist_ok=True)
+        now = datetime.now()
+        path = f'''recordings/{now.year}{now.month:0>2}{now.day:0>2}{now.hour:0>2}{now.minute:0>2}{now.second:0>2}'''
+        return self.radar.startRawCapture(path)
+
+    def stopRawCapture(self):
+        self.radar.stopRawCapture()
+
+    def getRawCaptureInfo(self):
+        return self.radar.getRawCaptureInfo()
+
+    def getLastVehicleEvents(self):
+        """
+        most recent vehicles newest first
+        """
+        with self.threadLock:
+            return list(reversed(self._vehicleEvents))
+
+    def mph(self, kph):
+        return int(abs(kph * 0.6212712))
+
+    def addVehicleEvent(self, event):
+        """
+        one call per vehicle from the tracker. this is what the counts are built from
+        """
+        speed = self.mph(event["peak_speed"])
+        event["peak_speed_mph"] = speed
+        event["median_speed_mph"] = self.mph(event["median_speed"])
+
+        hour = datetime.fromtimestamp(event["millis"] / 1000).hour
+        self.percentiles["vehicle_speed"].add(speed, event["millis"])
+        if (self.store != None):
+            self.store.addVehicle(event)
+
+        with self.threadLock:
+            self._vehicleEvents.append(event)
+
+            self.stats[self.hourly_counts][hour] += 1
+            if (speed > 30):
+                self.stats[self.hourly_count_gt_30][hour] += 1
+
+            self.dropInBucket(self.speed_buckets, self.stats[self.speed_counts], speed)
+        self.bumpVersion("readings", "stats")
+        self.broadcaster.publish("vehicle", event)
+
+        logger.info(f'''vehicle[{event['id']}] peak[{speed}] median[{event['median_speed_mph']}] closest[{event['closest_distance']}] dwell[{event['dwell']}]''')
+
+    def getLastFrame(self):
+        return self._lastFrame
+
     def getRadarParameters(self):
         return self.radar.getRadarParameters()
 
     def setParameter(self, name, value):
-        return self.radar.setParameter(name, value)
+        r = self.radar.setParameter(name, value)
+        self.activeProfile = None
+        self.bumpVersion("params")
+        return r
+
+    def applyProfile(self, name):
+        """
+        switch the radar to a saved profile. returns (response, what changed)
+        """
+        if (self.profiles == None):
+            return 1, {}
+        values = self.profiles.get(name)
+        if (values == None):
+            logger.info(f'''no profile [{name}]''')
+            return 1, {}
+
+        r, changed = self.radar.applyParameters(values)
+        if (r == 0):
+            self.activeProfile = name
+        self.bumpVersion("params")
+        logger.info(f'''profile [{name}] applied[{r}] changed {list(changed)}''')
+        return r, changed
+
+    def saveProfile(self, name):
+        """
+        keep the radar's current settings as profile name
+        """
+        if (self.profiles == None):
+            return False
+        params = self.radar.getRadarParameters()
+        self.profiles.save(name, {n: params[n]['value'] for n in RPST_PARAMETERS if params[n].get('value') != None})
+        self.activeProfile = name
+        self.bumpVersion("params")
+        return True
+
+    def deleteProfile(self, name):
+        if (self.profiles == None or not self.profiles.delete(name)):
+            return False
+        if (self.activeProfile == name):
+            self.activeProfile = None
+        self.bumpVersion("params")
+        return True
+
+    def getProfileNames(self):
+        if (self.profiles == None):
+            return []
+        return self.profiles.names()
 
     def setSpeedThreshold(self, threshold):
         self.speed_threshold = int(threshold)
+        self.bumpVersion("params")
     
     def getStats(self):
         return self.stats
@@ -163,7 +477,8 @@ class Controller:
         return
 
     def takeStill(self):
-        self.camera.takeStill("0", "0", 0, 0)
+        if (self.capture != None):
+            self.capture.submit(None, "0", "0", 0, 0)
     
     def run(self):
 
@@ -173,22 +488,57 @@ class Controller:
         
         try:
             counter = 0 # just to reduce logging noise
-            countIt = True # reducing multi counting of the same target
-            
+
+            # acquisition runs on its own thread at the sensor's frame rate.
+            # we just drain what it hands us
+            self.radar.startStreaming(KLD7.GNFD.TDAT | KLD7.GNFD.PDAT | KLD7.GNFD.DDAT)
+
+            lastReceived = None
             while not self.isStopped:
-                now = datetime.now()
-                distance, speed, angle, magnitude = self.radar.getTDAT()
+                frame = self.radar.getFrame(timeout=1.0)
+                if (frame == None):
+                    if (not self.radar.isStreaming()):
+                        logger.error("radar stopped streaming")
+                        break
+                    continue
+
+                received = time.monotonic()
+                if (lastReceived != None):
+                    LOOP_PERIOD.observe(received - lastReceived)
+                lastReceived = received
+                FRAME_AGE.observe(time.time() - frame.millis / 1000)
+
+                self._lastFrame = frame
+
+                # vehicles are counted when their track ends, not per reading
+                for event in self.tracker.update(frame):
+                    self.addVehicleEvent(event)
+
+                # one photo per vehicle, the first time its track goes over
+                if (self.capture != None):
+                    for track in self.tracker.getConfirmedTracks():
+                        if (not track.triggered and self.mph(track.speed) > self.speed_threshold):
+                            track.triggered = True
+                            self.capture.submit(track.id, self.mph(track.speed), int(track.distance), track.peakMagnitude, track.angle, frame.millis)
+                            self.camera.triggerClip(track.id, self.mph(track.speed))
+
+                distance, speed, angle, magnitude = frame.getTDAT()
                 if (speed != None):
                     counter = 0
-                    speed = int(abs(speed * 0.6212712)) # kph->mph
+                    speed = self.mph(speed) # kph->mph
 
-                    self._lastTrackedReadingTime = time.time() * 1000
+                    self._lastTrackedReadingTime = frame.millis
 
-                    self.addTDATReading({"millis": self._lastTrackedReadingTime,
+                    reading = {"millis": self._lastTrackedReadingTime,
                                     "distance": distance,
                                     "speed": speed,
                                     "angle": angle,
-                                    "magnitude": magnitude})
+                                    "magnitude": magnitude,
+                                    "targets": frame.getTargetCount()}
+                    self.addTDATReading(reading)
+                    self.addPercentiles(frame.millis, speed, distance, magnitude)
+                    if (self.store != None):
+                        self.store.addReading(reading)
 
                     logger.info(f's[{speed}] d[{distance}] a[{angle}] m[{magnitude}]')
 
@@ -201,31 +551,26 @@ class Controller:
                     self.stats[self.max_distance] = max(distance, self.stats[self.max_distance])
                     self.stats[self.max_angle] = max(angle, self.stats[self.max_angle])
                     self.stats[self.max_magnitude] = max(magnitude, self.stats[self.max_magnitude])
-
-                    if (countIt):
-                        self.stats[self.hourly_counts][now.hour] += 1
-                        if (speed > 30):
-                            self.stats[self.hourly_count_gt_30][now.hour] += 1
-                            
-                        self.dropInBucket(self.speed_buckets, self.stats[self.speed_counts], speed)
-                        
-                    if (self.camera != None and speed > self.speed_threshold):
-                         self.camera.takeStill(speed, distance, magnitude, angle)
-
-                    countIt = False # don't count consecutive reads as different targets
+                    self.bumpVersion("readings", "stats")
 
                 else:
                     if (counter > 1000): # nearly completely arbitrary. it's about 40 seconds
-                        logger.info('*')
+                        logger.info(f'''* frames{self.getFrameCounters()}''')
                         counter = 0
 
                     counter += 1
-                    countIt = True # means on the next target will be 'new'
-                    
-                time.sleep(0.033) # mostly arbitrary
-                
+
+                LOOP_BUSY.observe(time.monotonic() - received)
+
+            for event in self.tracker.flush():
+                self.addVehicleEvent(event)
+
             logger.info(f'''controller was stopped''')
+            self.radar.stopStreaming()
         except Exception as e:
             traceback.print_exc()
             self.radar.disconnect()
             return
+        finally:
+            if (self.store != None):
+                self.store.close()
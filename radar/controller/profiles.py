@@ -0,0 +1,65 @@
+import os
+import json
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+class ProfileStore:
+    """
+    named sets of radar parameters (day, night, rain, ...) kept in one
+    json file as name -> {parameter: value}. every change rewrites the
+    file through a temp file so a power cut leaves the old or the new one
+    """
+    def __init__(self, path="profiles.json"):
+        self.path = path
+        self._profiles = {}
+        self._lock = threading.Lock()
+        self.load()
+
+    def load(self):
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                profiles = json.load(f)
+        except FileNotFoundError:
+            profiles = {}
+        except ValueError as e:
+            # keep running with none rather than not at all
+            logger.error(f'''can't read profiles from [{self.path}] [{e}]''')
+            profiles = {}
+
+        with self._lock:
+            self._profiles = {name: {k: int(v) for k, v in values.items()} for name, values in profiles.items()}
+        logger.info(f'''loaded profiles {list(self._profiles)} from [{self.path}]''')
+
+    def _write(self):
+        temp = f'''{self.path}.tmp'''
+        with open(temp, "w", encoding="utf-8") as f:
+            json.dump(self._profiles, f, indent=2, sort_keys=True)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temp, self.path)
+
+    def names(self):
+        with self._lock:
+            return sorted(self._profiles)
+
+    def get(self, name):
+        """
+        a copy of the profile's parameters, None if there's no such profile
+        """
+        with self._lock:
+            values = self._profiles.get(name)
+            return None if values == None else dict(values)
+
+    def save(self, name, values):
+        with self._lock:
+            self._profiles[name] = {k: int(v) for k, v in values.items()}
+            self._write()
+
+    def delete(self, name):
+        with self._lock:
+            if (self._profiles.pop(name, None) == None):
+                return False
+            self._write()
+            return True
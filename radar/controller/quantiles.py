@@ -0,0 +1,154 @@
+import math
+import time
+import threading
+import numpy as np
+
+class Histogram:
+    """
+    hdr style log-linear histogram of non-negative ints. values under
+    precision get their own bucket, above that every power of two is split
+    into precision/2 buckets so the error is at most 2/precision of the
+    value. fixed size, and merging two is adding their counts
+    """
+    def __init__(self, maximum, precision=64):
+        if (precision & (precision - 1) != 0 or precision < 2):
+            raise ValueError(f'''precision must be a power of 2 [{precision}]''')
+        self.maximum = int(maximum)
+        self.precision = precision
+        self._half = precision // 2
+        self._shift = precision.bit_length() - 1
+        self.counts = np.zeros(self.bucketIndex(self.maximum) + 1, dtype=np.uint32)
+        self.total = 0
+
+    def bucketIndex(self, value):
+        v = min(max(int(value), 0), self.maximum)
+        if (v < self.precision):
+            return v
+        e = v.bit_length() - self._shift
+        return e * self._half + (v >> e)
+
+    def bucketValue(self, index):
+        """
+        middle of the range of values that land in bucket index
+        """
+        if (index < self.precision):
+            return index
+        e = index // self._half - 1
+        low = (index - e * self._half) << e
+        return low + ((1 << e) - 1) / 2
+
+    def add(self, value):
+        self.counts[self.bucketIndex(value)] += 1
+        self.total += 1
+
+    def clear(self):
+        self.counts[:] = 0
+        self.total = 0
+
+    def merge(self, other):
+        self.counts += other.counts
+        self.total += other.total
+
+    def quantiles(self, qs):
+        """
+        values at each quantile in qs (0..1). None for each if empty
+        """
+        if (self.total == 0):
+            return [None for q in qs]
+        cumulative = np.cumsum(self.counts)
+        out = []
+        for q in qs:
+            rank = max(1, math.ceil(q * self.total))
+            out.append(self.bucketValue(int(np.searchsorted(cumulative, rank))))
+        return out
+
+class RollingQuantiles:
+    """
+    one histogram per minute for the last hour, per hour for the last day
+    and per day for the last `days`. a value goes into its minute, hour and
+    day slot once, anything longer than a slot is a merge of slots so no
+    reading is ever looked at twice. memory never grows
+    """
+    MINUTE = 60000
+    HOUR = 3600000
+    DAY = 86400000
+
+    QUANTILES = (0.5, 0.85, 0.95)
+
+    def __init__(self, maximum, precision=64, days=31):
+        self.maximum = maximum
+        self.precision = precision
+        self._tiers = {"minute": (self.MINUTE, 60),
+                       "hour": (self.HOUR, 24),
+                       "day": (self.DAY, days)}
+        # tier -> ([Histogram], [slot key])
+        self._slots = {}
+        for tier, (width, count) in self._tiers.items():
+            self._slots[tier] = ([Histogram(maximum, precision) for i in range(count)], [None] * count)
+        self.lock = threading.Lock()
+
+    def _localKey(self, millis, width):
+        # hours and days follow the local clock so "8am" and "tuesday" mean what people think
+        if (width >= self.HOUR):
+            millis += localOffset(millis)
+        return int(millis // width)
+
+    def add(self, value, millis):
+        with self.lock:
+            for tier, (width, count) in self._tiers.items():
+                key = self._localKey(millis, width)
+                histograms, keys = self._slots[tier]
+                i = key % count
+                if (keys[i] != None and keys[i] > key):
+                    # older than anything this slot still remembers
+                    continue
+                if (keys[i] != key):
+                    histograms[i].clear()
+                    keys[i] = key
+                histograms[i].add(value)
+
+    def _merged(self, tier, first, last):
+        width, count = self._tiers[tier]
+        out = Histogram(self.maximum, self.precision)
+        histograms, keys = self._slots[tier]
+        for i in range(count):
+            if (keys[i] != None and first <= keys[i] <= last):
+                out.merge(histograms[i])
+        return out
+
+    def _summary(self, histogram):
+        values = histogram.quantiles(self.QUANTILES)
+        return {"count": histogram.total, "p50": values[0], "p85": values[1], "p95": values[2]}
+
+    def getWindows(self, millis):
+        """
+        p50/p85/p95 over the last minute, hour and day
+        """
+        with self.lock:
+            minute = self._localKey(millis, self.MINUTE)
+            hour = self._localKey(millis, self.HOUR)
+            return {"minute": self._summary(self._merged("minute", minute, minute)),
+                    "hour": self._summary(self._merged("minute", minute - 59, minute)),
+                    "day": self._summary(self._merged("hour", hour - 23, hour))}
+
+    def getSlots(self, tier, millis):
+        """
+        summary for each slot of a tier oldest first as (slot start millis, summary)
+        """
+        width, count = self._tiers[tier]
+        with self.lock:
+            last = self._localKey(millis, width)
+            out = []
+            for key in range(last - count + 1, last + 1):
+                start = key * width
+                if (width >= self.HOUR):
+                    start -= localOffset(start)
+                out.append((start, self._summary(self._merged(tier, key, key))))
+            return out
+
+def localOffset(millis):
+    """
+    local time minus utc in ms at millis
+    """
+    t = time.localtime(millis / 1000)
+    return t.tm_gmtoff * 1000
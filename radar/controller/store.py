@@ -0,0 +1,213 @@
+import time
+import sqlite3
+import logging
+import threading
+import traceback
+from collections import deque
+
+logger = logging.getLogger(__name__)
+
+SCHEMA = ["""CREATE TABLE IF NOT EXISTS readings (
+                millis REAL NOT NULL,
+                distance INTEGER,
+                speed INTEGER,
+                angle REAL,
+                magnitude INTEGER,
+                targets INTEGER)""",
+          """CREATE TABLE IF NOT EXISTS vehicles (
+                millis REAL NOT NULL,
+                id INTEGER,
+                dwell INTEGER,
+                hits INTEGER,
+                peak_speed_mph INTEGER,
+                median_speed_mph INTEGER,
+                closest_distance INTEGER,
+                closest_angle REAL,
+                peak_magnitude INTEGER,
+                direction TEXT)""",
+          "CREATE INDEX IF NOT EXISTS readings_millis ON readings (millis)",
+          "CREATE INDEX IF NOT EXISTS vehicles_millis ON vehicles (millis)"]
+
+READING_FIELDS = ("millis", "distance", "speed", "angle", "magnitude", "targets")
+VEHICLE_FIELDS = ("millis", "id", "dwell", "hits", "peak_speed_mph", "median_speed_mph",
+                  "closest_distance", "closest_angle", "peak_magnitude", "direction")
+
+class ReadingStore:
+    """
+    readings and vehicle events in sqlite (WAL) so they outlive a reboot.
+    add*() only appends to a queue, a writer thread inserts whatever has
+    piled up in one transaction every flushInterval seconds or batchSize
+    rows, whichever comes first. the radar loop never waits on the sd card
+    """
+    def __init__(self, path="readings.db", batchSize=200, flushInterval=2.0, maxQueued=100000):
+        self.path = path
+        self.batchSize = batchSize
+        self.flushInterval = flushInterval
+        self.maxQueued = maxQueued
+
+        self._queue = deque()
+        self._cond = threading.Condition()
+        self.isStopped = False
+
+        self.written = 0
+        self.commits = 0
+        self.dropped = 0 # rows thrown away because the writer fell too far behind
+        self.errors = 0
+        self._commitTotal = 0.0
+        self._commitMax = 0.0
+
+        db = self._connect()
+        with db:
+            for statement in SCHEMA:
+                db.execute(statement)
+        db.close()
+
+        self._thread = threading.Thread(target=self.run, name="Reading Store", daemon=True)
+        self._thread.start()
+
+    def _connect(self):
+        db = sqlite3.connect(self.path)
+        db.execute("PRAGMA journal_mode=WAL")
+        # WAL + NORMAL only syncs at checkpoints. a power cut loses the last
+        # few commits at worst, never the database
+        db.execute("PRAGMA synchronous=NORMAL")
+        return db
+
+    def _add(self, table, row):
+        with self._cond:
+            if (self.isStopped):
+                return
+            if (len(self._queue) >= self.maxQueued):
+                self._queue.popleft()
+                self.dropped += 1
+            self._queue.append((table, row))
+            # wake the writer when there is something to do, it waits out the batch on its own
+            if (len(self._queue) == 1 or len(self._queue) >= self.batchSize):
+                self._cond.notify()
+
+    def addReading(self, reading):
+        self._add("readings", tuple([reading.get(f) for f in READING_FIELDS]))
+
+    def addVehicle(self, event):
+        self._add("vehicles", tuple([event.get(f) for f in VEHICLE_FIELDS]))
+
+    def close(self):
+        """
+        write what's queued and stop the writer
+        """
+        with self._cond:
+            self.isStopped = True
+            self._cond.notify()
+        self._thread.join()
+
+    def run(self):
+        db = self._connect()
+        readingsInsert = f'''INSERT INTO readings ({",".join(READING_FIELDS)}) VALUES ({",".join("?" * len(READING_FIELDS))})'''
+        vehiclesInsert = f'''INSERT INTO vehicles ({",".join(VEHICLE_FIELDS)}) VALUES ({",".join("?" * len(VEHICLE_FIELDS))})'''
+
+        while True:
+            with self._cond:
+                while len(self._queue) == 0 and not self.isStopped:
+                    self._cond.wait()
+
+                # give the batch a chance to fill up
+                deadline = time.monotonic() + self.flushInterval
+                while len(self._queue) < self.batchSize and not self.isStopped:
+                    remaining = deadline - time.monotonic()
+                    if (remaining <= 0):
+                        break
+                    self._cond.wait(remaining)
+
+                batch = list(self._queue)
+                self._queue.clear()
+                if (len(batch) == 0 and self.isStopped):
+                    break
+
+            readings = [row for table, row in batch if table == "readings"]
+            vehicles = [row for table, row in batch if table == "vehicles"]
+
+            start = time.monotonic()
+            try:
+                with db:
+                    if (len(readings) > 0):
+                        db.executemany(readingsInsert, readings)
+                    if (len(vehicles) > 0):
+                        db.executemany(vehiclesInsert, vehicles)
+            except Exception as e:
+                self.errors += 1
+                traceback.print_exc()
+                continue
+            elapsed = time.monotonic() - start
+
+            with self._cond:
+                self.written += len(batch)
+                self.commits += 1
+                self._commitTotal += elapsed
+                self._commitMax = max(self._commitMax, elapsed)
+
+        db.close()
+        logger.info(f'''reading store was stopped. rows[{self.written}] commits[{self.commits}]''')
+
+    def getMetrics(self):
+        with self._cond:
+            n = max(self.commits, 1)
+            return {"path": self.path,
+                    "queued": len(self._queue),
+                    "written": self.written,
+                    "commits": self.commits,
+                    "dropped": self.dropped,
+                    "errors": self.errors,
+                    "commit_avg_ms": int(self._commitTotal / n * 1000),
+                    "commit_max_ms": int(self._commitMax * 1000)}
+
+    def loadSince(self, table, fields, sinceMillis):
+        """
+        rows of table newer than sinceMillis oldest first, streamed
+        """
+        db = self._connect()
+        try:
+            for row in db.execute(f'''SELECT {",".join(fields)} FROM {table} WHERE millis >= ? ORDER BY rowid''', (sinceMillis,)):
+                yield row
+        finally:
+            db.close()
+
+    def load(self, recentReadings=10, recentVehicles=10):
+        """
+        what the controller needs to pick up where it left off. all of it is
+        aggregated in sqlite so startup doesn't walk every row in python
+            readings  - newest last
+            vehicles  - newest last
+            totals    - count/min/max over every reading
+            hours     - hour of day -> (vehicles, vehicles over 30mph)
+            speeds    - peak mph -> vehicles
+        """
+        db = self._connect()
+        try:
+            rows = db.execute(f'''SELECT {",".join(READING_FIELDS)} FROM readings ORDER BY rowid DESC LIMIT ?''', (recentReadings,)).fetchall()
+            readings = [dict(zip(READING_FIELDS, row)) for row in reversed(rows)]
+
+            rows = db.execute(f'''SELECT {",".join(VEHICLE_FIELDS)} FROM vehicles ORDER BY rowid DESC LIMIT ?''', (recentVehicles,)).fetchall()
+            vehicles = [dict(zip(VEHICLE_FIELDS, row)) for row in reversed(rows)]
+
+            row = db.execute('''SELECT COUNT(*),
+                                       MIN(speed), MAX(speed), MIN(angle), MAX(angle),
+                                       MIN(distance), MAX(distance), MIN(magnitude), MAX(magnitude)
+                                FROM readings''').fetchone()
+            totals = dict(zip(("count", "min_speed", "max_speed", "min_angle", "max_angle",
+                               "min_distance", "max_distance", "min_magnitude", "max_magnitude"), row))
+
+            hours = {}
+            for hour, count, fast in db.execute('''SELECT CAST(strftime('%H', millis / 1000, 'unixepoch', 'localtime') AS INTEGER),
+                                                          COUNT(*), SUM(peak_speed_mph > 30)
+                                                   FROM vehicles GROUP BY 1'''):
+                hours[hour] = (count, fast)
+
+            speeds = dict(db.execute('''SELECT peak_speed_mph, COUNT(*) FROM vehicles GROUP BY 1''').fetchall())
+        finally:
+            db.close()
+
+        return {"readings": readings,
+                "vehicles": vehicles,
+                "totals": totals,
+                "hours": hours,
+                "speeds": speeds}
@@ -0,0 +1,198 @@
+import logging
+from statistics import median
+
+logger = logging.getLogger(__name__)
+
+# km/h -> cm/s. radar distance is cm and speed km/h, receding is positive
+KPH_TO_CMS = 100000 / 3600
+
+class Track:
+    """
+    one vehicle. distance/speed are alpha-beta filtered, the raw
+    measurements are kept for the summary when the track ends
+    """
+    def __init__(self, trackId, millis, distance, speed, angle, magnitude):
+        self.id = trackId
+        self.firstMillis = millis
+        self.lastMillis = millis # where the filter state is, coasting included
+        self.lastSeenMillis = millis
+
+        # filter state
+        self.distance = float(distance)
+        self.speed = float(speed)
+        self.angle = float(angle)
+
+        self.hits = 1
+        self.misses = 0
+        self.confirmed = False
+        self.triggered = False # camera already fired for this one
+
+        self.speeds = [abs(speed)]
+        self.closestDistance = distance
+        self.closestAngle = angle
+        self.peakMagnitude = magnitude
+
+    def predict(self, millis):
+        dt = (millis - self.lastMillis) / 1000
+        return self.distance + self.speed * KPH_TO_CMS * dt
+
+    def getPeakSpeed(self):
+        return max(self.speeds)
+
+    def toEvent(self):
+        return {"id": self.id,
+                "millis": self.firstMillis,
+                "dwell": int(self.lastSeenMillis - self.firstMillis),
+                "hits": self.hits,
+                "peak_speed": self.getPeakSpeed(),
+                "median_speed": median(self.speeds),
+                "closest_distance": self.closestDistance,
+                "closest_angle": self.closestAngle,
+                "peak_magnitude": self.peakMagnitude,
+                "direction": "receding" if self.speed > 0 else "approaching"}
+
+class Tracker:
+    """
+    turns per frame targets into vehicles. targets are matched to tracks
+    nearest first inside distance/speed/angle gates, a track needs
+    confirmHits updates before it counts and ends after maxMisses frames
+    without one. update() returns an event dict per vehicle that ended.
+    the distance gate widens with speed while a track goes unseen and a car
+    passing the sensor is followed out of the speed and angle gates so the
+    closest readings stay on its track
+    """
+    def __init__(self, alpha=0.5, beta=0.3, distanceGate=200, speedGate=10, angleGate=0.35,
+                 confirmHits=3, maxMisses=8):
+        self.alpha = alpha
+        self.beta = beta
+        self.distanceGate = distanceGate # cm on top of where the track should be
+        self.speedGate = speedGate # km/h
+        self.angleGate = angleGate # rad
+        self.confirmHits = confirmHits
+        self.maxMisses = maxMisses
+
+        self.tracks = []
+        self._nextId = 1
+
+    def _targets(self, frame):
+        # PDAT is everything the sensor saw, TDAT is its own single track
+        if (frame.pdat is not None and len(frame.pdat) > 0):
+            return [(int(t["distance"]), float(t["speed"]), float(t["angle"]), int(t["magnitude"])) for t in frame.pdat]
+
+        distance, speed, angle, magnitude = frame.getTDAT()
+        if (speed == None):
+            return []
+        return [(distance, speed, angle, magnitude)]
+
+    def _distanceGate(self, track, millis):
+        # the range rate swings from -speed towards +speed as a car passes
+        # the sensor, so the further it can have drifted from the prediction
+        # since it was last seen the wider the gate
+        dt = (millis - track.lastSeenMillis) / 1000
+        return self.distanceGate + abs(track.speed) * KPH_TO_CMS * dt
+
+    def _isPassing(self, track, speed, angle):
+        # closest to the sensor the radial speed falls away to nothing and the
+        # angle swings out to the side within a few frames. that's still the
+        # same car even though it's outside the speed and angle gates
+        slower = abs(speed) <= abs(track.speed) + self.speedGate and (speed * track.speed > 0 or abs(speed) <= self.speedGate)
+        wider = angle * track.angle > 0 and abs(angle) >= abs(track.angle) - self.angleGate
+        return slower and wider
+
+    def _cost(self, track, predicted, target, distanceGate):
+        distance, speed, angle, magnitude = target
+        dd = abs(distance - predicted)
+        ds = abs(speed - track.speed)
+        da = abs(angle - track.angle)
+        if (dd > distanceGate):
+            return None
+        if ((ds > self.speedGate or da > self.angleGate) and not self._isPassing(track, speed, angle)):
+            return None
+        # normalized so no single gate dominates
+        return dd / distanceGate + min(ds, self.speedGate) / self.speedGate + min(da, self.angleGate) / self.angleGate
+
+    def _update(self, track, predicted, millis, target):
+        distance, speed, angle, magnitude = target
+        dt = max((millis - track.lastMillis) / 1000, 0.001)
+
+        # alpha-beta on range. the doppler speed is a direct measurement so
+        # it's blended in rather than only derived from range
+        residual = distance - predicted
+        track.distance = predicted + self.alpha * residual
+        derived = track.speed + self.beta * residual / dt / KPH_TO_CMS
+        track.speed = (derived + speed) / 2
+        track.angle += self.alpha * (angle - track.angle)
+        track.lastMillis = millis
+        track.lastSeenMillis = millis
+
+        track.hits += 1
+        track.misses = 0
+        if (track.hits >= self.confirmHits):
+            track.confirmed = True
+
+        track.speeds.append(abs(speed))
+        if (distance < track.closestDistance):
+            track.closestDistance = distance
+            track.closestAngle = angle
+        track.peakMagnitude = max(track.peakMagnitude, magnitude)
+
+    def update(self, frame):
+        millis = frame.millis
+        targets = self._targets(frame)
+
+        predictions = [t.predict(millis) for t in self.tracks]
+        gates = [self._distanceGate(t, millis) for t in self.tracks]
+
+        # every gated pair, cheapest first
+        pairs = []
+        for i, track in enumerate(self.tracks):
+            for j, target in enumerate(targets):
+                cost = self._cost(track, predictions[i], target, gates[i])
+                if (cost != None):
+                    pairs.append((cost, i, j))
+        pairs.sort()
+
+        usedTracks = set()
+        usedTargets = set()
+        for cost, i, j in pairs:
+            if (i in usedTracks or j in usedTargets):
+                continue
+            usedTracks.add(i)
+            usedTargets.add(j)
+            self._update(self.tracks[i], predictions[i], millis, targets[j])
+
+        events = []
+        alive = []
+        for i, track in enumerate(self.tracks):
+            if (i not in usedTracks):
+                track.misses += 1
+                # coast so a dropped frame doesn't lose it
+                track.distance = predictions[i]
+                track.lastMillis = millis
+                # tentative tracks get no slack
+                if (track.misses > self.maxMisses or (not track.confirmed and track.misses > 1)):
+                    if (track.confirmed):
+                        events.append(track.toEvent())
+                    continue
+            alive.append(track)
+
+        for j, target in enumerate(targets):
+            if (j in usedTargets):
+                continue
+            distance, speed, angle, magnitude = target
+            alive.append(Track(self._nextId, millis, distance, speed, angle, magnitude))
+            self._nextId += 1
+
+        self.tracks = alive
+        return events
+
+    def getConfirmedTracks(self):
+        return [t for t in self.tracks if t.confirmed]
+
+    def flush(self):
+        """
+        end everything. used on shutdown so a vehicle in view still gets counted
+        """
+        events = [t.toEvent() for t in self.tracks if t.confirmed]
+        self.tracks = []
+        return events
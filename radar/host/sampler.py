@@ -0,0 +1,164 @@
+import os
+import re
+import time
+import shutil
+import logging
+import threading
+import subprocess
+import traceback
+from collections import deque
+
+logger = logging.getLogger(__name__)
+
+# the first three lines of /proc/meminfo, what the host page has always shown
+MEMORY_FIELDS = ("MemTotal", "MemFree", "MemAvailable")
+THERMAL_ZONE = "/sys/class/thermal/thermal_zone0/temp"
+AP_CONNECTION = "radar-ap"
+
+class HostSampler:
+    """
+    memory, disk, load, temperature and the wifi connection read on a
+    schedule by one thread so a page load only copies the last snapshot.
+    the wifi connection is looked up once at start and again only when a
+    long running `nmcli monitor` reports a change, not on every sample.
+    the last history samples are kept oldest first for trends
+    """
+    def __init__(self, interval=5, history=120, disk="."):
+        self.interval = interval
+        self.disk = disk
+
+        self.isStopped = False
+        self._cond = threading.Condition()
+        self._snapshot = None
+        self._history = deque(maxlen=history)
+        self.version = 0
+
+        self._monitor:subprocess.Popen = None
+        self._wifiChanged = True # look it up on the first sample
+        self.connection = None
+        self.monitorRestarts = 0
+        self.errors = 0
+
+        self._thread = threading.Thread(target=self.run, name="Host Sampler", daemon=True)
+        self._thread.start()
+        self._monitorThread = threading.Thread(target=self.watchNetwork, name="nmcli Monitor", daemon=True)
+        self._monitorThread.start()
+
+    def sample(self):
+        now = time.time()
+        snapshot = {"millis": int(now * 1000)}
+
+        with open("/proc/uptime", "r") as f:
+            snapshot["uptime"] = int(float(f.read().split(' ')[0]))
+
+        memory = {}
+        with open("/proc/meminfo", "r", encoding="utf-8") as f:
+            for line in f:
+                name, colon, rest = line.partition(':')
+                if (name in MEMORY_FIELDS):
+                    memory[name] = int(rest.split()[0]) # kB
+                    if (len(memory) == len(MEMORY_FIELDS)):
+                        break
+        snapshot["memory_kb"] = memory
+
+        (total, used, free) = shutil.disk_usage(self.disk)
+        snapshot["disk"] = {"total": total, "used": used, "free": free}
+
+        snapshot["load"] = os.getloadavg()
+
+        try:
+            with open(THERMAL_ZONE, "r") as f:
+                snapshot["temperature"] = int(f.read()) / 1000
+        except (OSError, ValueError):
+            snapshot["temperature"] = None
+
+        if (self._wifiChanged):
+            self._wifiChanged = False
+            self.connection = self.getConnection()
+        snapshot["connection"] = self.connection
+        snapshot["on_ap"] = self.connection == AP_CONNECTION
+
+        with self._cond:
+            self._snapshot = snapshot
+            self._history.append(snapshot)
+            self.version += 1
+
+    def getConnection(self):
+        """
+        wlan0's connection name, None without nmcli or a connection
+        """
+        try:
+            output = subprocess.run(["nmcli", "-f", "general.connection", "device", "show", "wlan0"], capture_output=True, timeout=5)
+        except (OSError, subprocess.TimeoutExpired):
+            return None
+        m = re.match(r'GENERAL.CONNECTION: +(\S+)', output.stdout.decode('utf-8'))
+        if (m == None or m[1] == "--"):
+            return None
+        return m[1]
+
+    def watchNetwork(self):
+        """
+        any line out of nmcli monitor means something about the network
+        changed. the next sample looks the connection up again
+        """
+        backoff = 1
+        while not self.isStopped:
+            try:
+                self._monitor = subprocess.Popen(["nmcli", "monitor"], stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+            except OSError as e:
+                logger.info(f'''no nmcli monitor [{e}], wifi state is only read at start''')
+                return
+
+            started = time.monotonic()
+            for line in self._monitor.stdout:
+                # a burst of lines is still one lookup, on the next sample
+                self._wifiChanged = True
+            self._monitor.wait()
+            if (self.isStopped):
+                break
+
+            # it died on its own. don't spin if it keeps doing that
+            self.monitorRestarts += 1
+            backoff = 1 if time.monotonic() - started > 60 else min(backoff * 2, 60)
+            logger.info(f'''nmcli monitor exited [{self._monitor.returncode}], restarting in [{backoff}s]''')
+            time.sleep(backoff)
+
+    def stop(self):
+        with self._cond:
+            self.isStopped = True
+            self._cond.notify()
+        if (self._monitor != None and self._monitor.poll() == None):
+            self._monitor.terminate()
+
+    def run(self):
+        while True:
+            try:
+                self.sample()
+            except Exception as e:
+                self.errors += 1
+                traceback.print_exc()
+
+            with self._cond:
+                self._cond.wait(self.interval)
+                if (self.isStopped):
+                    break
+
+        logger.info(f'''host sampler was stopped''')
+
+    def getSnapshot(self):
+        """
+        the latest sample, None before the first one
+        """
+        with self._cond:
+            return self._snapshot
+
+    def getHistory(self):
+        with self._cond:
+            return list(self._history)
+
+    def getMetrics(self):
+        return {"samples": self.version,
+                "interval": self.interval,
+                "monitor_running": self._monitor != None and self._monitor.poll() == None,
+                "monitor_restarts": self.monitorRestarts,
+                "errors": self.errors}
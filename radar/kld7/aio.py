@@ -0,0 +1,389 @@
+import os
+import time
+import asyncio
+import logging
+from collections import deque
+
+import serial
+
+from kld7.frame import Frame, decodeTargets, decodeDetection, decodeRaw
+from kld7.protocol import PacketDecoder, DONE, COMMAND, COMMAND_UNSIGNED, EMPTY_COMMAND
+from metrics.prometheus import REGISTRY
+
+logger = logging.getLogger(__name__)
+
+# same codes as KLD7.RESPONSE
+OK = 0
+UART_ERROR = 4
+TIMEOUT = 6
+
+# written to completed, per command. everything that isn't a frame or a parameter read/write is "other"
+ROUND_TRIP_HELP = "serial time from writing a command to its last block"
+ROUND_TRIP = {cmd: REGISTRY.histogram("kld7_round_trip_seconds", ROUND_TRIP_HELP, {"cmd": cmd.decode()}) for cmd in (b'GNFD', b'GRPS', b'SRPS')}
+ROUND_TRIP_OTHER = REGISTRY.histogram("kld7_round_trip_seconds", ROUND_TRIP_HELP, {"cmd": "other"})
+
+class _Exchange:
+    """
+    one command on the wire. done when its RESP and every block that
+    follows it have been read
+    """
+    __slots__ = ("cmd", "data", "blocks", "future", "response", "result", "deadline", "written")
+
+    def __init__(self, cmd, data, blocks, future, result=None):
+        self.cmd = cmd
+        self.data = data # bytes written
+        self.blocks = blocks # blocks still expected after an OK RESP
+        self.future = future
+        self.response = None
+        self.result = result # RPST bytes for GRPS, the Frame being filled for GNFD
+        self.deadline = 0
+        self.written = 0
+
+class AsyncKLD7:
+    """
+    K-LD7 driver that lives on an asyncio loop. the serial fd is read by
+    the loop's reader callback, commands go through one FIFO and up to
+    `depth` of them are on the wire at once so a parameter change just
+    queues up behind the GNFDs already in flight instead of taking a lock
+    """
+    def __init__(self, depth=3, timeout=0.5):
+        self.serialPort = None
+        self.decoder = PacketDecoder()
+        self.depth = depth
+        self.timeout = timeout
+
+        self._loop = None
+        self._fd = None
+        self._queued = deque() # not written yet
+        self._inflight = deque() # written, waiting on the sensor
+        self._writeBuffer = bytearray()
+        self._watchdog = None
+        self.isLost = False # the port hung up or failed, nothing more will be read
+
+        # streaming
+        self.streamPayload = 8 # TDAT
+        self.streamDepth = 2
+        self.streamErrors = 0
+        self.onFrame = None # called on the loop with each streamed Frame
+        self._streamTask = None
+
+    async def open(self, device):
+        """
+        open the port, INIT the sensor and switch to 2Mbaud
+        """
+        self._loop = asyncio.get_running_loop()
+        self.isLost = False
+        self.decoder.reset()
+
+        # pyserial still does the termios setup, we just take the fd from it
+        self.serialPort = serial.Serial(device)
+        self.serialPort.baudrate = 115200
+        self.serialPort.parity = serial.PARITY_EVEN
+        self.serialPort.stopbits = serial.STOPBITS_ONE
+        self.serialPort.bytesize = serial.EIGHTBITS
+
+        # a failed open leaves nothing behind for the next attempt to trip over
+        try:
+            self._fd = self.serialPort.fileno()
+            os.set_blocking(self._fd, False)
+            self._loop.add_reader(self._fd, self._onReadable)
+            self._watchdog = self._loop.create_task(self._watch())
+
+            r = await self.command(b'INIT', 3) # 3 sets baud rate to 2000000
+            if (r == OK):
+                # change to higher baudrate based on the '3' value in the INIT payload
+                self.serialPort.baudrate = 2E6
+        except BaseException:
+            self._release()
+            raise
+
+        if (r != OK):
+            self._release()
+        return r
+
+    async def close(self):
+        await self.stopStreaming()
+        r = await self.command(b'GBYE')
+        self._release()
+        return r
+
+    def _release(self):
+        """
+        let go of the port. whatever is still waiting gets UART_ERROR
+        """
+        if (self._watchdog != None):
+            self._watchdog.cancel()
+            self._watchdog = None
+        if (self._fd != None):
+            self._loop.remove_reader(self._fd)
+            self._loop.remove_writer(self._fd)
+            self._fd = None
+        self._writeBuffer.clear()
+        self._failAll(UART_ERROR)
+        self.serialPort.close()
+
+    def _failAll(self, response):
+        while len(self._inflight) > 0 or len(self._queued) > 0:
+            exchange = self._inflight.popleft() if len(self._inflight) > 0 else self._queued.popleft()
+            exchange.response = response
+            if (not exchange.future.done()):
+                exchange.future.set_result(exchange)
+
+    def _submit(self, cmd, data, blocks, result=None):
+        future = self._loop.create_future()
+        exchange = _Exchange(cmd, data, blocks, future, result)
+        if (self._fd == None):
+            # closed or lost, there's nothing to write to
+            exchange.response = UART_ERROR
+            future.set_result(exchange)
+            return future
+        self._queued.append(exchange)
+        self._pump()
+        return future
+
+    async def command(self, cmd, value=None):
+        """
+        send a command with an optional 4 byte value and return the RESP code
+        """
+        if (cmd == b'GNFD'):
+            frame = await self.gnfd(value)
+            return OK if frame != None else UART_ERROR
+
+        if (value == None):
+            data = EMPTY_COMMAND.pack(cmd, 0)
+        elif (value < 0):
+            data = COMMAND.pack(cmd, 4, value)
+        else:
+            data = COMMAND_UNSIGNED.pack(cmd, 4, value)
+
+        exchange = await self._submit(cmd, data, 0)
+        return exchange.response
+
+    async def grps(self):
+        """
+        returns (response, RPST payload bytes)
+        """
+        exchange = await self._submit(b'GRPS', EMPTY_COMMAND.pack(b'GRPS', 0), 1)
+        return exchange.response, exchange.result
+
+    async def srps(self, rpst):
+        exchange = await self._submit(b'SRPS', EMPTY_COMMAND.pack(b'SRPS', len(rpst)) + rpst, 0)
+        return exchange.response
+
+    async def gnfd(self, payload):
+        """
+        one GNFD for any combination of GNFD bits. Frame or None
+        """
+        frame = Frame(0)
+        if (payload & 4): # PDAT. no targets is an empty array, not None
+            frame.pdat = decodeTargets(b'')
+
+        exchange = await self._submit(b'GNFD', COMMAND_UNSIGNED.pack(b'GNFD', 4, payload),
+                                      bin(payload).count('1'), frame)
+        if (exchange.response != OK):
+            return None
+        return frame
+
+    ############################################################
+    # wire side. everything below runs on the loop only
+
+    def _pump(self):
+        while len(self._queued) > 0 and len(self._inflight) < self.depth:
+            exchange = self._queued.popleft()
+            exchange.written = time.monotonic()
+            exchange.deadline = exchange.written + self.timeout
+            self._inflight.append(exchange)
+            self._write(exchange.data)
+
+    def _write(self, data):
+        if (len(self._writeBuffer) == 0):
+            try:
+                n = os.write(self._fd, data)
+            except BlockingIOError:
+                n = 0
+            except OSError as e:
+                self._lose(f'''write failed [{e}]''')
+                return
+            if (n == len(data)):
+                return
+            data = data[n:]
+            self._loop.add_writer(self._fd, self._onWritable)
+        self._writeBuffer += data
+
+    def _onWritable(self):
+        try:
+            n = os.write(self._fd, self._writeBuffer)
+        except BlockingIOError:
+            return
+        except OSError as e:
+            self._lose(f'''write failed [{e}]''')
+            return
+        del self._writeBuffer[:n]
+        if (len(self._writeBuffer) == 0):
+            self._loop.remove_writer(self._fd)
+
+    def _complete(self, exchange):
+        self._inflight.popleft()
+        ROUND_TRIP.get(exchange.cmd, ROUND_TRIP_OTHER).observe(time.monotonic() - exchange.written)
+        if (exchange.cmd == b'GNFD'):
+            exchange.result.millis = time.time() * 1000
+        if (not exchange.future.done()):
+            exchange.future.set_result(exchange)
+        self._pump()
+
+    def _onReadable(self):
+        try:
+            n = self.decoder.readFrom(self._fd)
+        except OSError as e:
+            # EIO once a usb adapter is pulled. it would stay readable and fail again forever
+            self._lose(f'''read failed [{e}]''')
+            return
+        if (n == None):
+            return
+        if (n == 0):
+            # hung up. the fd stays readable at EOF so the reader has to go
+            self._lose("end of file")
+            return
+
+        while True:
+            header, payload = self.decoder.nextPacket()
+            if (header == None):
+                return
+
+            if (len(self._inflight) == 0):
+                # nobody asked for this
+                self.decoder.resyncs += 1
+                continue
+
+            exchange = self._inflight[0]
+            if (header == b'RESP' and exchange.response != None):
+                # the blocks we were waiting on never showed up. this RESP
+                # belongs to the next exchange
+                self.decoder.resyncs += 1
+                exchange.response = UART_ERROR
+                self._complete(exchange)
+                if (len(self._inflight) == 0):
+                    continue
+                exchange = self._inflight[0]
+
+            if (exchange.response == None):
+                if (header != b'RESP'):
+                    # tail of an exchange we already gave up on
+                    self.decoder.resyncs += 1
+                    continue
+                exchange.response = payload[0]
+                if (exchange.response != OK or exchange.blocks == 0):
+                    self._complete(exchange)
+                continue
+
+            self._decodeBlock(exchange, header, payload)
+            exchange.blocks -= 1
+            if (exchange.blocks == 0):
+                self._complete(exchange)
+
+    def _lose(self, reason):
+        logger.error(f'''KLD7 port lost [{reason}]. failing [{len(self._inflight) + len(self._queued)}] waiting''')
+        self.isLost = True
+        self._loop.remove_reader(self._fd)
+        self._loop.remove_writer(self._fd)
+        self._fd = None
+        self._writeBuffer.clear()
+        self._failAll(UART_ERROR)
+
+    def _decodeBlock(self, exchange, header, payload):
+        # payload points into the decoder's buffer. copy out of it before the next read
+        if (header == b'RPST'):
+            exchange.result = bytes(payload)
+            return
+
+        frame = exchange.result
+        if (header == b'TDAT'):
+            if (len(payload) > 0):
+                frame.tdat = decodeTargets(payload)[0]
+        elif (header == b'PDAT'):
+            frame.pdat = decodeTargets(payload)
+        elif (header == b'DDAT'):
+            frame.ddat = decodeDetection(payload)
+        elif (header == b'RADC'):
+            frame.radc = decodeRaw(bytes(payload))
+        elif (header == b'RFFT'):
+            frame.rfft = decodeRaw(bytes(payload))
+        elif (header == b'DONE'):
+            frame.frameNumber = DONE.unpack(payload)[0]
+
+    async def _watch(self):
+        while True:
+            await asyncio.sleep(self.timeout / 4)
+            if (len(self._inflight) == 0 or time.monotonic() < self._inflight[0].deadline):
+                continue
+
+            # the sensor went quiet. everything on the wire is suspect so
+            # fail it all and start clean
+            self.decoder.timeouts += 1
+            logger.error(f'''KLD7 [{self._inflight[0].cmd}] timed out. failing [{len(self._inflight)}] in flight {self.decoder.getCounters()}''')
+            while len(self._inflight) > 0:
+                exchange = self._inflight.popleft()
+                exchange.response = TIMEOUT
+                if (not exchange.future.done()):
+                    exchange.future.set_result(exchange)
+
+            self.decoder.reset()
+            try:
+                self.serialPort.reset_input_buffer()
+            except Exception:
+                pass
+            self._pump()
+
+    ############################################################
+    # streaming
+
+    def isStreaming(self):
+        return self._streamTask != None and not self._streamTask.done()
+
+    async def startStreaming(self, payload, depth=2):
+        if (self.isStreaming()):
+            return
+        self.streamPayload = payload
+        self.streamDepth = max(1, depth)
+        self._streamTask = self._loop.create_task(self._stream())
+
+    async def stopStreaming(self):
+        if (not self.isStreaming()):
+            return
+        self._streamTask.cancel()
+        try:
+            await self._streamTask
+        except asyncio.CancelledError:
+            pass
+        self._streamTask = None
+
+    async def _stream(self):
+        logger.info(f'''KLD7 streaming started payload[{self.streamPayload}] depth[{self.streamDepth}]''')
+        pending = deque()
+        try:
+            while True:
+                # keep the sensor's next request queued before it finishes this frame.
+                # streamPayload is read per request so it can change on the fly
+                while len(pending) < self.streamDepth:
+                    pending.append(self._loop.create_task(self.gnfd(self.streamPayload)))
+
+                frame = await pending.popleft()
+                if (frame == None):
+                    self.streamErrors += 1
+                    if (self.isLost):
+                        # every request fails at once from here on, don't spin on them
+                        break
+                    continue
+
+                if (self.onFrame != None):
+                    self.onFrame(frame)
+        except asyncio.CancelledError:
+            # requests already on the wire still get their answers read
+            if (len(pending) > 0):
+                await asyncio.gather(*pending, return_exceptions=True)
+            raise
+        except Exception as e:
+            self.streamErrors += 1
+            logger.error(f'''KLD7 streaming failed [{e}]''')
+        finally:
+            logger.info(f'''KLD7 streaming stopped''')
@@ -0,0 +1,105 @@
+import math
+import numpy as np
+
+# PDAT and TDAT targets share the same 8 byte layout on the wire
+# distance cm, speed 0.01km/h, angle 0.01deg, magnitude dB
+RAW_TARGET_DTYPE = np.dtype([("distance", "<u2"),
+                             ("speed", "<i2"),
+                             ("angle", "<i2"),
+                             ("magnitude", "<u2")])
+
+# what we hand out. same units as getTDAT(): km/h and radians
+TARGET_DTYPE = np.dtype([("distance", "<u2"),
+                         ("speed", "<f4"),
+                         ("angle", "<f4"),
+                         ("magnitude", "<u2")])
+
+# RADC/RFFT are uint16 samples in blocks of 256 per channel
+SAMPLE_DTYPE = np.dtype("<u2")
+SAMPLES_PER_CHANNEL = 256
+
+# DDAT is 6 single byte flags in this order
+DDAT_FIELDS = ("detection", "micro_detection", "angle", "direction", "range", "speed")
+
+_ANGLE_SCALE = math.pi / 18000 # 0.01 deg -> rad
+
+def decodeTargets(buf):
+    """
+    decode a PDAT/TDAT payload into a TARGET_DTYPE array in one shot.
+    no per target unpacking
+    """
+    raw = np.frombuffer(buf, dtype=RAW_TARGET_DTYPE)
+
+    targets = np.empty(raw.shape[0], dtype=TARGET_DTYPE)
+    targets["distance"] = raw["distance"]
+    targets["speed"] = raw["speed"] * 0.01
+    targets["angle"] = raw["angle"] * _ANGLE_SCALE
+    targets["magnitude"] = raw["magnitude"]
+    return targets
+
+def decodeRaw(buf):
+    """
+    view a RADC/RFFT payload as (channels, 256) uint16 without copying
+    """
+    samples = np.frombuffer(buf, dtype=SAMPLE_DTYPE)
+    if (samples.shape[0] % SAMPLES_PER_CHANNEL == 0):
+        return samples.reshape(-1, SAMPLES_PER_CHANNEL)
+    return samples
+
+def decodeDetection(buf):
+    if (len(buf) < len(DDAT_FIELDS)):
+        return None
+    return dict(zip(DDAT_FIELDS, bytes(buf[:len(DDAT_FIELDS)])))
+
+class Frame:
+    """
+    everything the sensor returned for one GNFD request.
+    tdat is a single TARGET_DTYPE record or None, pdat a (possibly empty)
+    TARGET_DTYPE array or None if PDAT wasn't requested, ddat a dict of
+    the DDAT flags or None. radc/rfft are (channels, 256) uint16 views
+    over the received bytes when raw capture is on
+    """
+    __slots__ = ("millis", "tdat", "pdat", "ddat", "frameNumber", "radc", "rfft")
+
+    def __init__(self, millis, tdat=None, pdat=None, ddat=None, frameNumber=None):
+        self.millis = millis
+        self.tdat = tdat
+        self.pdat = pdat
+        self.ddat = ddat
+        self.frameNumber = frameNumber
+        self.radc = None
+        self.rfft = None
+
+    def hasTarget(self):
+        return self.tdat is not None
+
+    def getTDAT(self):
+        """
+        same shape as KLD7.getTDAT() so old callers don't have to care
+        """
+        if (self.tdat is None):
+            return None, None, None, None
+        return int(self.tdat["distance"]), float(self.tdat["speed"]), float(self.tdat["angle"]), int(self.tdat["magnitude"])
+
+    def getTargetCount(self):
+        if (self.pdat is None):
+            return 0
+        return len(self.pdat)
+
+    def toDict(self):
+        distance, speed, angle, magnitude = self.getTDAT()
+        d = {"millis": self.millis,
+             "frame": self.frameNumber,
+             "tdat": None,
+             "pdat": None,
+             "ddat": self.ddat}
+
+        if (speed != None):
+            d["tdat"] = {"distance": distance, "speed": speed, "angle": angle, "magnitude": magnitude}
+
+        if (self.pdat is not None):
+            d["pdat"] = [{"distance": int(t["distance"]),
+                          "speed": round(float(t["speed"]), 2),
+                          "angle": round(float(t["angle"]), 4),
+                          "magnitude": int(t["magnitude"])} for t in self.pdat]
+        return d
@@ -0,0 +1,142 @@
+import os
+import re
+import struct
+import logging
+
+logger = logging.getLogger(__name__)
+
+HEADER = struct.Struct('<4sI')
+COMMAND = struct.Struct('<4sIi')
+COMMAND_UNSIGNED = struct.Struct('<4sII')
+EMPTY_COMMAND = struct.Struct('<4sI')
+
+# GRPS/SRPS parameter structure and the DONE frame counter
+RPST = struct.Struct('<19s8B2b4Bb4BH2B')
+# RPST after the software version, in order. these are what SRPS sets
+RPST_PARAMETERS = ("base_frequency", "maximum_speed", "maximum_range", "threshold_offset",
+                   "tracking_filter_type", "vibration_suppression",
+                   "minimum_detection_distance", "maximum_detection_distance",
+                   "minimum_detection_angle", "maximum_detection_angle",
+                   "minimum_detection_speed", "maximum_detection_speed",
+                   "detection_direction", "range_threshold", "angle_threshold", "speed_threshold",
+                   "digital_output_1", "digital_output_2", "digital_output_3",
+                   "hold_time", "micro_detection_retrigger", "micro_detection_sensitivity")
+DONE = struct.Struct('<I')
+
+# every block the sensor sends and the longest payload it can have.
+# anything else in a header slot means we lost sync
+MAX_PAYLOAD = {b'RESP': 1,
+               b'RPST': 42,
+               b'RADC': 3072,
+               b'RFFT': 1536,
+               b'PDAT': 8 * 128,
+               b'TDAT': 8,
+               b'DDAT': 6,
+               b'DONE': 4}
+
+DATA_HEADERS = (b'RADC', b'RFFT', b'PDAT', b'TDAT', b'DDAT', b'DONE')
+
+_HEADER_PATTERN = re.compile(b'|'.join([re.escape(h) for h in MAX_PAYLOAD]))
+
+class PacketDecoder:
+    """
+    splits the byte stream from the sensor into header/length/payload
+    packets through one preallocated buffer. bytes are read straight into
+    the buffer and payloads come back as memoryviews into it so they are
+    only good until the next readFrom(). when a header doesn't make sense
+    the buffer is scanned forward for the next known header instead of
+    trusting the byte count
+    """
+    def __init__(self, size=16384):
+        self._buf = bytearray(size)
+        self._view = memoryview(self._buf)
+        self._start = 0
+        self._end = 0
+
+        self.packets = 0
+        self.shortReads = 0 # reads that stopped in the middle of a packet
+        self.timeouts = 0
+        self.resyncs = 0
+        self.discarded = 0 # bytes thrown away while resyncing
+
+    def reset(self):
+        """
+        forget anything buffered
+        """
+        self.discarded += self._end - self._start
+        self._start = 0
+        self._end = 0
+
+    def readFrom(self, fd):
+        """
+        read whatever the fd has into the free end of the buffer.
+        returns the byte count, 0 at end of file and None if there was
+        nothing to read
+        """
+        if (self._start > 0):
+            # slide what we have down to the front
+            n = self._end - self._start
+            self._buf[0:n] = self._view[self._start:self._end]
+            self._start = 0
+            self._end = n
+
+        if (self._end == len(self._buf)):
+            # full of something that never parsed. it's garbage
+            self.resyncs += 1
+            self.reset()
+
+        try:
+            n = os.readv(fd, [self._view[self._end:]])
+        except BlockingIOError:
+            return None
+
+        self._end += n
+        return n
+
+    def _resync(self):
+        # skip at least one byte and look for something that looks like a header
+        self.resyncs += 1
+        m = _HEADER_PATTERN.search(self._buf, self._start + 1, self._end)
+        if (m == None):
+            # keep the last 3 bytes, they could be the start of a split header
+            keep = min(3, self._end - self._start)
+            self.discarded += self._end - self._start - keep
+            self._start = self._end - keep
+        else:
+            self.discarded += m.start() - self._start
+            self._start = m.start()
+
+    def nextPacket(self):
+        """
+        next well formed packet as (header, payload) or (None, None) if
+        a whole one isn't buffered yet
+        """
+        while True:
+            available = self._end - self._start
+            if (available < HEADER.size):
+                break
+
+            header, length = HEADER.unpack_from(self._buf, self._start)
+            limit = MAX_PAYLOAD.get(header)
+            if (limit == None or length > limit):
+                self._resync()
+                continue
+
+            if (available < HEADER.size + length):
+                break
+
+            payloadStart = self._start + HEADER.size
+            self._start = payloadStart + length
+            self.packets += 1
+            return header, self._view[payloadStart:payloadStart + length]
+
+        if (self._end > self._start):
+            self.shortReads += 1
+        return None, None
+
+    def getCounters(self):
+        return {"packets": self.packets,
+                "short_reads": self.shortReads,
+                "timeouts": self.timeouts,
+                "resyncs": self.resyncs,
+                "discarded_bytes": self.discarded}
@@ -1,13 +1,88 @@
-import sys
-import math
-from struct import unpack
-import serial
 import time 
+import struct
+import asyncio
 import threading
 import logging
 
+from kld7.recording import RawRecorder
+from kld7.protocol import PacketDecoder, RPST, RPST_PARAMETERS
+from kld7.aio import AsyncKLD7
+from metrics.prometheus import REGISTRY
+
 logger = logging.getLogger(__name__)
 
+# caller's view, includes waiting behind the GNFDs already on the wire
+COMMAND_SECONDS = REGISTRY.histogram("kld7_command_seconds", "sendCommand() from call to response")
+FRAME_REQUEST_SECONDS = REGISTRY.histogram("kld7_frame_request_seconds", "getNextFrame()/getTDAT() from call to frame")
+
+class FrameBuffer:
+    """
+    bounded ring of frames shared between the acquisition thread and
+    whoever consumes the frames. when the consumer falls behind the oldest
+    frame is overwritten and counted as an overrun
+    """
+    def __init__(self, size=64):
+        self._size = size
+        self._frames = [None] * size # preallocated so the ring never grows
+        self._head = 0 # next slot to write
+        self._count = 0
+
+        self.pushed = 0
+        self.popped = 0
+        self.overruns = 0
+
+        self._cond = threading.Condition()
+
+    def put(self, frame):
+        with self._cond:
+            self._frames[self._head] = frame
+            self._head = (self._head + 1) % self._size
+
+            if (self._count == self._size):
+                # oldest frame just got stomped on
+                self.overruns += 1
+            else:
+                self._count += 1
+
+            self.pushed += 1
+            self._cond.notify()
+
+    def get(self, timeout=None):
+        """
+        oldest frame in the ring or None if nothing showed up within timeout
+        """
+        with self._cond:
+            if (self._count == 0):
+                self._cond.wait(timeout)
+                if (self._count == 0):
+                    return None
+
+            tail = (self._head - self._count) % self._size
+            frame = self._frames[tail]
+            self._frames[tail] = None
+            self._count -= 1
+            self.popped += 1
+
+        return frame
+
+    def clear(self):
+        with self._cond:
+            for i in range(self._size):
+                self._frames[i] = None
+            self._head = 0
+            self._count = 0
+
+    def __len__(self):
+        return self._count
+
+    def getCounters(self):
+        with self._cond:
+            return {"size": self._size,
+                    "queued": self._count,
+                    "pushed": self.pushed,
+                    "popped": self.popped,
+                    "overruns": self.overruns}
+
 class KLD7:
     class RESPONSE():
         OK = 0
@@ -18,6 +93,16 @@ class KLD7:
         SENSOR_BUSY = 5
         TIMEOUT = 6
 
+    class GNFD():
+        # payload bits for GNFD. OR them together to get several in one frame.
+        # the sensor answers with the blocks in this order
+        RADC = 1
+        RFFT = 2
+        PDAT = 4
+        TDAT = 8
+        DDAT = 16
+        DONE = 32
+
     def __del__(self):
         self.disconnect()
 
@@ -28,6 +113,18 @@ class KLD7:
         self._init_time = 0
         self._device = ''
         self.serialPort = None
+
+        # all the serial work happens in the async driver on its own loop
+        # thread. the methods here just hand it coroutines and wait
+        self._driver = AsyncKLD7()
+        self._driver.onFrame = self._onFrame
+        self._loop = None
+        self._loopThread = None
+        self.protocol:PacketDecoder = self._driver.decoder
+
+        # streamed frames land here. see startStreaming()
+        self.frames = FrameBuffer()
+        self._recorder:RawRecorder = None
         
         # this will hold the actual values when they are read as well
         self._radarParameters = {
@@ -167,28 +264,17 @@ class KLD7:
         self._init_time = int(time.time()*1000)
         self._device = device
 
-        # create serial object with corresponding COM Port and open it 
-        self.serialPort =serial.Serial(self._device)
-        self.serialPort.baudrate=115200
-        self.serialPort.parity=serial.PARITY_EVEN
-        self.serialPort.stopbits=serial.STOPBITS_ONE
-        self.serialPort.bytesize=serial.EIGHTBITS
+        self._loop = asyncio.new_event_loop()
+        self._loopThread = threading.Thread(target=self._loop.run_forever, name="KLD7 Loop", daemon=True)
+        self._loopThread.start()
 
         # connect to sensor and set baudrate 
-        payloadlength = (4).to_bytes(4, byteorder='little')
-        value = (3).to_bytes(4, byteorder='little') # set baud rate to 2000000
-        header = bytes("INIT", 'utf-8')
-        cmd_init = header+payloadlength+value
-        self.serialPort.write(cmd_init)
-
-        # get response
-        response = self.serialPort.read(9)
-        if response[8] != 0:
+        response = self._run(self._driver.open(self._device))
+        self.serialPort = self._driver.serialPort
+        if response != 0:
             logger.error('Error during initialisation for K-LD7')
-            return response[8]
-
-        # change to higher baudrate based on the '3' value in the INIT payload
-        self.serialPort.baudrate = 2E6
+            self._stopLoop()
+            return response
         
         # just to get them for visibility
         r = self._getRadarParameters()
@@ -197,25 +283,18 @@ class KLD7:
         return r
     
     def _getRadarParameters(self):
-        with self.threadLock:
-
-            header = bytes("GRPS", 'utf-8')
-            payloadlength = (0).to_bytes(4, byteorder='little') # all commands except grps and srps are 4 byte payloads
-            cmd_frame = header+payloadlength
-
-            self.serialPort.write(cmd_frame)
+        response, buf = self._run(self._driver.grps())
+        if response != 0:
+            logger.error(f'[GRPS] error[{response}]')
+            return response
 
-            # get response
-            response = self.serialPort.read(9)
-            if response[8] != 0:
-                logger.error(f'[GRPS] error[{response[8]}]')
-                return response[8]
-            
-            header, payloadLength = unpack('<4sI', self.serialPort.read(8))
+        if (buf == None or len(buf) != RPST.size):
+            logger.error(f'[GRPS] bad parameter structure')
+            return self.RESPONSE.UART_ERROR
 
-            buf = self.serialPort.read(payloadLength)
+        with self.threadLock:
 
-            # this looks weird but there is a struct.unpack about 23 lines below here
+            # this looks weird but there is a RPST.unpack about 23 lines below here
             self._software_version,\
             self._base_frequency,\
             self._maximum_speed,\
@@ -239,7 +318,7 @@ class KLD7:
             self._hold_time,\
             self._micro_detection_retrigger,\
             self._micro_detection_sensitivity\
-             = unpack('<19s8B2b4Bb4BH2B', buf)
+             = RPST.unpack(buf)
              
             # makes it easier to expose the data
             # _radarParameters also carries meta data 
@@ -270,26 +349,95 @@ class KLD7:
         return 0
 
 
+    def _run(self, coro):
+        """
+        run a driver coroutine on the loop thread and wait for it
+        """
+        return asyncio.run_coroutine_threadsafe(coro, self._loop).result()
+
     def getTDAT(self):
-        with self.threadLock:
-            r = self.sendCommand("GNFD", 8) # 8 is for TDAT
-            if (r != 0):
-                logger.error(f'GNFD failed[{r}]')
-                return None, None, None, None
-
-            # look for header and payload
-            tdatResponse = self.serialPort.read(8)
-            if (tdatResponse[4] > 0):
-                readings = self.serialPort.read(8)
-                distance, speed, angle, magnitude = unpack('<HhhH', readings)
-                speed = speed / 100
-                angle = math.radians(angle)/100
-                
-                return distance, speed, angle, magnitude
-            
-        return None, None, None, None
+        frame = self.getNextFrame(self.GNFD.TDAT)
+        if (frame == None):
+            return None, None, None, None
+
+        return frame.getTDAT()
+
+    def getNextFrame(self, payload):
+        """
+        one GNFD round trip for any combination of GNFD bits.
+        returns a Frame or None if the sensor refused the request
+        """
+        if (not self._inited):
+            return None
+
+        start = time.monotonic()
+        frame = self._run(self._driver.gnfd(payload))
+        FRAME_REQUEST_SECONDS.observe(time.monotonic() - start)
+        if (frame == None):
+            logger.error(f'GNFD failed')
+        return frame
+
+    @property
+    def streamErrors(self):
+        return self._driver.streamErrors
+
+    def isStreaming(self):
+        return self._inited and self._driver.isStreaming()
+
+    def startStreaming(self, payload=GNFD.TDAT, depth=2):
+        """
+        keep `depth` GNFD requests in flight so the sensor always has the
+        next request queued when a frame completes. every Frame is pushed
+        into self.frames
+        """
+        if (not self._inited or self.isStreaming()):
+            return
+
+        self.frames.clear()
+        self._run(self._driver.startStreaming(payload, depth))
+
+    def stopStreaming(self):
+        if (not self._inited):
+            return
+        self._run(self._driver.stopStreaming())
+
+    def getFrame(self, timeout=None):
+        return self.frames.get(timeout)
+
+    def _onFrame(self, frame):
+        # on the loop thread
+        if (self._recorder != None):
+            self._recorder.append(frame)
+        self.frames.put(frame)
+
+    def startRawCapture(self, path):
+        """
+        add RADC and RFFT to the streamed payload and append every frame's
+        raw blocks to a RawRecorder at path
+        """
+        if (not self.isStreaming() or self._recorder != None):
+            return 1
+
+        self._recorder = RawRecorder(path)
+        # requests already in flight finish with the old payload, that's fine
+        self._driver.streamPayload |= self.GNFD.RADC | self.GNFD.RFFT
+        logger.info(f'''raw capture started [{path}]''')
+        return 0
+
+    def stopRawCapture(self):
+        recorder = self._recorder
+        if (recorder == None):
+            return
+        self._driver.streamPayload &= ~(self.GNFD.RADC | self.GNFD.RFFT)
+        self._recorder = None
+        recorder.close()
+
+    def getRawCaptureInfo(self):
+        recorder = self._recorder
+        if (recorder == None):
+            return None
+        return recorder.getInfo()
 
-    
     def setParameter(self, name, value):
         if (not self._inited):
             return 1
@@ -304,64 +452,107 @@ class KLD7:
             self._getRadarParameters()
         return r
 
-    def sendCommand(self, cmd, value):
+    def applyParameters(self, values):
+        """
+        set several parameters at once. values is name -> value, anything
+        already at that value is left out and if that's everything nothing
+        is sent. otherwise it's one SRPS with the whole structure and one
+        GRPS to check it took. returns (response, {name: (old, new)} that
+        changed). a value that didn't stick is INVALID_PARAMETER_VALUE
+        """
         if (not self._inited):
-            return
+            return 1, {}
+
+        unknown = [name for name in values if name not in RPST_PARAMETERS]
+        if (len(unknown) > 0):
+            logger.error(f'''[SRPS] not settable {unknown}''')
+            return self.RESPONSE.UNKNOWN_COMMAND, {}
 
         with self.threadLock:
-            header = bytes(cmd, 'utf-8')
-
-            # hack for reset.
-            # it's the only cmd with zero payload except for GRPS and GBYE
-            # which aren't exposed externally cuz they have completely diff semantics
-            if (cmd != "RFSE"):
-                payloadlength = (4).to_bytes(4, byteorder='little') # all commands except grps and srps are 4 byte payloads
-                if (value < 0):
-                    f = True
-                else:
-                    f = False
-
-                v = (value).to_bytes(4, byteorder='little', signed=f)
-                cmd_frame = header+payloadlength+v
-            else:
-                payloadlength = (0).to_bytes(4, byteorder='little') # all commands except grps and srps are 4 byte payloads
-                cmd_frame = header+payloadlength
+            if (self._software_version == None):
+                r = self._getRadarParameters()
+                if (r != 0):
+                    return r, {}
+            current = {name: self._radarParameters[name]["value"] for name in RPST_PARAMETERS}
+            version = self._software_version
+
+        changed = {name: (current[name], int(value)) for name, value in values.items() if current[name] != int(value)}
+        if (len(changed) == 0):
+            return 0, {}
+
+        wanted = dict(current)
+        wanted.update({name: new for name, (old, new) in changed.items()})
+        try:
+            rpst = RPST.pack(version, *[wanted[name] for name in RPST_PARAMETERS])
+        except struct.error as e:
+            # a value doesn't fit its field
+            logger.error(f'''[SRPS] bad values [{e}]''')
+            return self.RESPONSE.INVALID_PARAMETER_VALUE, {}
+
+        response = self._run(self._driver.srps(rpst))
+        if (response != 0):
+            logger.error(f'''[SRPS] error[{response}]''')
+            return response, {}
+
+        r = self._getRadarParameters()
+        if (r != 0):
+            return r, changed
 
-            if (cmd != "GNFD"):
-                logger.debug(f"cmd_frame[{cmd_frame}]")
+        with self.threadLock:
+            rejected = [name for name, (old, new) in changed.items() if self._radarParameters[name]["value"] != new]
+        if (len(rejected) > 0):
+            logger.error(f'''[SRPS] sensor didn't take {rejected}''')
+            return self.RESPONSE.INVALID_PARAMETER_VALUE, changed
+
+        logger.info(f'''[SRPS] set {changed}''')
+        return 0, changed
+
+    def sendCommand(self, cmd, value):
+        if (not self._inited):
+            return
 
-            self.serialPort.write(cmd_frame)
+        # hack for reset.
+        # it's the only cmd with zero payload except for GRPS and GBYE
+        # which aren't exposed externally cuz they have completely diff semantics
+        if (cmd == "RFSE"):
+            value = None
 
-            # get response
-            response = self.serialPort.read(9)
-            if response[8] != 0:
-                logger.error(f'[{cmd}] error[{response[8]}]')
+        # queued behind whatever GNFDs are already on the wire. no locking
+        start = time.monotonic()
+        response = self._run(self._driver.command(bytes(cmd, 'utf-8'), value))
+        COMMAND_SECONDS.observe(time.monotonic() - start)
+        if response != 0:
+            logger.error(f'[{cmd}] error[{response}]')
 
-        return response[8]
+        return response
     
     def disconnect(self):
         if (self._inited == False):
             return
         logger.info(f'''KLD7 shutting down ...''')
-        with self.threadLock:
-            logger.info(f'''sending BYE to sensor''')
-            # disconnect from sensor 
-            payloadlength = (0).to_bytes(4, byteorder='little')
-            header = bytes("GBYE", 'utf-8')
-            cmd_frame = header+payloadlength
-            self.serialPort.write(cmd_frame)
-
-            # get response
-            response = self.serialPort.read(9)
-            if response[8] == 0:
-                logger.info('KLD7 acknowledged BYE')
-            else:
-                logger.error('Error during disconnecting with K-LD7')
-                
-            logger.info(f'''closing [{self._device}]''')
-            self.serialPort.close()
-            self._inited = False
-        return response[8]
+        self.stopRawCapture()
+
+        logger.info(f'''sending BYE to sensor''')
+        # disconnect from sensor. stops streaming first
+        response = self._run(self._driver.close())
+        if response == 0:
+            logger.info('KLD7 acknowledged BYE')
+        else:
+            logger.error('Error during disconnecting with K-LD7')
+
+        logger.info(f'''closing [{self._device}]''')
+        self._stopLoop()
+        self._inited = False
+        return response
+
+    def _stopLoop(self):
+        if (self._loop == None):
+            return
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        if (self._loopThread is not threading.current_thread()):
+            self._loopThread.join(2)
+        self._loop.close()
+        self._loop = None
         
     def getRadarParameters(self):
         return self._radarParameters
\ No newline at end of file
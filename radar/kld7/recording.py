@@ -0,0 +1,213 @@
+import os
+import mmap
+import logging
+import threading
+import traceback
+import numpy as np
+from collections import deque
+
+from kld7.frame import Frame, decodeRaw
+
+logger = logging.getLogger(__name__)
+
+# one record per recorded frame. offset points into the .raw file where
+# the RADC block starts, the RFFT block follows right after it
+INDEX_DTYPE = np.dtype([("frame", "<u4"),
+                        ("millis", "<f8"),
+                        ("offset", "<u8"),
+                        ("radc", "<u4"),
+                        ("rfft", "<u4")])
+
+class _MappedFile:
+    """
+    append only file that is grown in chunks and written through a mmap so
+    appends never go through python file buffers
+    """
+    def __init__(self, path, chunk):
+        self.path = path
+        self._chunk = chunk
+        self._fd = os.open(path, os.O_RDWR | os.O_CREAT | os.O_TRUNC, 0o644)
+        self.used = 0
+        self._size = 0
+        self._map = None
+        self._grow(chunk)
+
+    def _grow(self, size):
+        size = ((size + self._chunk - 1) // self._chunk) * self._chunk
+        if (self._map != None):
+            self._map.close()
+        os.ftruncate(self._fd, size)
+        self._map = mmap.mmap(self._fd, size)
+        self._size = size
+
+    def append(self, buf):
+        offset = self.used
+        n = len(buf)
+        if (offset + n > self._size):
+            self._grow(offset + n + self._chunk)
+        self._map[offset:offset + n] = buf
+        self.used += n
+        return offset
+
+    def flush(self):
+        self._map.flush()
+
+    def close(self):
+        if (self._map == None):
+            return
+        self._map.flush()
+        self._map.close()
+        self._map = None
+        # give back the unused tail of the last chunk
+        os.ftruncate(self._fd, self.used)
+        os.close(self._fd)
+
+class RawRecorder:
+    """
+    appends RADC/RFFT blocks to <path>.raw and an INDEX_DTYPE record per
+    frame to <path>.idx. both files only ever grow while recording so a
+    recording can be read while it is still being written.
+    append() only queues the frame, the mmap writes and growing the files
+    happen on the recorder's own thread so a slow sd card never holds up
+    the serial loop. when the queue is full the frame is dropped
+    """
+    def __init__(self, path, chunk=16 * 1024 * 1024, size=64):
+        self.path = path
+        self.size = size
+        self._data = _MappedFile(path + ".raw", chunk)
+        self._index = _MappedFile(path + ".idx", INDEX_DTYPE.itemsize * 4096)
+        self._record = np.zeros(1, dtype=INDEX_DTYPE)
+        self.frames = 0
+        self.dropped = 0
+        self.errors = 0
+
+        self._queue = deque()
+        self._cond = threading.Condition()
+        self.closed = False
+
+        self._thread = threading.Thread(target=self.run, name="Raw Recorder", daemon=True)
+        self._thread.start()
+
+    def append(self, frame:Frame):
+        """
+        never blocks. a no-op once the recorder is closed
+        """
+        if (frame.radc is None and frame.rfft is None):
+            return
+
+        with self._cond:
+            if (self.closed):
+                return
+            if (len(self._queue) >= self.size):
+                self.dropped += 1
+                return
+            self._queue.append(frame)
+            self._cond.notify()
+
+    def write(self, frame:Frame):
+        radc = frame.radc
+        rfft = frame.rfft
+        offset = self._data.used
+        radcLen = 0
+        rfftLen = 0
+        if (radc is not None):
+            self._data.append(radc.data.cast('B'))
+            radcLen = radc.nbytes
+        if (rfft is not None):
+            self._data.append(rfft.data.cast('B'))
+            rfftLen = rfft.nbytes
+
+        r = self._record[0]
+        r["frame"] = frame.frameNumber if frame.frameNumber != None else self.frames
+        r["millis"] = frame.millis
+        r["offset"] = offset
+        r["radc"] = radcLen
+        r["rfft"] = rfftLen
+        self._index.append(self._record.data.cast('B'))
+        self.frames += 1
+
+    def run(self):
+        while True:
+            with self._cond:
+                while len(self._queue) == 0 and not self.closed:
+                    self._cond.wait()
+                if (len(self._queue) == 0):
+                    # closed and everything queued before that is written
+                    break
+                frame = self._queue.popleft()
+
+            try:
+                self.write(frame)
+            except Exception as e:
+                self.errors += 1
+                traceback.print_exc()
+
+        self._data.close()
+        self._index.close()
+        logger.info(f'''raw recording closed [{self.path}] frames[{self.frames}] dropped[{self.dropped}]''')
+
+    def getInfo(self):
+        with self._cond:
+            queued = len(self._queue)
+        return {"path": self.path,
+                "frames": self.frames,
+                "queued": queued,
+                "dropped": self.dropped,
+                "errors": self.errors,
+                "bytes": self._data.used}
+
+    def close(self):
+        """
+        stop taking frames, let the writer finish what's queued and close
+        the files. safe from any thread while append() is still being called
+        """
+        with self._cond:
+            if (self.closed):
+                return
+            self.closed = True
+            self._cond.notify()
+        if (self._thread is not threading.current_thread()):
+            self._thread.join()
+
+def mapOrEmpty(path, dtype):
+    # a capture stopped before its first frame leaves empty files, mmap won't map those
+    if (os.path.getsize(path) == 0):
+        return np.zeros(0, dtype=dtype)
+    return np.memmap(path, dtype=dtype, mode="r")
+
+class RawRecording:
+    """
+    read side of RawRecorder. everything is a memmap view so a recording
+    of any length can be walked on the pi without loading it
+    """
+    def __init__(self, path):
+        self.path = path
+        self._data = mapOrEmpty(path + ".raw", np.uint8)
+        index = mapOrEmpty(path + ".idx", INDEX_DTYPE)
+
+        # a recording that wasn't closed cleanly has zeroed records at the end
+        valid = np.nonzero(index["millis"])[0]
+        count = 0
+        if (len(valid) > 0):
+            count = valid[-1] + 1
+        self.index = index[:count]
+
+    def __len__(self):
+        return len(self.index)
+
+    def getFrame(self, i):
+        r = self.index[i]
+        offset = int(r["offset"])
+        radcLen = int(r["radc"])
+        rfftLen = int(r["rfft"])
+
+        frame = Frame(float(r["millis"]), frameNumber=int(r["frame"]))
+        if (radcLen > 0):
+            frame.radc = decodeRaw(self._data[offset:offset + radcLen])
+        if (rfftLen > 0):
+            frame.rfft = decodeRaw(self._data[offset + radcLen:offset + radcLen + rfftLen])
+        return frame
+
+    def __iter__(self):
+        for i in range(len(self.index)):
+            yield self.getFrame(i)
@@ -0,0 +1,305 @@
+import os
+import sys
+import math
+import time
+import json
+import tty
+import select
+import random
+import signal
+import argparse
+import logging
+from collections import deque
+from struct import pack, unpack
+
+from kld7.protocol import RPST
+
+logger = logging.getLogger(__name__)
+
+# parameter cmd -> index into the RPST tuple (software version is 0)
+PARAMETER_COMMANDS = ["RBFR", "RSPI", "RRAI", "THOF", "TRFT", "VISU",
+                      "MIRA", "MARA", "MIAN", "MAAN", "MISP", "MASP",
+                      "DEDI", "RATH", "ANTH", "SPTH", "DIG1", "DIG2",
+                      "DIG3", "HOLD", "MIDE", "MIDS"]
+
+# factory defaults from the K-LD7 datasheet
+DEFAULT_PARAMETERS = [b'K-LD7_APP-RFB-SIM', 1, 1, 1, 30, 0, 3, 0, 50, -90, 90, 0, 100, 2, 10, 0, 50, 0, 1, 2, 120, 0, 4]
+
+RADC_LENGTH = 3072
+RFFT_LENGTH = 1536
+
+def encodeTarget(t):
+    """
+    inverse of kld7.frame.decodeTargets for one target dict
+    """
+    return pack('<HhhH', int(t["distance"]),
+                int(round(t["speed"] * 100)),
+                int(round(math.degrees(t["angle"]) * 100)),
+                int(t["magnitude"]))
+
+def encodeBlock(header, payload):
+    return header + pack('<I', len(payload)) + payload
+
+def encodeFrame(frame, bits, frameNumber):
+    """
+    build the blocks the sensor sends after RESP for a GNFD with `bits`.
+    frame is a Frame.toDict() style dict
+    """
+    out = b''
+    if (bits & 1):
+        out += encodeBlock(b'RADC', bytes(RADC_LENGTH))
+    if (bits & 2):
+        out += encodeBlock(b'RFFT', bytes(RFFT_LENGTH))
+    if (bits & 4):
+        pdat = frame.get("pdat")
+        if (pdat == None):
+            pdat = []
+            if (frame.get("tdat") != None):
+                pdat = [frame["tdat"]]
+        out += encodeBlock(b'PDAT', b''.join([encodeTarget(t) for t in pdat]))
+    if (bits & 8):
+        tdat = frame.get("tdat")
+        out += encodeBlock(b'TDAT', encodeTarget(tdat) if tdat != None else b'')
+    if (bits & 16):
+        ddat = frame.get("ddat")
+        if (ddat == None):
+            detected = 1 if frame.get("tdat") != None else 0
+            ddat = {"detection": detected, "micro_detection": 0, "angle": 0,
+                    "direction": 0, "range": 0, "speed": 0}
+        out += encodeBlock(b'DDAT', bytes([ddat["detection"], ddat["micro_detection"], ddat["angle"],
+                                           ddat["direction"], ddat["range"], ddat["speed"]]))
+    if (bits & 32):
+        out += encodeBlock(b'DONE', pack('<I', frameNumber & 0xffffffff))
+    return out
+
+class ReplaySource:
+    """
+    frames from a jsonl file of Frame.toDict() lines, paced by the
+    recorded millis. loops forever unless loop is False
+    """
+    def __init__(self, path, loop=True):
+        self.path = path
+        self.loop = loop
+
+    def __iter__(self):
+        while True:
+            lastMillis = None
+            with open(self.path, 'r', encoding='utf-8') as f:
+                for line in f:
+                    if (line.strip() == ''):
+                        continue
+                    frame = json.loads(line)
+                    millis = frame.get("millis", 0)
+                    delay = 0 if lastMillis == None else max(0, (millis - lastMillis) / 1000)
+                    lastMillis = millis
+                    yield delay, frame
+            if (not self.loop):
+                return
+
+class SyntheticSource:
+    """
+    cars driving through the beam. each pass approaches from maximumRange
+    to the sensor at a random speed with a random gap between cars
+    """
+    def __init__(self, period=0.05, maximumRange=3000, seed=None):
+        self.period = period
+        self.maximumRange = maximumRange
+        self.random = random.Random(seed)
+
+    def __iter__(self):
+        empty = {"tdat": None, "pdat": []}
+        while True:
+            # nobody around
+            for i in range(int(self.random.uniform(0.5, 5) / self.period)):
+                yield self.period, empty
+
+            speed = self.random.uniform(15, 90) # km/h
+            distance = float(self.maximumRange)
+            lateral = self.random.uniform(150, 600) # cm from the beam center
+            sign = self.random.choice([-1, 1])
+            step = speed / 3.6 * 100 * self.period # cm per frame
+
+            while distance > 0:
+                angle = math.atan2(lateral, distance)
+                # the radar only sees the radial part of the speed
+                target = {"distance": int(math.hypot(distance, lateral)),
+                          "speed": -speed * math.cos(angle),
+                          "angle": sign * angle,
+                          "magnitude": int(self.random.uniform(60, 90))}
+                yield self.period, {"tdat": target, "pdat": [target]}
+                distance -= step
+
+class Simulator:
+    """
+    software K-LD7 behind a pseudo terminal. answers INIT/GRPS/SRPS/GNFD/
+    GBYE and the parameter commands the way the sensor does. GNFD requests
+    are served one per frame so a pipelining client sees the same cadence
+    it would on /dev/ttyAMA0
+    """
+    def __init__(self, source, speed=1.0):
+        self.source = iter(source)
+        self.speed = speed
+        self.parameters = list(DEFAULT_PARAMETERS)
+        self.frameNumber = 0
+        self.isStopped = False
+
+        self._master, self._slave = os.openpty()
+        tty.setraw(self._slave)
+        self.device = os.ttyname(self._slave)
+
+        self._in = bytearray()
+        self._out = bytearray()
+        self._nextFrameTime = 0
+        self._pending = deque() # (cmd, payload) waiting for their turn
+
+    def stop(self):
+        self.isStopped = True
+
+    def close(self):
+        os.close(self._master)
+        os.close(self._slave)
+
+    def _respond(self, code):
+        self._out += encodeBlock(b'RESP', bytes([code]))
+
+    def _handle(self, cmd, payload):
+        """
+        returns False if the command has to wait for the next frame
+        """
+        if (cmd == b'GNFD'):
+            now = time.monotonic()
+            if (now < self._nextFrameTime):
+                return False
+
+            delay, frame = next(self.source)
+            if (self.speed > 0):
+                self._nextFrameTime = max(now, self._nextFrameTime) + delay / self.speed
+
+            bits = unpack('<I', payload)[0]
+            self.frameNumber += 1
+            self._respond(0)
+            self._out += encodeFrame(frame, bits, self.frameNumber)
+        elif (cmd == b'INIT' or cmd == b'GBYE'):
+            self._respond(0)
+        elif (cmd == b'GRPS'):
+            self._respond(0)
+            self._out += encodeBlock(b'RPST', RPST.pack(*self.parameters))
+        elif (cmd == b'SRPS'):
+            if (len(payload) != RPST.size):
+                self._respond(2)
+            else:
+                values = list(RPST.unpack(payload))
+                values[0] = self.parameters[0] # version is read only
+                self.parameters = values
+                self._respond(0)
+        elif (cmd == b'RFSE'):
+            self.parameters = list(DEFAULT_PARAMETERS)
+            self._respond(0)
+        elif (cmd.decode('utf-8', 'replace') in PARAMETER_COMMANDS and len(payload) == 4):
+            i = PARAMETER_COMMANDS.index(cmd.decode('utf-8')) + 1
+            self.parameters[i] = unpack('<i', payload)[0]
+            self._respond(0)
+        else:
+            self._respond(1)
+        return True
+
+    def _parse(self):
+        while len(self._in) >= 8:
+            cmd, length = unpack('<4sI', self._in[:8])
+            if (len(self._in) < 8 + length):
+                break
+            self._pending.append((bytes(cmd), bytes(self._in[8:8 + length])))
+            del self._in[:8 + length]
+
+    def run(self):
+        logger.info(f'''KLD7 simulator serving on [{self.device}] speed[{self.speed}x]''')
+        while not self.isStopped:
+            # commands are answered strictly in order like the sensor does
+            while len(self._pending) > 0:
+                cmd, payload = self._pending[0]
+                if (not self._handle(cmd, payload)):
+                    break
+                self._pending.popleft()
+
+            timeout = 0.1
+            if (len(self._pending) > 0):
+                timeout = max(0, min(timeout, self._nextFrameTime - time.monotonic()))
+
+            writers = [self._master] if len(self._out) > 0 else []
+            r, w, x = select.select([self._master], writers, [], timeout)
+            if (len(r) > 0):
+                try:
+                    self._in += os.read(self._master, 4096)
+                except OSError:
+                    # client went away. the slave end is still ours so just wait for the next one
+                    time.sleep(0.1)
+                    continue
+                self._parse()
+            if (len(w) > 0):
+                n = os.write(self._master, self._out)
+                del self._out[:n]
+
+def record(device, path, seconds):
+    """
+    capture a replayable frame stream from a real sensor
+    """
+    from kld7.radar import KLD7
+
+    radar = KLD7()
+    r = radar.init(device)
+    if (r != KLD7.RESPONSE.OK):
+        logger.error(f'''radar failed to init[{r}] with device[{device}]''')
+        return r
+
+    count = 0
+    end = time.time() + seconds
+    radar.startStreaming(KLD7.GNFD.TDAT | KLD7.GNFD.PDAT | KLD7.GNFD.DDAT)
+    try:
+        with open(path, 'w', encoding='utf-8') as f:
+            while time.time() < end:
+                frame = radar.getFrame(timeout=1.0)
+                if (frame == None):
+                    continue
+                f.write(json.dumps(frame.toDict()) + '\n')
+                count += 1
+    finally:
+        radar.disconnect()
+
+    logger.info(f'''recorded [{count}] frames to [{path}]''')
+    return 0
+
+def main():
+    logging.basicConfig(stream=sys.stdout, level=logging.INFO)
+
+    parser = argparse.ArgumentParser(description="software K-LD7 on a pseudo terminal")
+    parser.add_argument("-r", "--replay", help="jsonl frame stream to replay")
+    parser.add_argument("-s", "--speed", help="playback speed. 0 is as fast as the client asks", type=float, default=1.0)
+    parser.add_argument("-p", "--period", help="synthetic frame period in seconds", type=float, default=0.05)
+    parser.add_argument("--seed", help="seed for synthetic traffic", type=int, default=None)
+    parser.add_argument("--record", help="record a frame stream from this serial device instead of serving")
+    parser.add_argument("-o", "--output", help="where --record writes to", default="frames.jsonl")
+    parser.add_argument("--seconds", help="how long --record runs", type=float, default=60)
+    args = parser.parse_args()
+
+    if (args.record != None):
+        return record(args.record, args.output, args.seconds)
+
+    if (args.replay != None):
+        source = ReplaySource(args.replay)
+    else:
+        source = SyntheticSource(args.period, seed=args.seed)
+
+    simulator = Simulator(source, args.speed)
+    signal.signal(signal.SIGTERM, lambda signum, frame: simulator.stop())
+
+    # main.py -d <this>
+    print(simulator.device, flush=True)
+    try:
+        simulator.run()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        simulator.close()
+
+if __name__ == "__main__":
+    main()
@@ -5,7 +5,6 @@ import traceback
 import threading
 import argparse
 import logging
-import time
 
 isRaspberryPi = False
 if (os.path.isfile("/boot/firmware/config.txt")):
@@ -15,6 +14,9 @@ if (os.path.isfile("/boot/firmware/config.txt")):
 from kld7.radar import KLD7
 from controller.controller import Controller
 from web.web import HttpInterface
+from camera.capture import CaptureWorker
+from controller.store import ReadingStore
+from controller.profiles import ProfileStore
 
 logging.basicConfig(stream=sys.stdout, level=logging.INFO)
 logger = logging.getLogger(__name__)
@@ -39,6 +41,18 @@ def main():
     parser.add_argument("-d", "--device", help="serial port", required=True)
     parser.add_argument("-w", "--web_interface", help="web interface control", action='store_false')
     parser.add_argument("-r", "--radar_interface", help="radar controller control", action='store_false')
+    parser.add_argument("--capture_policy", help="what to do when the camera falls behind", choices=CaptureWorker.POLICIES, default=CaptureWorker.COALESCE)
+    parser.add_argument("--capture_queue", help="camera requests allowed to wait", type=int, default=4)
+    parser.add_argument("--clip_preroll", help="seconds of H.264 kept before a trigger. 0 turns clips off", type=float, default=0)
+    parser.add_argument("--clip_postroll", help="seconds recorded after the last trigger", type=float, default=3)
+    parser.add_argument("--pretrigger", help="camera frames kept before a trigger. 0 takes a new still per trigger", type=int, default=0)
+    parser.add_argument("--store", help="sqlite file readings and vehicles are kept in. empty turns it off", default="readings.db")
+    parser.add_argument("--image_budget", help="MB of images kept before the least valuable are deleted", type=int, default=4096)
+    parser.add_argument("--min_free", help="MB of disk always left free, images are deleted to keep it", type=int, default=1024)
+    parser.add_argument("--profiles", help="json file named radar profiles are kept in", default="profiles.json")
+    parser.add_argument("--profile", help="saved radar profile to apply at start", default="")
+    parser.add_argument("--web_workers", help="web requests served at once", type=int, default=8)
+    parser.add_argument("--web_backlog", help="connections allowed to wait for a web worker", type=int, default=16)
     args = parser.parse_args()
 
     try:
@@ -55,13 +69,22 @@ def main():
                 logger.info(f"radar failed to init[{r}] with device[{args.device}]")
                 exit()
 
+        store = None
+        if (args.store != ""):
+            store = ReadingStore(args.store)
+        profiles = ProfileStore(args.profiles)
+
         if (isRaspberryPi and args.radar_interface):
-            camera = Picam()
-            controller.init(radar, camera)
+            camera = Picam(args.pretrigger, clipPreRoll=args.clip_preroll, clipPostRoll=args.clip_postroll)
+            controller.init(radar, camera, args.capture_policy, args.capture_queue, store, args.image_budget << 20, args.min_free << 20, profiles)
         else:
-            controller.init(radar)
+            controller.init(radar, store=store, imageBudgetBytes=args.image_budget << 20, minFreeBytes=args.min_free << 20, profiles=profiles)
+
+        if (args.profile != "" and args.radar_interface):
+            r, changed = controller.applyProfile(args.profile)
+            logger.info(f'''profile [{args.profile}] at start [{r}] changed {list(changed)}''')
 
-        wif.init(controller)
+        wif.init(controller, args.web_workers, args.web_backlog)
 
         rthread = threading.Thread(target=controller.run, name="Radar Controller", kwargs={})
         wthread = threading.Thread(target=wif.go, name="Web Interface", kwargs={})
@@ -0,0 +1,114 @@
+import os
+import sys
+import time
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+MAX_SECONDS = 60
+# 1 to 1000 samples a second. any faster and the walk over every stack holds the gil the whole time
+MIN_INTERVAL = 0.001
+MAX_INTERVAL = 1.0
+
+def threadCpu(ident):
+    """
+    cpu seconds thread ident has used, None where the platform can't say
+    """
+    try:
+        return time.clock_gettime(time.pthread_getcpuclockid(ident))
+    except (AttributeError, OSError, ValueError):
+        return None
+
+def frameName(frame):
+    code = frame.f_code
+    # ; separates frames in the collapsed format, the count is after the last space
+    return f'''{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})'''.replace(';', ':')
+
+class SamplingProfiler:
+    """
+    looks at every thread's stack with sys._current_frames() every
+    interval seconds for a fixed time and counts identical stacks. nothing
+    is hooked into the interpreter and nothing runs between profiles, so
+    it costs nothing until someone asks. one profile at a time
+    """
+    def __init__(self):
+        self._busy = threading.Lock()
+        self.runs = 0
+
+    def profile(self, seconds=10, interval=0.01):
+        """
+        blocks for seconds. returns None if a profile is already running,
+        otherwise {"collapsed": text, "threads": [...], "samples", "seconds"}.
+        collapsed is one "thread;outer;...;inner count" line per stack,
+        what flamegraph.pl and speedscope read
+        """
+        seconds = min(max(float(seconds), 0.1), MAX_SECONDS)
+        interval = min(max(float(interval), MIN_INTERVAL), MAX_INTERVAL)
+        if (not self._busy.acquire(blocking=False)):
+            return None
+
+        try:
+            me = threading.get_ident()
+            names = {}
+            cpuStart = {}
+            for t in threading.enumerate():
+                names[t.ident] = t.name
+                cpuStart[t.ident] = threadCpu(t.ident)
+
+            stacks = {}
+            samples = {} # ident -> samples it was seen in
+            taken = 0
+            processStart = os.times()
+            start = time.monotonic()
+            end = start + seconds
+            while True:
+                now = time.monotonic()
+                if (now >= end):
+                    break
+                for ident, frame in sys._current_frames().items():
+                    if (ident == me):
+                        continue
+                    stack = []
+                    while frame != None:
+                        stack.append(frameName(frame))
+                        frame = frame.f_back
+                    name = names.get(ident)
+                    if (name == None):
+                        # started after we did
+                        name = names[ident] = next((t.name for t in threading.enumerate() if t.ident == ident), str(ident))
+                    stack.append(name.replace(';', ':'))
+                    key = ";".join(reversed(stack))
+                    stacks[key] = stacks.get(key, 0) + 1
+                    samples[ident] = samples.get(ident, 0) + 1
+                taken += 1
+                # keep to the schedule rather than drift by however long sampling took
+                time.sleep(max(0, start + taken * interval - time.monotonic()))
+            wall = time.monotonic() - start
+            processEnd = os.times()
+            processCpu = (processEnd.user + processEnd.system) - (processStart.user + processStart.system)
+
+            threads = []
+            alive = {t.ident: t for t in threading.enumerate()}
+            for ident, name in names.items():
+                before = cpuStart.get(ident)
+                after = threadCpu(ident) if ident in alive else None
+                cpu = None if before == None or after == None else after - before
+                threads.append({"name": name,
+                                "ident": ident,
+                                "samples": samples.get(ident, 0),
+                                "cpu_seconds": None if cpu == None else round(cpu, 3),
+                                "cpu_percent": None if cpu == None else round(cpu / wall * 100, 1),
+                                "profiler": ident == me})
+            threads.sort(key=lambda t: -(t["cpu_seconds"] or 0))
+
+            self.runs += 1
+            collapsed = "".join([f'''{key} {count}\n''' for key, count in sorted(stacks.items(), key=lambda s: -s[1])])
+            logger.info(f'''profiled [{len(names)}] threads for [{wall:.1f}s] [{taken}] samples [{len(stacks)}] stacks''')
+            return {"collapsed": collapsed,
+                    "threads": threads,
+                    "samples": taken,
+                    "seconds": round(wall, 3),
+                    "process_cpu_percent": round(processCpu / wall * 100, 1)}
+        finally:
+            self._busy.release()
@@ -0,0 +1,117 @@
+import array
+import bisect
+import logging
+import threading
+import traceback
+
+logger = logging.getLogger(__name__)
+
+# seconds. 100us to 10s, roughly 1-2.5-5 per decade
+LATENCY_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05,
+                   0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+def formatLabels(labels):
+    if (labels == None or len(labels) == 0):
+        return ""
+    return "{" + ",".join([f'''{k}="{v}"''' for k, v in labels.items()]) + "}"
+
+class LatencyHistogram:
+    """
+    fixed buckets, counts in a preallocated array. observe() is a bisect
+    and two in-place adds so it's fine on the radar loop and the serial
+    callbacks. it isn't locked, two threads observing the same histogram
+    at the same instant can lose a count, which is cheaper than a lock
+    on every frame
+    """
+    __slots__ = ("name", "help", "labels", "bounds", "counts", "total")
+
+    def __init__(self, name, help, labels=None, bounds=LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.bounds = tuple(bounds)
+        # one per bound and +Inf at the end. not cumulative, that's done when rendered
+        self.counts = array.array('Q', [0] * (len(self.bounds) + 1))
+        self.total = array.array('d', [0.0])
+
+    def observe(self, seconds):
+        self.counts[bisect.bisect_left(self.bounds, seconds)] += 1
+        self.total[0] += seconds
+
+    def render(self, lines):
+        counts = self.counts.tolist()
+        extra = "" if self.labels == None else "," + formatLabels(self.labels)[1:-1]
+        cumulative = 0
+        for bound, count in zip(self.bounds, counts):
+            cumulative += count
+            lines.append(f'''{self.name}_bucket{{le="{bound}"{extra}}} {cumulative}''')
+        cumulative += counts[-1]
+        lines.append(f'''{self.name}_bucket{{le="+Inf"{extra}}} {cumulative}''')
+        lines.append(f'''{self.name}_sum{formatLabels(self.labels)} {self.total[0]}''')
+        lines.append(f'''{self.name}_count{formatLabels(self.labels)} {cumulative}''')
+
+class Registry:
+    """
+    histograms recorded as things happen and collectors that are only
+    asked for their numbers when /metrics is scraped. a collector returns
+    (name, type, help, labels, value) tuples, that's how the counters the
+    rest of the code already keeps get exposed without touching the hot path
+    """
+    def __init__(self):
+        self._histograms = []
+        self._collectors = []
+        self._lock = threading.Lock()
+
+    def histogram(self, name, help, labels=None, bounds=LATENCY_BUCKETS):
+        h = LatencyHistogram(name, help, labels, bounds)
+        with self._lock:
+            self._histograms.append(h)
+        return h
+
+    def addCollector(self, collector):
+        with self._lock:
+            self._collectors.append(collector)
+
+    def removeCollector(self, collector):
+        with self._lock:
+            if (collector in self._collectors):
+                self._collectors.remove(collector)
+
+    def render(self):
+        with self._lock:
+            histograms = list(self._histograms)
+            collectors = list(self._collectors)
+
+        # every sample of a name has to come out together under one HELP/TYPE
+        families = {} # name -> (type, help, lines)
+        for h in histograms:
+            if (h.name not in families):
+                families[h.name] = ("histogram", h.help, [])
+            h.render(families[h.name][2])
+
+        for collector in collectors:
+            try:
+                samples = list(collector())
+            except Exception:
+                # one broken collector shouldn't take the whole scrape down
+                traceback.print_exc()
+                continue
+            for name, kind, help, labels, value in samples:
+                if (value == None):
+                    continue
+                if (name not in families):
+                    families[name] = (kind, help, [])
+                families[name][2].append(f'''{name}{formatLabels(labels)} {value}''')
+
+        lines = []
+        for name, (kind, help, samples) in families.items():
+            lines.append(f'''# HELP {name} {help}''')
+            lines.append(f'''# TYPE {name} {kind}''')
+            lines.extend(samples)
+        lines.append("")
+        return "\n".join(lines)
+
+# the one the whole process records into
+REGISTRY = Registry()
@@ -0,0 +1,163 @@
+import json
+import logging
+import threading
+from urllib.parse import urlsplit, parse_qs
+
+from controller.controller import Controller
+from web.response import sendBody
+
+logger = logging.getLogger(__name__)
+
+# an idle event stream sends a comment this often so dead clients are noticed
+PING_SECONDS = 5
+
+def toJson(value):
+    # numpy scalars sneak in from frames
+    if (hasattr(value, "item")):
+        return value.item()
+    raise TypeError(f'''can't serialize [{type(value)}]''')
+
+class JsonApi:
+    """
+    /api/* as compact json. every endpoint has a version that is cheap to
+    get, it's the ETag, and the body is only built when the client's
+    If-None-Match doesn't match it
+    """
+    def __init__(self, controller:Controller):
+        self.controller = controller
+
+        # path -> (version(), payload(query))
+        self.endpoints = {"/api/readings": (lambda: self.controller.getVersion("readings"), self.readings),
+                          "/api/stats": (self.controller.getStatsVersion, self.stats),
+                          "/api/params": (lambda: self.controller.getVersion("params"), self.params),
+                          "/api/images": (self.imagesVersion, self.images),
+                          "/api/host": (self.hostVersion, self.host)}
+
+    def readings(self, query):
+        return {"readings": self.controller.getLastTDATReadings(),
+                "vehicles": self.controller.getLastVehicleEvents()}
+
+    def stats(self, query):
+        return {"stats": self.controller.getStats(),
+                "percentiles": self.controller.getPercentiles()}
+
+    def params(self, query):
+        return {"speed_threshold": self.controller.speed_threshold,
+                "radar": self.controller.getRadarParameters(),
+                "profiles": self.controller.getProfileNames(),
+                "active_profile": self.controller.activeProfile}
+
+    def hostVersion(self):
+        return f'''{self.controller.startMillis:x}-{self.controller.host.version}'''
+
+    def host(self, query):
+        """
+        the latest host sample. ?history=1 adds the recent ones oldest first
+        """
+        payload = {"host": self.controller.getHostSnapshot()}
+        if (query.get("history", ["0"])[0] == "1"):
+            payload["history"] = self.controller.host.getHistory()
+        return payload
+
+    def imagesVersion(self):
+        return f'''{self.controller.startMillis:x}-{self.controller.images.version}'''
+
+    def images(self, query):
+        """
+        newest first. pass next back as cursor for the page after
+        """
+        try:
+            limit = max(1, min(int(query.get("limit", ["100"])[0]), 1000))
+        except ValueError:
+            raise ValueError(f'''limit must be a number [{query.get("limit")[0]}]''')
+        cursor = query.get("cursor", [None])[0]
+        images, next = self.controller.images.page(cursor, limit)
+        for image in images:
+            # None until it's built, asking queues it
+            image["thumb"] = self.controller.thumbnails.getUrl("thumb", image["name"])
+            image["medium"] = self.controller.thumbnails.getUrl("medium", image["name"])
+        return {"total": len(self.controller.images), "images": images, "next": next}
+
+    def handle(self, handler):
+        """
+        answer handler's GET for anything under /api/
+        """
+        url = urlsplit(handler.path)
+        if (url.path.rstrip('/') == "/api/events"):
+            self.events(handler)
+            return
+
+        endpoint = self.endpoints.get(url.path.rstrip('/'))
+        if (endpoint == None):
+            handler.send_error(404, f'''no such endpoint [{url.path}]''')
+            return
+
+        version, payload = endpoint
+        # the query is part of what the client gets back
+        etag = f'''"{version()}{'-' + url.query if url.query != '' else ''}"'''
+
+        if (etag in [t.strip() for t in handler.headers.get("If-None-Match", "").split(',')]):
+            handler.send_response(304)
+            handler.send_header("ETag", etag)
+            handler.send_header("Cache-Control", "no-cache")
+            handler.end_headers()
+            return
+
+        try:
+            body = json.dumps(payload(parse_qs(url.query)), separators=(',', ':'), default=toJson).encode("utf-8")
+        except ValueError as e:
+            handler.send_error(400, str(e))
+            return
+
+        # always come back and ask, the 304 is what makes that cheap
+        sendBody(handler, body, "application/json", {"ETag": etag, "Cache-Control": "no-cache"})
+
+    def events(self, handler):
+        """
+        server-sent events. every reading and vehicle as it happens. once
+        the headers are out the connection is detached from the web worker
+        and streamed from a thread of its own, the broadcaster caps how
+        many of those there are
+        """
+        subscription = self.controller.broadcaster.subscribe()
+        if (subscription == None):
+            handler.send_error(503, "too many event listeners")
+            return
+
+        try:
+            handler.send_response(200)
+            handler.send_header("Content-Type", "text/event-stream")
+            handler.send_header("Cache-Control", "no-cache")
+            # no length, the end of the stream is the end of the connection
+            handler.send_header("Connection", "close")
+            handler.end_headers()
+            handler.close_connection = True
+            handler.wfile.write(b'retry: 2000\n\n')
+            handler.wfile.flush()
+        except (BrokenPipeError, ConnectionResetError, TimeoutError):
+            self.controller.broadcaster.unsubscribe(subscription)
+            return
+
+        handler.server.detach(handler.connection)
+        threading.Thread(target=self.stream, args=(handler.server, handler.connection, subscription),
+                         name="Event Stream", daemon=True).start()
+
+    def stream(self, server, connection, subscription):
+        try:
+            while not server.isClosing:
+                items = subscription.get(PING_SECONDS)
+                if (subscription.evicted):
+                    # too slow. the browser reconnects and starts from now
+                    break
+
+                if (len(items) == 0):
+                    out = b': ping\n\n'
+                else:
+                    out = b''.join([f'''event: {name}\ndata: {json.dumps(data, separators=(',', ':'), default=toJson)}\n\n'''.encode("utf-8") for name, data in items])
+                connection.sendall(out)
+        except OSError:
+            # gone, or stalled past the socket timeout
+            pass
+        finally:
+            self.controller.broadcaster.unsubscribe(subscription)
+            server.shutdown_request(connection)
@@ -0,0 +1,57 @@
+// live updates for the readings page from /api/events
+(function () {
+    var MAX_ROWS = 10;
+
+    function elapsed(millis) {
+        var d = Math.max(0, Date.now() - millis);
+        var h = Math.floor(d / 3600000);
+        var m = Math.floor((d % 3600000) / 60000);
+        var s = Math.floor((d % 60000) / 1000);
+        return [h, m, s].map(function (v) { return String(v).padStart(2, '0'); }).join(':');
+    }
+
+    function prepend(body, millis, cells) {
+        if (body == null) {
+            return;
+        }
+        var row = document.createElement('tr');
+        row.dataset.millis = millis;
+        [elapsed(millis)].concat(cells).forEach(function (text) {
+            var td = document.createElement('td');
+            td.textContent = text;
+            row.appendChild(td);
+        });
+        // drop the "nothing yet" placeholder
+        if (body.rows.length == 1 && body.rows[0].dataset.millis == null) {
+            body.deleteRow(0);
+        }
+        body.insertBefore(row, body.firstChild);
+        while (body.rows.length > MAX_ROWS) {
+            body.deleteRow(body.rows.length - 1);
+        }
+    }
+
+    var readings = document.getElementById('readings-live');
+    var vehicles = document.getElementById('vehicles-live');
+
+    var events = new EventSource('/api/events');
+    events.addEventListener('reading', function (e) {
+        var r = JSON.parse(e.data);
+        prepend(readings, r.millis, [r.speed.toFixed(2), String(r.distance).padStart(4, '0'),
+                                     r.angle.toFixed(4), r.magnitude, r.targets || 0]);
+    });
+    events.addEventListener('vehicle', function (e) {
+        var v = JSON.parse(e.data);
+        prepend(vehicles, v.millis, [v.peak_speed_mph, v.median_speed_mph,
+                                     String(v.closest_distance).padStart(4, '0'), v.dwell, v.direction]);
+    });
+
+    // the page may come out of the server's cache so its elapsed times start out stale
+    function tick() {
+        document.querySelectorAll('tr[data-millis]').forEach(function (row) {
+            row.cells[0].textContent = elapsed(Number(row.dataset.millis));
+        });
+    }
+    tick();
+    setInterval(tick, 1000);
+})();
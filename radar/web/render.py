@@ -0,0 +1,79 @@
+import string
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+class Template:
+    """
+    a str.format() style template parsed once when it's created. render()
+    only formats the fields and joins, it never looks at the text again.
+    fields are plain names, {speed:0>2.2f} works, {reading[speed]} doesn't
+    """
+    def __init__(self, text):
+        self.text = text
+        # literal text and (name, format spec) pairs in order
+        self._parts = []
+        for literal, field, spec, conversion in string.Formatter().parse(text):
+            if (literal != ""):
+                self._parts.append(literal)
+            if (field == None):
+                continue
+            if (not field.isidentifier() or conversion != None):
+                raise ValueError(f'''template field [{field}] has to be a plain name''')
+            self._parts.append((field, spec))
+
+    def render(self, **values):
+        return "".join([p if isinstance(p, str) else format(values[p[0]], p[1]) for p in self._parts])
+
+    def renderAll(self, rows):
+        """
+        one render per dict in rows, joined
+        """
+        return "".join([self.render(**row) for row in rows])
+
+class PageCache:
+    """
+    rendered html by key, each kept with the version it was built from.
+    get() hands back the cached copy while the version still matches and
+    builds a new one when it doesn't. builds are one at a time so a burst
+    of page loads right after a change builds the page once
+    """
+    def __init__(self):
+        self._entries = {} # key -> (version, html)
+        self._lock = threading.Lock()
+        self._building = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, version, build):
+        with self._lock:
+            entry = self._entries.get(key)
+            if (entry != None and entry[0] == version):
+                self.hits += 1
+                return entry[1]
+
+        with self._building:
+            # someone else may have built it while we waited
+            with self._lock:
+                entry = self._entries.get(key)
+                if (entry != None and entry[0] == version):
+                    self.hits += 1
+                    return entry[1]
+
+            html = build()
+            with self._lock:
+                self._entries[key] = (version, html)
+                self.misses += 1
+            return html
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def getMetrics(self):
+        with self._lock:
+            return {"entries": len(self._entries),
+                    "hits": self.hits,
+                    "misses": self.misses}
@@ -0,0 +1,181 @@
+import os
+import gzip
+import logging
+import mimetypes
+import email.utils
+from urllib.parse import urlsplit, parse_qs
+
+logger = logging.getLogger(__name__)
+
+# captures and their derived copies get a new name rather than being rewritten.
+# clips are not in here, one is written under its final name while it records
+IMMUTABLE_FOLDERS = ("images", "cache", "previews")
+# web/ assets are linked with ?v=<mtime> so a new version is a new url
+VERSIONED_FOLDERS = ("web",)
+LONG_CACHE = "public, max-age=31536000, immutable"
+
+# not worth the cpu below this
+GZIP_MIN_BYTES = 512
+GZIP_TYPES = ("text/html", "text/plain", "application/json", "text/css", "text/javascript", "application/javascript")
+
+def assetVersion(st):
+    return f'''{st.st_mtime_ns // 1000000:x}'''
+
+def assetUrl(relative):
+    """
+    url for a file under web/ that changes when the file does, so it can be
+    cached for good
+    """
+    try:
+        return f'''/{relative}?v={assetVersion(os.stat(relative))}'''
+    except OSError:
+        return f'''/{relative}'''
+
+def fileETag(st):
+    """
+    strong validator. a file is only ever replaced by a new inode or a
+    different size/mtime, so this changes whenever the bytes can have
+    """
+    return f'''"{st.st_ino:x}-{st.st_size:x}-{st.st_mtime_ns:x}"'''
+
+def cacheControl(relative, st, query=""):
+    """
+    web/ assets are only kept for good when asked for by the url assetUrl
+    gives out now. a bare or old ?v= from a stale page has to check back
+    """
+    top = relative.split('/', 1)[0]
+    if (top in IMMUTABLE_FOLDERS):
+        return LONG_CACHE
+    if (top in VERSIONED_FOLDERS and parse_qs(query).get("v") == [assetVersion(st)]):
+        return LONG_CACHE
+    return "no-cache"
+
+def parseRange(header, size):
+    """
+    (start, end inclusive) for a single bytes= range, None to send the
+    whole file (no header, several ranges, or nonsense) and False when it
+    can't be satisfied
+    """
+    if (header == None or not header.startswith("bytes=") or ',' in header):
+        return None
+    first, dash, last = header[6:].strip().partition('-')
+    if (dash == ""):
+        return None
+    try:
+        if (first == ""):
+            # the last n bytes
+            n = int(last)
+            if (n <= 0):
+                return False
+            return (max(0, size - n), size - 1)
+        start = int(first)
+        end = size - 1 if last == "" else min(int(last), size - 1)
+    except ValueError:
+        return None
+    if (start >= size or start > end):
+        return False
+    return (start, end)
+
+def isNotModified(handler, etag, st):
+    match = handler.headers.get("If-None-Match")
+    if (match != None):
+        return etag in [t.strip() for t in match.split(',')] or match.strip() == '*'
+    since = handler.headers.get("If-Modified-Since")
+    if (since != None):
+        try:
+            return int(st.st_mtime) <= email.utils.parsedate_to_datetime(since).timestamp()
+        except (TypeError, ValueError):
+            return False
+    return False
+
+def sendFile(handler, path, relative, headOnly=False):
+    """
+    path on disk straight from the page cache to the socket with sendfile.
+    handles If-None-Match/If-Modified-Since and a single Range. relative is
+    the url path without the leading / and picks the Cache-Control
+    """
+    try:
+        f = open(path, "rb")
+    except OSError:
+        handler.send_error(404, "file not found")
+        return
+
+    with f:
+        st = os.fstat(f.fileno())
+        size = st.st_size
+        etag = fileETag(st)
+        modified = email.utils.formatdate(st.st_mtime, usegmt=True)
+        contentType = mimetypes.guess_type(path)[0] or "application/octet-stream"
+        cache = cacheControl(relative, st, urlsplit(handler.path).query)
+
+        def common():
+            handler.send_header("ETag", etag)
+            handler.send_header("Last-Modified", modified)
+            handler.send_header("Cache-Control", cache)
+            handler.send_header("Accept-Ranges", "bytes")
+
+        if (isNotModified(handler, etag, st)):
+            handler.send_response(304)
+            common()
+            handler.end_headers()
+            return
+
+        span = parseRange(handler.headers.get("Range"), size)
+        # a range against an older copy than the client has makes no sense, send it all
+        ifRange = handler.headers.get("If-Range")
+        if (ifRange != None and ifRange.strip() != etag and ifRange.strip() != modified):
+            span = None
+
+        if (span == False):
+            handler.send_response(416)
+            handler.send_header("Content-Range", f'''bytes */{size}''')
+            handler.send_header("Content-Length", "0")
+            common()
+            handler.end_headers()
+            return
+
+        if (span == None):
+            start, end = 0, size - 1
+            handler.send_response(200)
+        else:
+            start, end = span
+            handler.send_response(206)
+            handler.send_header("Content-Range", f'''bytes {start}-{end}/{size}''')
+        count = end - start + 1
+
+        handler.send_header("Content-Type", contentType)
+        handler.send_header("Content-Length", str(count))
+        common()
+        handler.end_headers()
+
+        if (headOnly or count <= 0):
+            return
+        # socket.sendfile() is os.sendfile() that copes with the socket's timeout
+        handler.connection.sendfile(f, start, count)
+
+def acceptsGzip(handler):
+    for coding in handler.headers.get("Accept-Encoding", "").split(','):
+        name, semi, params = coding.strip().partition(';')
+        if (name.strip() in ("gzip", "*") and params.replace(' ', '') != "q=0"):
+            return True
+    return False
+
+def sendBody(handler, body, contentType, headers=None, status=200):
+    """
+    body is bytes. compressed when it's a compressible type, big enough and
+    the client takes gzip
+    """
+    handler.send_response(status)
+    handler.send_header("Content-Type", contentType)
+    if (contentType.split(';')[0] in GZIP_TYPES):
+        handler.send_header("Vary", "Accept-Encoding")
+        if (len(body) >= GZIP_MIN_BYTES and acceptsGzip(handler)):
+            # level 5 is most of the saving for a fraction of the cpu of 9
+            body = gzip.compress(body, compresslevel=5, mtime=0)
+            handler.send_header("Content-Encoding", "gzip")
+    handler.send_header("Content-Length", str(len(body)))
+    for name, value in (headers or {}).items():
+        handler.send_header(name, value)
+    handler.end_headers()
+    if (handler.command != "HEAD"):
+        handler.wfile.write(body)
@@ -0,0 +1,161 @@
+import time
+import socket
+import select
+import queue
+import logging
+import threading
+import http.server as http
+
+logger = logging.getLogger(__name__)
+
+# how often an idle keep-alive connection checks whether someone is waiting for its worker
+IDLE_POLL_SECONDS = 0.1
+
+class PooledHTTPServer(http.HTTPServer):
+    """
+    accepts on the caller's thread with handle_request() and hands each
+    connection to a fixed set of worker threads through a bounded queue.
+    a slow download only ties up its own worker. when every worker is busy
+    and the queue is full new connections get a 503 instead of piling up.
+    an idle keep-alive connection only holds its worker until someone else
+    is waiting for one, and long running responses (event streams) can be
+    detached to a thread of their own so they don't hold a worker at all
+    """
+    def __init__(self, address, handler, workers=8, backlog=16):
+        # before super() binds, a failed bind calls server_close() on the way out
+        self._queue = queue.Queue(backlog)
+        self._lock = threading.Lock()
+        self._connections = set()
+        self._detached = set()
+        self._workers = []
+
+        super().__init__(address, handler)
+        # handle_request() gives up after this so the caller can check for stop/wifi changes
+        self.timeout = 0.5
+        # long running responses (event streams) watch this to know when to let go
+        self.isClosing = False
+
+        self.accepted = 0
+        self.rejected = 0
+        self.active = 0
+        self.idleClosed = 0 # keep-alive connections let go so a waiting one got the worker
+
+        for i in range(workers):
+            t = threading.Thread(target=self._work, name=f'''Web Worker {i}''', daemon=True)
+            t.start()
+            self._workers.append(t)
+
+    def process_request(self, request, client_address):
+        try:
+            self._queue.put_nowait((request, client_address))
+            self.accepted += 1
+        except queue.Full:
+            self.rejected += 1
+            self._reject(request)
+
+    def _reject(self, request):
+        try:
+            request.sendall(b'HTTP/1.1 503 Service Unavailable\r\nContent-Length: 0\r\nRetry-After: 1\r\nConnection: close\r\n\r\n')
+        except OSError:
+            pass
+        self.shutdown_request(request)
+
+    def _work(self):
+        while True:
+            item = self._queue.get()
+            if (item == None):
+                break
+
+            request, client_address = item
+            with self._lock:
+                self._connections.add(request)
+                self.active += 1
+            try:
+                # keep-alive connections stay in here until the client or the timeout ends them
+                self.finish_request(request, client_address)
+            except Exception:
+                self.handle_error(request, client_address)
+            finally:
+                with self._lock:
+                    self._connections.discard(request)
+                    self.active -= 1
+                    detached = request in self._detached
+                    self._detached.discard(request)
+                if (not detached):
+                    self.shutdown_request(request)
+
+    def detach(self, request):
+        """
+        on the worker handling request. the worker lets go of it without
+        closing it, whoever called this closes it with shutdown_request()
+        """
+        with self._lock:
+            self._detached.add(request)
+
+    def waitForRequest(self, connection, rfile, idleTimeout, requestTimeout):
+        """
+        on a worker between requests on a kept-alive connection. True once
+        the next request has started to arrive, False to close it because
+        it sat idle for idleTimeout, the server is closing or another
+        connection is queued for a worker
+        """
+        # a pipelined request may already be sitting in rfile's buffer. with
+        # the socket non blocking peek() returns it, or b'' without waiting
+        connection.settimeout(0)
+        try:
+            if (len(rfile.peek(1)) > 0):
+                return True
+        except OSError:
+            return False
+        finally:
+            connection.settimeout(requestTimeout)
+
+        deadline = time.monotonic() + idleTimeout
+        while True:
+            remaining = deadline - time.monotonic()
+            if (remaining <= 0 or self.isClosing):
+                return False
+            if (self._queue.qsize() > 0):
+                with self._lock:
+                    self.idleClosed += 1
+                return False
+            # readable is the next request or the client hanging up, either way handle_one_request() sorts it out
+            r, w, x = select.select([connection], [], [], min(remaining, IDLE_POLL_SECONDS))
+            if (len(r) > 0):
+                return True
+
+    def server_close(self):
+        self.isClosing = True
+        super().server_close()
+
+        # nobody is going to serve what's still waiting
+        while True:
+            try:
+                request, client_address = self._queue.get_nowait()
+            except queue.Empty:
+                break
+            self.shutdown_request(request)
+
+        # idle keep-alive connections see eof, a response being written still finishes
+        with self._lock:
+            for request in self._connections:
+                try:
+                    request.shutdown(socket.SHUT_RD)
+                except OSError:
+                    pass
+
+        for t in self._workers:
+            self._queue.put(None)
+        # one deadline for all of them, not 5s for each slow client
+        deadline = time.monotonic() + 5
+        for t in self._workers:
+            t.join(timeout=max(0, deadline - time.monotonic()))
+
+    def getMetrics(self):
+        with self._lock:
+            return {"workers": len(self._workers),
+                    "active": self.active,
+                    "queued": self._queue.qsize(),
+                    "accepted": self.accepted,
+                    "rejected": self.rejected,
+                    "idle_closed": self.idleClosed}
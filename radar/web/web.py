@@ -1,30 +1,90 @@
-import sys
 import subprocess
 import os
-import shutil
 import logging
-import threading
 import time
-from urllib.parse import parse_qs
+from datetime import datetime
+from urllib.parse import parse_qs, urlsplit, quote
 import re
+from html import escape
 
 import http.server as http
-from os.path import isfile, isdir
 
 from controller.controller import Controller
+from web.server import PooledHTTPServer
+from web.api import JsonApi
+from web.render import Template, PageCache
+from web.response import sendFile, sendBody, assetUrl
+from metrics.prometheus import REGISTRY, CONTENT_TYPE
+from metrics.profiler import SamplingProfiler
 
 # Configuration
 server = None
 HOST_NAME = ""
 SERVER_PORT = 8080
+IMAGES_PER_PAGE = 50
+PROFILE_NAME = re.compile(r'[A-Za-z0-9_-]{1,32}')
 downWifi = False
 upAP = False
 
 logger = logging.getLogger(__name__)
 
+REQUEST_SECONDS = {kind: REGISTRY.histogram("http_request_seconds", "web request from parsed to answered", {"kind": kind})
+                   for kind in ("page", "api", "file", "metrics")}
+
+# parsed once here, not on every page load
+READINGS_HEAD = Template('''<table class="radar">
+                <thead>
+                <tr><th colspan='6' class='highlight'>Radar Tracked Data</th></tr>
+                <tr><th>Elapsed Time</th><th>Speed(mph)</th><th>Distance (cm)</th><th>Angle(rad)</th><th>Magnitude(dB)</th><th>Raw Targets</th>
+                </thead><tbody id='readings-live'>''')
+READING_ROW = Template("""<tr data-millis='{millis}'>
+                <td>{elapsed}</td>
+                <td>{speed:0>2.2f}</td>
+                <td>{distance:0>4}</td>
+                <td>{angle:0>2.4f}</td>
+                <td>{magnitude}</td>
+                <td>{targets}</td>
+                </tr>
+                """)
+VEHICLES_HEAD = Template('''<table class="radar">
+                <thead>
+                <tr><th colspan='6' class='highlight'>Vehicles</th></tr>
+                <tr><th>Elapsed Time</th><th>Peak(mph)</th><th>Median(mph)</th><th>Closest (cm)</th><th>Dwell (ms)</th><th>Direction</th>
+                </thead><tbody id='vehicles-live'>''')
+VEHICLE_ROW = Template("""<tr data-millis='{millis}'>
+            <td>{elapsed}</td>
+            <td>{peak}</td>
+            <td>{median}</td>
+            <td>{closest:0>4}</td>
+            <td>{dwell}</td>
+            <td>{direction}</td>
+            </tr>""")
+BASIC_METRICS = Template('''<table class="radar">
+                <thead>
+                <tr><td colspan='2' class='highlight'>Basic Metrics</td></tr>
+                </thead>
+        <tr><th class='col-width-15'>Total Reads</th><td class='col-width-85'>{reads}</td></tr>
+        <tr><th>Min/Max Distance(cm)</th><td>{minDistance:0>4}/{maxDistance:0>4}</td></tr>
+        <tr><th>Min/Max Speed (mph)</th><td>{minSpeed:0>2.2f}/{maxSpeed:0>2.2f}</td></tr>
+        <tr><th>Min/Max Angle(rad)</th><td>{minAngle:0>2.4f}/{maxAngle:0>2.4f}</td></tr>
+        <tr><th>Min/Max Magnitude(dB)</th><td>{minMagnitude}/{maxMagnitude}</td></tr>
+        </table>''')
+COUNT_CELL = Template("<td>{label}/{count}</td>")
+COUNT_CELL_HIGHLIGHT = Template("<td class='highlight'>{label}/{count}</td>")
+
+def elapsed(millis):
+    """
+    hh:mm:ss
+    """
+    millis = max(0, int(millis))
+    return f'''{millis // 3600000:0>2}:{millis % 3600000 // 60000:0>2}:{millis % 60000 // 1000:0>2}'''
+
 class HttpInterface:
     def __init__(self):
         self.isStopped = False
+        self.workers = 8
+        self.backlog = 16
+        self.server:PooledHTTPServer = None
 
         # poor man's enum
         self.wifiActionUp = 'up'
@@ -44,8 +104,10 @@ class HttpInterface:
 
         self.wifiAction = None
             
-    def init(self, controller:Controller):
+    def init(self, controller:Controller, workers=8, backlog=16):
         self.controller = controller
+        self.workers = workers
+        self.backlog = backlog
 
     def stop(self):
         self.isStopped = True
@@ -54,26 +116,66 @@ class HttpInterface:
 
         RadarHttpRequestHandler.httpInterface = self
         RadarHttpRequestHandler.controller = self.controller
+        RadarHttpRequestHandler.api = JsonApi(self.controller)
+        RadarHttpRequestHandler.pages = PageCache()
+        REGISTRY.addCollector(self.collectMetrics)
 
-        server = http.HTTPServer((HOST_NAME, SERVER_PORT), RadarHttpRequestHandler)
+        self.server = PooledHTTPServer((HOST_NAME, SERVER_PORT), RadarHttpRequestHandler, self.workers, self.backlog)
         
         while (not self.isStopped):
-            server.handle_request()
+            # only accepts here. requests run on the server's workers and
+            # this comes back within server.timeout when nobody connects
+            self.server.handle_request()
 
             # changing wifi connection. either bringing wifi connection up or down
             # so we need to restart the socket server
             if (self.wifiAction != None):
-                server.server_close()
-                server = None
+                self.server.server_close()
+                self.server = None
 
                 self.doWifiAction()
-                server = http.HTTPServer((HOST_NAME, SERVER_PORT), RadarHttpRequestHandler)
+                self.server = PooledHTTPServer((HOST_NAME, SERVER_PORT), RadarHttpRequestHandler, self.workers, self.backlog)
 
+        self.server.server_close()
         logger.info(f'''web interface was stopped''')
 
+    def getServerMetrics(self):
+        if (self.server == None):
+            return None
+        return self.server.getMetrics()
+
+    def collectMetrics(self):
+        """
+        web server counters for /metrics
+        """
+        samples = []
+        metrics = self.getServerMetrics()
+        if (metrics != None):
+            samples.append(("http_connections_accepted_total", "counter", "connections handed to a worker", None, metrics['accepted']))
+            samples.append(("http_connections_rejected_total", "counter", "connections turned away with a 503", None, metrics['rejected']))
+            samples.append(("http_workers_busy", "gauge", "workers serving a connection", None, metrics['active']))
+            samples.append(("http_connections_queued", "gauge", "connections waiting for a worker", None, metrics['queued']))
+            samples.append(("http_idle_connections_closed_total", "counter", "idle keep-alive connections closed so a waiting one got a worker", None, metrics['idle_closed']))
+        pages = RadarHttpRequestHandler.pages
+        if (pages != None):
+            cache = pages.getMetrics()
+            samples.append(("http_page_cache_hits_total", "counter", "pages served from the page cache", None, cache['hits']))
+            samples.append(("http_page_cache_builds_total", "counter", "pages built for the page cache", None, cache['misses']))
+        return samples
+
 class RadarHttpRequestHandler(http.SimpleHTTPRequestHandler):
     controller:Controller = None # type: ignore
     httpInterface:HttpInterface = None # type: ignore
+    api:JsonApi = None # type: ignore
+    pages:PageCache = None # type: ignore
+    profiler = SamplingProfiler() # idle until /hostcontrol/profile
+
+    # keep-alive. every response has to carry a Content-Length for this
+    protocol_version = "HTTP/1.1"
+    # seconds a request may stall mid way before its worker gives up on it
+    timeout = 15
+    # seconds a kept-alive connection may sit idle between requests. less when others are waiting for a worker
+    keepAliveTimeout = 5
 
     def __init__(self, *args, directory=None, **kwargs):
 
@@ -84,9 +186,15 @@ class RadarHttpRequestHandler(http.SimpleHTTPRequestHandler):
         self.routes['/hostcontrol/changeHostname'] = self.changeHostname
         self.routes['/hostcontrol/reboot'] = self.hostRebootPage
         self.routes['/hostcontrol/forgetssid'] = self.forgetSSID
+        self.routes['/hostcontrol/profile'] = self.profilePage
         self.routes['/hostcontrol'] = self.hostControlPage
         #self.routes['/radarcontrol/resetradar'] = self.radarReset
         self.routes['/radarcontrol/setspeedthreshold'] = self.setSpeedThreshold
+        self.routes['/radarcontrol/profile/apply'] = self.applyProfile
+        self.routes['/radarcontrol/profile/save'] = self.saveProfile
+        self.routes['/radarcontrol/profile/delete'] = self.deleteProfile
+        self.routes['/radarcontrol/rawcapture/start'] = self.startRawCapture
+        self.routes['/radarcontrol/rawcapture/stop'] = self.stopRawCapture
         self.routes['/radarcontrol'] = self.radarControlPage
         self.routes['/readings'] = self.readingsPage
         self.routes['/images/takestill'] = self.takeStill
@@ -121,26 +229,73 @@ class RadarHttpRequestHandler(http.SimpleHTTPRequestHandler):
         <h2>Home Page</h2>
         """
 
-    def imagesPage(self, path, translatedPath):
+    def imagesPage(self, path):
         s = ""
-        (total, used, free) = shutil.disk_usage('.')
-        s += f'''<p>Disk Usage: free: <b>{int(free/total*100)}%</b> used: <b>{int(used/1073741824)}G</b></p>'''
+        host = self.controller.getHostSnapshot()
+        if (host != None):
+            (total, used, free) = (host['disk']['total'], host['disk']['used'], host['disk']['free'])
+            s += f'''<p>Disk Usage: free: <b>{int(free/total*100)}%</b> used: <b>{int(used/1073741824)}G</b></p>'''
         s += "<p><a href='/images/takestill'>Take Still</a></<p>"
 
-        files = []
-        with os.scandir(translatedPath) as d:
-            for f in d:
-                files.append(f.name)
-
+        metrics = self.controller.getCaptureMetrics()
+        if (metrics != None):
+            s += f'''<p>Captures: <b>{metrics['captured']}</b> dropped: <b>{metrics['dropped']}</b> coalesced: <b>{metrics['coalesced']}</b>
+            wait avg/max: <b>{metrics['wait_avg_ms']}/{metrics['wait_max_ms']}ms</b> capture avg/max: <b>{metrics['capture_avg_ms']}/{metrics['capture_max_ms']}ms</b></p>'''
+
+        camera = self.controller.getCameraMetrics()
+        if (camera != None):
+            s += f'''<p>Camera mode: <b>{camera['mode']}</b> size: <b>{camera['size']}</b> preview: <b>{camera['preview_size']}</b>'''
+            if ('total_avg_ms' in camera):
+                s += f''' capture/overlay/save avg: <b>{camera['capture_avg_ms']}/{camera['overlay_avg_ms']}/{camera['save_avg_ms']}ms</b>
+                total avg/max: <b>{camera['total_avg_ms']}/{camera['total_max_ms']}ms</b>'''
+            s += "</p>"
+
+        thumbs = self.controller.thumbnails.getMetrics()
+        s += f'''<p>Thumbnails built: <b>{thumbs['built']}</b> pending: <b>{thumbs['pending']}</b> dropped: <b>{thumbs['dropped']}</b> errors: <b>{thumbs['errors']}</b></p>'''
+
+        clips = self.controller.getClipMetrics()
+        if (clips != None):
+            s += f'''<p>Clips: <b>{clips['clips']}</b> triggers: <b>{clips['triggers']}</b> merged: <b>{clips['merged']}</b>
+            recording: <b>{clips['recording']}</b> last: <b>{clips['last_clip']}</b></p>'''
+
+        # a page at a time out of the index, never the directory
+        query = parse_qs(urlsplit(path).query)
+        cursor = query.get("cursor", [None])[0]
+        images, next = self.controller.images.page(cursor, IMAGES_PER_PAGE)
+
+        s += f'''<p>Images: <b>{len(self.controller.images)}</b></p>'''
+        retention = self.controller.getRetentionMetrics()
+        if (retention != None):
+            free = "-" if retention['free_bytes'] == None else retention['free_bytes'] // 1048576
+            s += f'''<p>Disk used/budget: <b>{retention['used_bytes'] // 1048576}/{retention['budget_bytes'] // 1048576}M</b>
+            free/min: <b>{free}/{retention['min_free_bytes'] // 1048576}M</b>
+            evicted: <b>{retention['evicted']}</b> [{retention['evicted_bytes'] // 1048576}M]</p>'''
+            if (not retention['min_free_reachable']):
+                s += "<p class='highlight'>Free space is below the minimum and deleting images can't fix it, check clips/ and recordings</p>"
+        thumbnails = self.controller.thumbnails
         s += "<table class='radar'>"
-        files.sort(reverse=True)
-        for fileName in files:
-                s += f"""<tr><td><a href='{path}/{fileName}'>{fileName}</a></td></tr>"""
+        for image in images:
+            name = image['name']
+            url = '/' + quote(image['path'])
+            thumb = thumbnails.getUrl("thumb", name)
+            medium = thumbnails.getUrl("medium", name)
+            if (thumb != None and medium != None):
+                s += f"""<tr><td><a href='{medium}'><img src='{thumb}' loading='lazy'/></a><br/><a href='{url}'>{name}</a></td></tr>"""
+            else:
+                # still being built, the next visit will have it
+                s += f"""<tr><td><a href='{url}'>{name}</a></td></tr>"""
         s += "</table>"
+
+        s += "<p>"
+        if (cursor != None):
+            s += "<a href='/images'>Newest</a> "
+        if (next != None):
+            s += f'''<a href='/images?cursor={quote(next)}'>Older</a>'''
+        s += "</p>"
         return s
 
         
-    def radarControlPage(self, path, updated=None):
+    def radarControlPage(self, path, updated=None, message=None):
         params = self.controller.getRadarParameters()
         
         s = f'''<table class="radar"><thead><tr>
@@ -184,19 +339,76 @@ class RadarHttpRequestHandler(http.SimpleHTTPRequestHandler):
         s+= "</tr>"
 
         s += "</table>"
+
+        s += self.profilesSection(message)
+
+        capture = self.controller.getRawCaptureInfo()
+        if (capture == None):
+            s += "<p><a href='/radarcontrol/rawcapture/start'>Start Raw Capture (RADC/RFFT)</a></p>"
+        else:
+            s += f'''<p>Raw capture to <b>{capture['path']}</b> frames: <b>{capture['frames']}</b> dropped: <b>{capture['dropped']}</b> size: <b>{int(capture['bytes']/1048576)}M</b>
+            <a href='/radarcontrol/rawcapture/stop'>Stop Raw Capture</a></p>'''
         # s += "<p><a href='/radarcontrol/resetradar'>Reset Radar</a></<p>"
 
         return s
 
+    def profilesSection(self, message=None):
+        s = "<table class='radar'><thead><tr><th colspan='3' class='highlight'>Profiles</th></tr></thead>"
+        if (message != None):
+            s += f'''<tr><td colspan='3'>{escape(message)}</td></tr>'''
+        names = self.controller.getProfileNames()
+        if (len(names) == 0):
+            s += "<tr><td colspan='3'>No Saved Profiles</td></tr>"
+        for name in names:
+            active = " (active)" if name == self.controller.activeProfile else ""
+            s += f'''<tr><td>{name}{active}</td>
+            <td><a href='/radarcontrol/profile/apply/{name}'>Apply</a></td>
+            <td><a href='/radarcontrol/profile/delete/{name}'>Delete</a></td></tr>'''
+        s += '''<tr><td colspan='3'><form action='/radarcontrol/profile/save' method='get'>
+            <label for='profile'>Save current settings as:</label>
+            <input type='text' id='profile' name='name' pattern='[A-Za-z0-9_-]{1,32}'/>
+            <input type='submit' value='Save'/>
+            </form></td></tr>'''
+        s += "</table>"
+        return s
+
+    def profileName(self, path):
+        """
+        the name at the end of /radarcontrol/profile/<action>/<name> or in ?name=, None if it won't do as a profile name
+        """
+        url = urlsplit(path)
+        name = parse_qs(url.query).get("name", [url.path.rstrip('/').split('/')[-1]])[0]
+        if (PROFILE_NAME.fullmatch(name) == None or name in ("apply", "save", "delete")):
+            return None
+        return name
+
+    def applyProfile(self, path):
+        name = self.profileName(path)
+        if (name == None):
+            return self.radarControlPage(path, message="not a profile name")
+        r, changed = self.controller.applyProfile(name)
+        if (r != 0):
+            return self.radarControlPage(path, message=f'''profile {name} failed [{r}]''')
+        return self.radarControlPage(path, message=f'''profile {name} applied, changed {', '.join(changed) if len(changed) > 0 else 'nothing'}''')
+
+    def saveProfile(self, path):
+        name = self.profileName(path)
+        if (name == None):
+            return self.radarControlPage(path, message="profile names are letters, digits, - and _")
+        self.controller.saveProfile(name)
+        return self.radarControlPage(path, message=f'''saved profile {name}''')
+
+    def deleteProfile(self, path):
+        name = self.profileName(path)
+        if (name == None or not self.controller.deleteProfile(name)):
+            return self.radarControlPage(path, message="no such profile")
+        return self.radarControlPage(path, message=f'''deleted profile {name}''')
+
     def takeStill(self, path):
         self.controller.takeStill()
-        return self.imagesPage('/images', './images')
+        return self.imagesPage('/images')
         
     def readingsPage(self, path):
-        tdatReadings = []
-        
-        tdatReadings = self.controller.getLastTDATReadings()
-        
         # get timing of last tracked reading
         duration = int((time.time() * 1000) - self.controller._lastTrackedReadingTime)
 
@@ -221,81 +433,102 @@ class RadarHttpRequestHandler(http.SimpleHTTPRequestHandler):
 
         s = f'''<p>Uptime {upHours:0>2}:{upMinutes:0>2}:{upSeconds:0>2}</p>'''
         s += f'''<p>Last Tracked Reading Duration {lastTrackedHours:0>2}:{lastTrackedMinutes:0>2}:{lastTrackedSeconds:0>2}</p>'''
-        s += '''<table class="radar">
-                <thead>
-                <tr><th colspan='5' class='highlight'>Radar Tracked Data</th></tr>
-                <tr><th>Elapsed Time</th><th>Speed(mph)</th><th>Distance (cm)</th><th>Angle(rad)</th><th>Magnitude(dB)</th>
-                </thead>'''
-        
+        counters = self.controller.getFrameCounters()
+        s += f'''<p>Frames {counters['pushed']} Overruns {counters['overruns']} Errors {counters['errors']} Resyncs {counters.get('resyncs', 0)} Timeouts {counters.get('timeouts', 0)}</p>'''
+        store = self.controller.getStoreMetrics()
+        if (store != None):
+            s += f'''<p>Stored {store['written']} Queued {store['queued']} Commits {store['commits']} Commit avg/max {store['commit_avg_ms']}/{store['commit_max_ms']}ms Dropped {store['dropped']}</p>'''
+
+        # only rebuilt when a reading or vehicle comes in. live.js keeps the elapsed times current
+        s += self.pages.get("readings", self.controller.getVersion("readings"), self.readingsTables)
+        s += '<br/>' + self.rawTargetsTable(self.controller.getLastFrame())
+
+        s += '<br/>' + self.statsPage(path)
+
+        # new readings and vehicles show up without a reload
+        s += f"<script src='{assetUrl('web/live.js')}'></script>"
+
+        return s
+
+    def readingsTables(self):
+        now = time.time() * 1000
+        tdatReadings = self.controller.getLastTDATReadings()
+
+        s = READINGS_HEAD.text
         if (len(tdatReadings) > 0):
-            for reading in tdatReadings:
-                readTime = reading['millis']
-
-                duration = (time.time()*1000) - readTime
-                hours = int(duration/3600000)
-                duration %= 3600000
-                minutes = int(duration/60000) 
-                duration %= 60000
-                seconds = int(duration/1000)
-
-                s += f"""<tr>
-                <td>{hours:0>2}:{minutes:0>2}:{seconds:0>2}</td>
-                <td>{reading['speed']:0>2.2f}</td>
-                <td>{reading['distance']:0>4}</td>
-                <td>{reading['angle']:0>2.4f}</td>
-                <td>{reading['magnitude']}</td>
-                </tr>
-                """
+            s += READING_ROW.renderAll([{"millis": int(reading['millis']),
+                                         "elapsed": elapsed(now - reading['millis']),
+                                         "speed": reading['speed'],
+                                         "distance": reading['distance'],
+                                         "angle": reading['angle'],
+                                         "magnitude": reading['magnitude'],
+                                         "targets": reading.get('targets', 0)} for reading in tdatReadings])
         else:
-            s += f"""<tr><td colspan='5'>No Readings Available</td></tr>"""
+            s += f"""<tr><td colspan='6'>No Readings Available</td></tr>"""
+        s += '</tbody></table>'
 
-        s += '</table>'
+        s += '<br/>' + self.vehiclesTable(self.controller.getLastVehicleEvents())
+        return s
 
-        s += '<br/>' + self.statsPage(path)
+    def vehiclesTable(self, events):
+        s = VEHICLES_HEAD.text
+
+        if (len(events) == 0):
+            s += f"""<tr><td colspan='6'>No Vehicles Yet</td></tr>"""
+
+        now = time.time() * 1000
+        s += VEHICLE_ROW.renderAll([{"millis": int(event['millis']),
+                                     "elapsed": elapsed(now - event['millis']),
+                                     "peak": event['peak_speed_mph'],
+                                     "median": event['median_speed_mph'],
+                                     "closest": event['closest_distance'],
+                                     "dwell": event['dwell'],
+                                     "direction": event['direction']} for event in events])
 
+        s += '</tbody></table>'
         return s
-        
-    def statsPage(self, path):
-        stats = self.controller.getStats()
 
-        s = '<br/>'
-        s += '''<table class="radar">
+    def rawTargetsTable(self, frame):
+        s = '''<table class="radar">
                 <thead>
-                <tr><td colspan='2' class='highlight'>Basic Metrics</td></tr>
+                <tr><th colspan='4' class='highlight'>Last Frame Raw Targets (PDAT)</th></tr>
+                <tr><th>Speed(km/h)</th><th>Distance (cm)</th><th>Angle(rad)</th><th>Magnitude(dB)</th>
                 </thead>'''
-        
-        s += f"""
-        <tr><th class='col-width-15'>Total Reads</th><td class='col-width-85'>{stats[self.controller.read_count]}</td></tr>
-        <tr><th>Min/Max Distance(cm)</th><td>{stats[self.controller.min_distance]:0>4}/{stats[self.controller.max_distance]:0>4}</td></tr>
-        <tr><th>Min/Max Speed (mph)</th><td>{stats[self.controller.min_speed]:0>2.2f}/{stats[self.controller.max_speed]:0>2.2f}</td></tr>
-        <tr><th>Min/Max Angle(rad)</th><td>{stats[self.controller.min_angle]:0>2.4f}/{stats[self.controller.max_angle]:0>2.4f}</td></tr>
-        <tr><th>Min/Max Magnitude(dB)</th><td>{stats[self.controller.min_magnitude]}/{stats[self.controller.max_magnitude]}</td></tr>
-        """
+
+        if (frame == None or frame.getTargetCount() == 0):
+            s += f"""<tr><td colspan='4'>No Targets</td></tr>"""
+        else:
+            for t in frame.pdat:
+                s += f"""<tr><td>{t['speed']:0>2.2f}</td><td>{t['distance']:0>4}</td><td>{t['angle']:0>2.4f}</td><td>{t['magnitude']}</td></tr>"""
+
+        if (frame != None and frame.ddat != None):
+            flags = ' '.join([f'{k}[{v}]' for k,v in frame.ddat.items()])
+            s += f"""<tr><th>Detection</th><td colspan='3'>{flags}</td></tr>"""
 
         s += '</table>'
+        return s
 
-        ####################
-        s += '<br/><table class="radar"><thead><tr><th class="highlight" colspan="13">Trackings by Hour</th></tr></thead>'
+    def statsPage(self, path):
+        return self.pages.get("stats", self.controller.getStatsVersion(), self.statsTables)
 
-        counts = stats[self.controller.hourly_counts]
+    def statsTables(self):
+        stats = self.controller.getStats()
 
-        amRow = "<tr><th>AM</th>"
-        for hour in range(0,12):
-            if (counts[hour]>0):
-                amRow += f"""<td class='highlight'>{hour:0>2}/{counts[hour]}</td>"""
-            else:
-                amRow += f"""<td>{hour:0>2}/{counts[hour]}</td>"""
-        amRow += "</tr>"
+        s = '<br/>'
+        s += BASIC_METRICS.render(reads=stats[self.controller.read_count],
+                                  minDistance=stats[self.controller.min_distance], maxDistance=stats[self.controller.max_distance],
+                                  minSpeed=stats[self.controller.min_speed], maxSpeed=stats[self.controller.max_speed],
+                                  minAngle=stats[self.controller.min_angle], maxAngle=stats[self.controller.max_angle],
+                                  minMagnitude=stats[self.controller.min_magnitude], maxMagnitude=stats[self.controller.max_magnitude])
 
-        pmRow = "<tr><th>PM</th>"
-        for hour in range(12,24):
-            if (counts[hour]>0):
-                pmRow += f"""<td class='highlight'>{hour:0>2}/{counts[hour]}</td>"""
-            else:
-                pmRow += f"""<td>{hour:0>2}/{counts[hour]}</td>"""
-        pmRow += "</tr>"
+        s += self.percentilesTable(self.controller.getPercentiles())
+        s += self.percentileSlotsTable("Vehicle Speed p85 by Hour (mph)", self.controller.getPercentileSlots("vehicle_speed", "hour"), "%H")
+        s += self.percentileSlotsTable("Vehicle Speed p85 by Day (mph)", self.controller.getPercentileSlots("vehicle_speed", "day")[-7:], "%a %d")
 
-        s += amRow + pmRow + '</thead></table>'
+        ####################
+        s += '<br/><table class="radar"><thead><tr><th class="highlight" colspan="13">Trackings by Hour</th></tr></thead>'
+        s += self.hourRows(stats[self.controller.hourly_counts])
+        s += '</thead></table>'
 
         s += '<br/>'
         #############################################
@@ -303,68 +536,78 @@ class RadarHttpRequestHandler(http.SimpleHTTPRequestHandler):
         s += "<thead><th class='highlight' colspan='12'>Trackings by Speed Bucket</th></thead>"
         s += "<tr>"
         s += "<th>Bucket/Count</th>"
-        for speed, count in stats[self.controller.speed_counts].items():
-            if (count > 0):
-                s += f"""<td class='highlight'>{speed}/{count}</td>"""
-            else:
-                s += f"""<td>{speed}/{count}</td>"""
+        s += "".join([(COUNT_CELL_HIGHLIGHT if count > 0 else COUNT_CELL).render(label=speed, count=count)
+                      for speed, count in stats[self.controller.speed_counts].items()])
         s += "</tr>"
 
         s += '</table>'
         ###############################################################################################
         s += '<br/><table class="radar"><thead><tr><th class="highlight" colspan="13"> Over 30 by Hour</th></tr></thead>'
-
-        counts = stats[self.controller.hourly_count_gt_30]
-
-        amRow = "<tr><th>AM</th>"
-        for hour in range(0,12):
-            if (counts[hour] > 0):
-                amRow += f"""<td class='highlight'>{hour:0>2}/{counts[hour]}</td>"""
-            else:
-                amRow += f"""<td>{hour:0>2}/{counts[hour]}</td>"""
-        amRow += "</tr>"
-
-        pmRow = "<tr><th>PM</th>"
-        for hour in range(12,24):
-            if (counts[hour] > 0):
-                pmRow += f"""<td class='highlight'>{hour:0>2}/{counts[hour]}</td>"""
-            else:
-                pmRow += f"""<td>{hour:0>2}/{counts[hour]}</td>"""
-        pmRow += "</tr>"
-
-        s += amRow + pmRow + '</thead></table>'
+        s += self.hourRows(stats[self.controller.hourly_count_gt_30])
+        s += '</thead></table>'
 
         s += '<br/>'
 
         return s
+
+    def hourRows(self, counts):
+        """
+        AM and PM rows of hour/count cells, hours with something highlighted
+        """
+        def cells(hours):
+            return "".join([(COUNT_CELL_HIGHLIGHT if counts[hour] > 0 else COUNT_CELL).render(label=f'''{hour:0>2}''', count=counts[hour])
+                            for hour in hours])
+        return f'''<tr><th>AM</th>{cells(range(0, 12))}</tr><tr><th>PM</th>{cells(range(12, 24))}</tr>'''
         
+    def percentilesTable(self, percentiles):
+        s = '<br/><table class="radar">'
+        s += "<thead><tr><th class='highlight' colspan='4'>Percentiles p50/p85/p95 (count)</th></tr>"
+        s += "<tr><th></th><th>Minute</th><th>Hour</th><th>Day</th></tr></thead>"
+        for name, windows in percentiles.items():
+            s += f'''<tr><th>{name}</th>'''
+            for window in ("minute", "hour", "day"):
+                w = windows[window]
+                if (w['count'] == 0):
+                    s += "<td>-</td>"
+                else:
+                    s += f'''<td>{w['p50']:.0f}/<b>{w['p85']:.0f}</b>/{w['p95']:.0f} ({w['count']})</td>'''
+            s += "</tr>"
+        s += '</table>'
+        return s
+
+    def percentileSlotsTable(self, title, slots, labelFormat):
+        s = f'''<br/><table class="radar"><thead><tr><th class="highlight" colspan="{len(slots) + 1}">{title}</th></tr></thead>'''
+        s += "<tr><th>Start</th>"
+        for start, summary in slots:
+            s += f'''<td>{datetime.fromtimestamp(start / 1000).strftime(labelFormat)}</td>'''
+        s += "</tr><tr><th>p85/count</th>"
+        for start, summary in slots:
+            if (summary['count'] == 0):
+                s += "<td>-</td>"
+            else:
+                s += f'''<td class='highlight'>{summary['p85']:.0f}/{summary['count']}</td>'''
+        s += "</tr></table>"
+        return s
+
     def hostControlPage(self, path):
-        
-        with open("/proc/uptime", mode="r") as data:
-          ut = int(float(data.read().split(' ')[0]))
-                
+        # everything here was sampled in the background, see HostSampler
+        host = self.controller.getHostSnapshot()
+        if (host == None):
+            return "<h2>Host Control</h2><div>Host metrics aren't sampled yet, try again in a moment</div>"
+
+        ut = host['uptime']
         days = int(ut/86400)
         hours = int((ut%86400)/3600)
         minutes = int((ut%3600) / 60)
         seconds = int((ut%60))
 
-        (total, used, free) = shutil.disk_usage('.')
-        
-        memory =[]
-        with open('/proc/meminfo', 'r', encoding='utf-8') as meminfo:
-            lines = meminfo.readlines()
-            for line in lines:
-                match = re.match(r'^(\w+):\s+(\d+)\s+(\w+)', line)
-
-                if (match != None):
-                    memory.append([match[1], match[2], match[3]])
-
-        # first see what connection we have
-        onRadarAP = False
-        output = subprocess.run(["nmcli", "-f", "general.connection", "device", "show", "wlan0"], capture_output=True)
-        m = re.match(r'GENERAL.CONNECTION: +(radar-ap)', output.stdout.decode('utf-8'))
-        if (m != None):
-            onRadarAP = True
+        total = host['disk']['total']
+        used = host['disk']['used']
+        free = host['disk']['free']
+
+        memory = [[name, kb, "kB"] for name, kb in host['memory_kb'].items()]
+
+        onRadarAP = host['on_ap']
 
         section =  f"""
         <h2>Host Control</h2>
@@ -372,7 +615,11 @@ class RadarHttpRequestHandler(http.SimpleHTTPRequestHandler):
             <li>Camera Control</li>
         </ol>
         <div>Uptime {days:0>2} days {hours:0>2}:{minutes:0>2}:{seconds:0>2}</div>
+        <div>Load {host['load'][0]:.2f} {host['load'][1]:.2f} {host['load'][2]:.2f}{f" temperature {host['temperature']:.1f}C" if host['temperature'] != None else ""}
+        wifi {host['connection']} sampled {int(time.time() - host['millis'] / 1000)}s ago</div>
+        {self.serverStatus()}
         <div><a href='/hostcontrol/reboot'>Reboot</a></div>
+        <div><a href='/hostcontrol/profile?seconds=10'>Profile for 10s</a> where every thread spends its time</div>
         """
 
         if (onRadarAP == False):
@@ -424,6 +671,59 @@ class RadarHttpRequestHandler(http.SimpleHTTPRequestHandler):
         """
         return section
 
+    def profilePage(self, path):
+        """
+        runs the sampling profiler on this worker for ?seconds= (10, at
+        most 60) and keeps the collapsed stacks in profiling/ for a flame graph
+        """
+        query = parse_qs(urlsplit(path).query)
+        try:
+            seconds = float(query.get("seconds", ["10"])[0])
+            hz = float(query.get("hz", ["100"])[0])
+        except ValueError:
+            hz = None
+        # written this way round so nan doesn't get through
+        if (hz == None or not (seconds > 0 and hz > 0)):
+            return "<h2>Profile</h2><div>seconds and hz have to be numbers</div>"
+        interval = 1 / hz
+
+        result = self.profiler.profile(seconds, interval)
+        if (result == None):
+            return "<h2>Profile</h2><div>A profile is already running, try again when it's done</div>"
+
+        os.makedirs("profiling", exist_ok=True)
+        name = f'''profiling/{datetime.now().strftime('%Y%m%d-%H%M%S')}.folded'''
+        with open(name, "w", encoding="utf-8") as f:
+            f.write(result['collapsed'])
+
+        s = f'''<h2>Profile</h2>
+        <div>{result['seconds']}s, {result['samples']} samples, process cpu {result['process_cpu_percent']}%.
+        Collapsed stacks: <a href='/{name}'>{name}</a> (flamegraph.pl or speedscope.app)</div>'''
+        s += "<table class='radar'><thead><tr><th>Thread</th><th>CPU %</th><th>CPU s</th><th>Samples</th></tr></thead>"
+        for t in result['threads']:
+            cpu = "-" if t['cpu_percent'] == None else t['cpu_percent']
+            seconds = "-" if t['cpu_seconds'] == None else t['cpu_seconds']
+            s += f'''<tr><td>{escape(t['name'])}{' (profiler)' if t['profiler'] else ''}</td><td>{cpu}</td><td>{seconds}</td><td>{t['samples']}</td></tr>'''
+        s += "</table>"
+
+        # the hottest stacks right here, the file has all of them
+        s += "<table class='radar'><thead><tr><th>Samples</th><th>Stack (innermost last)</th></tr></thead>"
+        for line in result['collapsed'].splitlines()[:20]:
+            stack, space, count = line.rpartition(' ')
+            s += f'''<tr><td>{count}</td><td>{escape(stack.replace(';', ' > '))}</td></tr>'''
+        s += "</table>"
+        return s
+
+    def serverStatus(self):
+        metrics = self.httpInterface.getServerMetrics()
+        if (metrics == None):
+            return ""
+        s = f'''<div>Web workers {metrics['active']}/{metrics['workers']} busy, {metrics['queued']} waiting. accepted {metrics['accepted']} rejected {metrics['rejected']} idle closed {metrics['idle_closed']}</div>'''
+        if (self.pages != None):
+            pages = self.pages.getMetrics()
+            s += f'''<div>Page cache hits {pages['hits']} builds {pages['misses']}</div>'''
+        return s
+
     def changeHostname(self, form_data):
         hostname = form_data["hostname"]
         print(f'["/usr/bin/sudo","/usr/bin/hostnamectl","set-hostname", {hostname}])')
@@ -472,6 +772,14 @@ class RadarHttpRequestHandler(http.SimpleHTTPRequestHandler):
         return self.radarControlPage(path)
 
 
+    def startRawCapture(self, path):
+        self.controller.startRawCapture()
+        return self.radarControlPage(path)
+
+    def stopRawCapture(self, path):
+        self.controller.stopRawCapture()
+        return self.radarControlPage(path)
+
     def setSpeedThreshold(self, path):
 
         parts = list(filter(lambda x: x!='', path.split('/')))
@@ -491,7 +799,7 @@ class RadarHttpRequestHandler(http.SimpleHTTPRequestHandler):
     def htmlHeader(self, path):
         return f"""\
     <head>
-        <link rel='stylesheet' href='/web/styles.css'/>
+        <link rel='stylesheet' href='{assetUrl("web/styles.css")}'/>
     </head>
         """
 
@@ -507,6 +815,16 @@ class RadarHttpRequestHandler(http.SimpleHTTPRequestHandler):
     </div>
     """
 
+    def handle(self):
+        # BaseHTTPRequestHandler waits for the next request with the full
+        # timeout. an idle connection shouldn't keep a worker from a new one
+        self.close_connection = True
+        self.handle_one_request()
+        while not self.close_connection:
+            if (not self.server.waitForRequest(self.connection, self.rfile, self.keepAliveTimeout, self.timeout)):
+                break
+            self.handle_one_request()
+
     def log_message(self, format, *args):
         super().log_message(format, *args)
         return
@@ -540,36 +858,70 @@ class RadarHttpRequestHandler(http.SimpleHTTPRequestHandler):
         else:
             response = f"Raw Data Received: {post_body_str}"
      
+        body = response.encode('utf-8')
         self.send_response(200)
         self.send_header('Content-Type', 'text/plain; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
         self.end_headers()
-        self.wfile.write(response.encode('utf-8'))
+        self.wfile.write(body)
         
     def do_GET(self):
-        # let super class to serve the file since that's what it does
+        start = time.monotonic()
+        kind = self.serveGet()
+        # event streams last as long as the client stays, they'd only smear the histogram
+        if (kind != None):
+            REQUEST_SECONDS[kind].observe(time.monotonic() - start)
+
+    def serveGet(self):
+        """
+        answers the GET, returns what kind of request it was for REQUEST_SECONDS
+        """
+        if (self.path.startswith('/api/events')):
+            self.api.handle(self)
+            return None
+
+        if (self.path.startswith('/api/')):
+            self.api.handle(self)
+            return "api"
+
+        if (urlsplit(self.path).path == '/metrics'):
+            sendBody(self, REGISTRY.render().encode("utf-8"), CONTENT_TYPE)
+            return "metrics"
+
+        # files go straight from disk to the socket, see sendFile()
         translated_path = self.translate_path(self.path)
 
         if (os.path.isfile(translated_path)):
-            super().do_GET()
-            return
-        
-        self.send_response(200)
-        
-        self.send_header("Content-type", "text/html")
-        self.end_headers()
+            sendFile(self, translated_path, self.relativePath(translated_path))
+            return "file"
         
+        # the whole page is built first so it can go out with a Content-Length
+        page = "<!DOCTYPE html>\n<html>"
+        page += self.htmlHeader(self.path)
+        page += "<body>"
+
+        page += self.pageHeader(self.path)
+        page += self.handleGetRequest(self.path)
+
+        page += "</body>"
+        page += "</html>"
+
         # Note: Content must be encoded to bytes using "utf-8"
-        self.wfile.write(bytes("<!DOCTYPE html>\n<html>", "utf-8"))
+        body = bytes(page, "utf-8")
 
-        self.wfile.write(bytes(self.htmlHeader(self.path), "utf-8"))
-        self.wfile.write(bytes("<body>", "utf-8"))
+        # gzipped when the browser takes it, the pages are mostly table markup
+        sendBody(self, body, "text/html; charset=utf-8")
+        return "page"
 
-        self.wfile.write(bytes(self.pageHeader(self.path), "utf-8"))
-        if (self.path.endswith('/images') or self.path.endswith('images/')):
-            section = self.imagesPage(self.path, translated_path)
-            self.wfile.write(bytes(section, "utf-8"))
-        else:
-            self.wfile.write(bytes(self.handleGetRequest(self.path), "utf-8"))
+    def do_HEAD(self):
+        translated_path = self.translate_path(self.path)
+        if (os.path.isfile(translated_path)):
+            sendFile(self, translated_path, self.relativePath(translated_path), headOnly=True)
+            return
+        super().do_HEAD()
 
-        self.wfile.write(bytes("</body>", "utf-8"))
-        self.wfile.write(bytes("</html>", "utf-8"))
+    def relativePath(self, translated_path):
+        """
+        translated_path relative to what we serve, with / separators
+        """
+        return os.path.relpath(translated_path, self.directory).replace(os.sep, '/')